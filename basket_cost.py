@@ -0,0 +1,233 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from geojson_stream import atomic_open
+from price_matrix import PriceMatrix
+
+# Baskets priced together in batch mode; bounds the dense store x item block to
+# stores x (items in the chunk's baskets)
+BATCH_CHUNK_SIZE = 256
+
+
+def normalize_basket(basket):
+    """
+    Return (itemcodes, quantities) arrays for a basket given as {itemcode: quantity},
+    a list of (itemcode, quantity) pairs or a list of itemcodes (quantity 1 each).
+    Repeated itemcodes are merged.
+    """
+    if isinstance(basket,dict):
+        pairs = basket.items()
+    else:
+        pairs = [item if isinstance(item,(list,tuple)) else (item,1) for item in basket]
+    merged = {}
+    for itemcode,quantity in pairs:
+        itemcode = int(itemcode)
+        merged[itemcode] = merged.get(itemcode,0) + float(quantity)
+    itemcodes = np.fromiter(merged.keys(),dtype=np.int64,count=len(merged))
+    quantities = np.fromiter(merged.values(),dtype=np.float64,count=len(merged))
+    return itemcodes,quantities
+
+
+class BasketResult:
+    """
+    Cost of one or more baskets in every store.
+
+    Attributes:
+    store_ids (ndarray): Matrix store indexes of the compared stores (rows of the arrays below)
+    totals (ndarray): stores x baskets cost of the items each store carries
+    coverage (ndarray): stores x baskets number of basket items each store carries
+    item_counts (ndarray): Number of distinct items per basket
+    ranks (ndarray): stores x baskets rank, 1 = cheapest among the stores missing the fewest items
+    unknown (list): Per basket, the itemcodes no store sells
+    """
+
+    def __init__(self,matrix,store_ids,totals,coverage,item_counts,unknown):
+        self.matrix = matrix
+        self.store_ids = store_ids
+        self.totals = totals
+        self.coverage = coverage
+        self.item_counts = item_counts
+        self.unknown = unknown
+
+        # Order by missing items first, then total; totals are non-negative, so one key works
+        missing = item_counts[np.newaxis,:] - coverage
+        key = missing * (np.nanmax(totals,initial=0.0) + 1.0) + totals
+        order = np.argsort(key,axis=0,kind='stable')
+        self.ranks = np.empty_like(order)
+        np.put_along_axis(self.ranks,order,np.arange(1,len(store_ids) + 1)[:,np.newaxis],axis=0)
+
+    @property
+    def basket_count(self):
+        return self.totals.shape[1]
+
+    def rows(self,basket=0,limit=None):
+        """
+        Return the stores for one basket as dicts ordered by rank.
+
+        Parameters:
+        basket (int): Basket index
+        limit (int): Optional number of stores to return
+        """
+        order = np.argsort(self.ranks[:,basket],kind='stable')
+        if limit is not None:
+            order = order[:limit]
+        rows = []
+        for row in order:
+            store = self.matrix.stores[self.store_ids[row]]
+            carried = int(self.coverage[row,basket])
+            rows.append({
+                "rank": int(self.ranks[row,basket]),
+                "store_code": store['store_code'],
+                "store_name": store['store_name'],
+                "chainname": store['chainname'],
+                "city": store['city'],
+                "total": round(float(self.totals[row,basket]),2),
+                "coverage": carried,
+                "missing": int(self.item_counts[basket]) - carried
+            })
+        return rows
+
+
+class BasketEngine:
+    """
+    Prices shopping baskets in every store at once with a matrix product over the
+    store x item price matrix (see price_matrix.py).
+
+    For a chunk of baskets, the price columns of the items they contain are gathered into a
+    dense stores x items block P (0 where a store does not carry the item) with a matching
+    0/1 block C, and the baskets into an items x baskets quantity matrix Q. Then
+    totals = P @ Q and coverage = C @ (Q > 0).
+
+    Parameters:
+    matrix (PriceMatrix or str): Price matrix or its directory
+    """
+
+    def __init__(self,matrix):
+        self.matrix = PriceMatrix(matrix) if isinstance(matrix,str) else matrix
+
+    def _price_columns(self,item_ids,store_ids):
+        """Dense prices and carried flags of the given item columns for the given stores"""
+        matrix = self.matrix
+        starts = matrix.col_indptr[item_ids]
+        lengths = matrix.col_indptr[item_ids + 1] - starts
+        columns = np.repeat(np.arange(len(item_ids)),lengths)
+        offsets = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths,lengths)
+        positions = np.repeat(starts,lengths) + offsets
+
+        rows = matrix.col_stores[positions]
+        prices = np.zeros((matrix.store_count,len(item_ids)),dtype=np.float32)
+        prices[rows,columns] = matrix.col_prices[positions]
+        carried = np.zeros((matrix.store_count,len(item_ids)),dtype=np.float32)
+        carried[rows,columns] = 1.0
+        return prices[store_ids],carried[store_ids]
+
+    def price_baskets(self,baskets,store_codes=None,chunk_size=BATCH_CHUNK_SIZE):
+        """
+        Price several baskets in the selected stores.
+
+        Parameters:
+        baskets (list): Baskets in any format accepted by normalize_basket
+        store_codes (iterable): Optional stores to compare (default: every store)
+        chunk_size (int): Baskets per matrix product
+        """
+        matrix = self.matrix
+        if store_codes is None:
+            store_ids = np.arange(matrix.store_count)
+        else:
+            store_ids = np.array([matrix.store_index[code] for code in store_codes],dtype=np.int64)
+
+        normalized = [normalize_basket(basket) for basket in baskets]
+        totals = np.zeros((len(store_ids),len(normalized)))
+        coverage = np.zeros((len(store_ids),len(normalized)),dtype=np.int64)
+        item_counts = np.array([len(itemcodes) for itemcodes,quantities in normalized],dtype=np.int64)
+        unknown = []
+
+        for chunk_start in range(0,len(normalized),chunk_size):
+            chunk = normalized[chunk_start:chunk_start + chunk_size]
+            chunk_ids = [matrix.item_ids(itemcodes) for itemcodes,quantities in chunk]
+            for (itemcodes,quantities),item_ids in zip(chunk,chunk_ids):
+                unknown.append(itemcodes[item_ids < 0].tolist())
+
+            # Items of the chunk's baskets, each priced once
+            known = [item_ids[item_ids >= 0] for item_ids in chunk_ids]
+            columns = np.unique(np.concatenate(known)) if known else np.empty(0,dtype=np.int64)
+            quantities = np.zeros((len(columns),len(chunk)),dtype=np.float32)
+            for basket,((itemcodes,basket_quantities),item_ids) in enumerate(zip(chunk,chunk_ids)):
+                found = item_ids >= 0
+                quantities[np.searchsorted(columns,item_ids[found]),basket] = basket_quantities[found]
+
+            prices,carried = self._price_columns(columns,store_ids)
+            chunk_end = chunk_start + len(chunk)
+            totals[:,chunk_start:chunk_end] = prices @ quantities
+            coverage[:,chunk_start:chunk_end] = np.rint(carried @ (quantities > 0).astype(np.float32))
+
+        return BasketResult(matrix,store_ids,totals,coverage,item_counts,unknown)
+
+    def price_basket(self,basket,store_codes=None,limit=None):
+        """Price one basket and return the stores ordered by rank (see BasketResult.rows)"""
+        return self.price_baskets([basket],store_codes).rows(0,limit)
+
+    def stores_near(self,lat,lon,radius_km):
+        """Return the codes of the matrix stores within radius_km of a point"""
+        from spatial_index import StoreIndex
+
+        features = [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point","coordinates": [store['longitude'],store['latitude']]},
+                "properties": store
+            }
+            for store in self.matrix.stores
+            if store['latitude'] is not None and store['longitude'] is not None
+        ]
+        return [feature['properties']['store_code'] for distance,feature in StoreIndex(features).within(lat,lon,radius_km)]
+
+
+def load_baskets(path):
+    """
+    Load baskets from a JSON file: a single basket ({itemcode: quantity} or a list of
+    itemcodes / [itemcode, quantity] pairs), or a list of {itemcode: quantity} baskets.
+    """
+    with open(path,'r',encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data,list) and data and all(isinstance(basket,dict) for basket in data):
+        return data
+    return [data]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Price shopping baskets in every store")
+    parser.add_argument("baskets",help="JSON file with a basket ({itemcode: quantity} or a list) or a list of baskets")
+    parser.add_argument("--matrix",default="data/price_matrix",help="Price matrix directory (see price_matrix.py)")
+    parser.add_argument("--near",type=float,nargs=3,metavar=("LAT","LON","KM"),default=None,
+                        help="Only compare stores within KM of a point")
+    parser.add_argument("--top",type=int,default=10,help="Stores to show or write per basket")
+    parser.add_argument("--output",default=None,help="Write the results for every basket to this JSON file")
+    args = parser.parse_args()
+
+    engine = BasketEngine(args.matrix)
+    baskets = load_baskets(args.baskets)
+    store_codes = engine.stores_near(*args.near) if args.near else None
+
+    start = time.perf_counter()
+    result = engine.price_baskets(baskets,store_codes)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"Priced {result.basket_count} baskets in {len(result.store_ids)} stores in {elapsed:.1f} ms")
+
+    if args.output:
+        with atomic_open(args.output,'w') as f:
+            json.dump([
+                {"items": int(result.item_counts[b]),"unknown": result.unknown[b],"stores": result.rows(b,args.top)}
+                for b in range(result.basket_count)
+            ],f,ensure_ascii=False,indent=2)
+        print(f"Results saved to {args.output}")
+    else:
+        for b in range(result.basket_count):
+            print(f"\nBasket {b + 1}: {result.item_counts[b]} items"
+                  + (f", not sold anywhere: {result.unknown[b]}" if result.unknown[b] else ""))
+            for row in result.rows(b,args.top):
+                print(f"  {row['rank']:4d}. {row['total']:9.2f}  {row['coverage']}/{result.item_counts[b]}  "
+                      f"{row['store_code']}  {row['chainname']} - {row['store_name']}")
@@ -0,0 +1,396 @@
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import numpy as np
+
+from geojson_stream import atomic_open
+from synthetic_data import (DEFAULT_SEED,DEFAULT_UPLOAD_DATE,SCALES,SyntheticDataset,load_into_postgres,
+                            write_store_comparisons_csv)
+
+# A benchmark regresses if it got slower by more than TIME_TOLERANCE and MIN_REGRESSION_S,
+# or its peak memory grew by more than MEMORY_TOLERANCE and MIN_REGRESSION_MB
+TIME_TOLERANCE = 0.25
+MIN_REGRESSION_S = 0.05
+MEMORY_TOLERANCE = 0.10
+MIN_REGRESSION_MB = 5
+
+# Connections used by the pooled database benchmarks
+BENCHMARK_CONNECTIONS = 4
+
+# Worker processes forked while memory is traced would inherit tracing and run several times
+# slower; their memory is not measured anyway
+os.register_at_fork(after_in_child=tracemalloc.stop)
+
+
+class BenchmarkContext:
+    """
+    Inputs shared by the benchmarks of one run. Each input is built from the synthetic
+    dataset on first use, outside the timed runs.
+
+    Parameters:
+    dataset (SyntheticDataset): Data to benchmark with
+    work_dir (str): Scratch directory for inputs and outputs
+    """
+
+    def __init__(self,dataset,work_dir):
+        self.dataset = dataset
+        self.work_dir = work_dir
+        self._inputs = {}
+
+    def _input(self,name,build):
+        if name not in self._inputs:
+            with redirect_stdout(io.StringIO()):
+                self._inputs[name] = build()
+        return self._inputs[name]
+
+    @property
+    def csv_file(self):
+        def build():
+            output_file = os.path.join(self.work_dir,'input','store_price_comparisons.csv')
+            os.makedirs(os.path.dirname(output_file),exist_ok=True)
+            write_store_comparisons_csv(self.dataset,output_file)
+            return output_file
+        return self._input('csv_file',build)
+
+    @property
+    def geojson_file(self):
+        def build():
+            from csv_to_geojson import csv_to_geojson
+            output_file = os.path.join(self.work_dir,'input','stores.geojson')
+            csv_to_geojson(self.csv_file,output_file)
+            return output_file
+        return self._input('geojson_file',build)
+
+    @property
+    def features(self):
+        from tile_pyramid import load_features
+        return self._input('features',lambda: load_features(self.geojson_file))
+
+    @property
+    def price_data(self):
+        from price_aggregation import encode_price_data
+        return self._input('price_data',lambda: encode_price_data(self.dataset.prices,self.dataset.stores))
+
+    @property
+    def store_rows(self):
+        return self._input('store_rows',lambda: list(self.dataset.store_price_rows()))
+
+    def output(self,name):
+        """Return an empty output directory for one benchmark run"""
+        path = os.path.join(self.work_dir,'output',name)
+        shutil.rmtree(path,ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+
+def bench_csv_to_geojson(context):
+    from csv_to_geojson import csv_to_geojson
+    csv_to_geojson(context.csv_file,os.path.join(context.output('csv_to_geojson'),'stores.geojson'))
+
+
+def bench_csv_to_geojson_chunks(context):
+    from csv_to_geojson import csv_to_geojson
+    workers = max(2,os.cpu_count() or 1)
+    # Small chunks so every worker gets several, even at 1x
+    chunk_size = max(64 * 1024,os.path.getsize(context.csv_file) // (workers * 4))
+    csv_to_geojson(context.csv_file,os.path.join(context.output('csv_to_geojson_chunks'),'stores.geojson'),
+                   workers=workers,chunk_size=chunk_size)
+
+
+def bench_cheaper_neighbours(context):
+    from spatial_index import add_cheaper_neighbours
+    add_cheaper_neighbours(context.features)
+
+
+def bench_nearby_comparisons(context):
+    from head_to_head import add_nearby_comparisons,store_prices_from_price_data
+    add_nearby_comparisons(context.features,store_prices_from_price_data(context.price_data))
+
+
+def bench_tile_pyramid(context):
+    from tile_pyramid import write_tile_pyramid
+    write_tile_pyramid(context.features,context.output('tile_pyramid'))
+
+
+def bench_price_aggregation(context):
+    from price_aggregation import aggregate_prices,encode_price_data
+    dataset = context.dataset
+    data = encode_price_data(dataset.prices,dataset.stores)
+    aggregate_prices(data,known_items=np.frombuffer(dataset.items['itemcode'],dtype=np.int64))
+
+
+def bench_price_matrix(context):
+    from price_matrix import matrix_from_price_data
+    matrix_from_price_data(context.price_data,context.output('price_matrix'))
+
+
+def bench_store_files(context):
+    from store_files_export import export_store_files
+    output_dir = context.output('store_files')
+    export_store_files(context.store_rows,output_dir,os.path.join(output_dir,'summary.json'))
+
+
+def bench_store_files_compact(context):
+    from store_files_export import DEFAULT_PAGE_SIZE,export_store_files
+    output_dir = context.output('store_files_compact')
+    export_store_files(context.store_rows,os.path.join(output_dir,'stores'),os.path.join(output_dir,'summary.json'),
+                       compact=True,catalog=True,search_index=True,page_size=DEFAULT_PAGE_SIZE)
+
+
+def bench_pg_to_geojson_stream(context):
+    from pg_to_geojson import postgres_to_geojson_stream
+    postgres_to_geojson_stream(os.path.join(context.output('pg_to_geojson_stream'),'stores.geojson'))
+
+
+def bench_pg_to_geojson_copy(context):
+    from pg_to_geojson import postgres_to_geojson_copy
+    postgres_to_geojson_copy(os.path.join(context.output('pg_to_geojson_copy'),'stores.geojson'))
+
+
+def bench_pg_to_geojson_parallel(context):
+    from pg_to_geojson import postgres_to_geojson_parallel
+    postgres_to_geojson_parallel(os.path.join(context.output('pg_to_geojson_parallel'),'stores.geojson'),
+                                 BENCHMARK_CONNECTIONS)
+
+
+def bench_pg_price_data(context):
+    import storage
+    from price_aggregation import load_price_data
+
+    pg_conn = storage.connect()
+    try:
+        with pg_conn.cursor() as pg_cursor:
+            load_price_data(pg_cursor,DEFAULT_UPLOAD_DATE)
+    finally:
+        pg_conn.close()
+
+
+def bench_pg_store_files(context):
+    from store_files_export import postgres_to_store_files
+    postgres_to_store_files(DEFAULT_UPLOAD_DATE,context.output('pg_store_files'))
+
+
+def bench_pg_store_files_pooled(context):
+    from store_files_export import postgres_to_store_files
+    postgres_to_store_files(DEFAULT_UPLOAD_DATE,context.output('pg_store_files_pooled'),
+                            connections=BENCHMARK_CONNECTIONS)
+
+
+# (name, function, context inputs built before timing, needs the stand-in database), in run order
+BENCHMARKS = [
+    ('csv_to_geojson',bench_csv_to_geojson,('csv_file',),False),
+    ('csv_to_geojson_chunks',bench_csv_to_geojson_chunks,('csv_file',),False),
+    ('cheaper_neighbours',bench_cheaper_neighbours,('features',),False),
+    ('nearby_comparisons',bench_nearby_comparisons,('features','price_data'),False),
+    ('tile_pyramid',bench_tile_pyramid,('features',),False),
+    ('price_aggregation',bench_price_aggregation,(),False),
+    ('price_matrix',bench_price_matrix,('price_data',),False),
+    ('store_files',bench_store_files,('store_rows',),False),
+    ('store_files_compact',bench_store_files_compact,('store_rows',),False),
+    ('pg_to_geojson_stream',bench_pg_to_geojson_stream,(),True),
+    ('pg_to_geojson_copy',bench_pg_to_geojson_copy,(),True),
+    ('pg_to_geojson_parallel',bench_pg_to_geojson_parallel,(),True),
+    ('pg_price_data',bench_pg_price_data,(),True),
+    ('pg_store_files',bench_pg_store_files,(),True),
+    ('pg_store_files_pooled',bench_pg_store_files_pooled,(),True)
+]
+
+
+def run_benchmark(function,context,repeat=3,verbose=False):
+    """
+    Time a benchmark and measure its peak memory.
+
+    The benchmark runs repeat times untraced and the best time is kept, then once more under
+    tracemalloc for the peak of memory allocated while it ran. Only allocations of this process
+    are traced; memory of worker processes is not included.
+
+    Parameters:
+    function: Benchmark function taking the context
+    context (BenchmarkContext): Shared inputs
+    repeat (int): Number of timed runs
+    verbose (bool): Show the output of the benchmarked code
+    """
+    output = sys.stdout if verbose else io.StringIO()
+    times = []
+    with redirect_stdout(output):
+        for run in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            function(context)
+            times.append(time.perf_counter() - start)
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function(context)
+            current,peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'seconds': min(times),
+        'median_seconds': float(np.median(times)),
+        'peak_mb': peak / (1024 * 1024)
+    }
+
+
+def run_benchmarks(dataset,benchmarks,repeat=3,verbose=False):
+    """Run the given BENCHMARKS entries and return a report"""
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    results = {}
+    try:
+        context = BenchmarkContext(dataset,work_dir)
+        for name,function,inputs,needs_database in benchmarks:
+            print(f"Running {name}...",end=' ',flush=True)
+            for attribute in inputs:
+                getattr(context,attribute)
+            result = run_benchmark(function,context,repeat,verbose)
+            results[name] = result
+            print(f"{result['seconds']:.3f}s, peak {result['peak_mb']:.1f} MB")
+    finally:
+        shutil.rmtree(work_dir,ignore_errors=True)
+
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'scale': dataset.scale,
+        'seed': dataset.seed,
+        'rows': {
+            'stores': dataset.store_count,
+            'items': len(dataset.items),
+            'prices': len(dataset.prices)
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'repeat': repeat,
+        'benchmarks': results
+    }
+
+
+def compare_reports(baseline,current,time_tolerance=TIME_TOLERANCE,memory_tolerance=MEMORY_TOLERANCE):
+    """
+    Compare a report with the baseline and return a list of regression messages: benchmarks
+    that got slower by more than time_tolerance (and MIN_REGRESSION_S) or whose peak memory
+    grew by more than memory_tolerance (and MIN_REGRESSION_MB).
+    """
+    regressions = []
+    for name,result in current['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            continue
+        slower = result['seconds'] - before['seconds']
+        if slower > MIN_REGRESSION_S and result['seconds'] > before['seconds'] * (1 + time_tolerance):
+            regressions.append(f"{name}: {before['seconds']:.3f}s -> {result['seconds']:.3f}s")
+        larger = result['peak_mb'] - before['peak_mb']
+        if larger > MIN_REGRESSION_MB and result['peak_mb'] > before['peak_mb'] * (1 + memory_tolerance):
+            regressions.append(f"{name}: peak {before['peak_mb']:.1f} MB -> {result['peak_mb']:.1f} MB")
+    return regressions
+
+
+def baseline_path(report_dir,scale_name):
+    return os.path.join(report_dir,f"benchmark_baseline_{scale_name}.json")
+
+
+def load_baseline(report_dir,scale_name):
+    """Return the stored baseline for a scale, or None"""
+    path = baseline_path(report_dir,scale_name)
+    if not os.path.exists(path):
+        return None
+    with open(path,'r',encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_report(report,path):
+    os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+    with atomic_open(path,'w') as f:
+        json.dump(report,f,ensure_ascii=False,indent=2)
+    print(f"Report saved to {path}")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the conversion and export paths on synthetic data")
+    parser.add_argument("--scale",default="1x",choices=list(SCALES),help="Data size relative to the current data")
+    parser.add_argument("--seed",type=int,default=DEFAULT_SEED,help="Random seed of the synthetic data")
+    parser.add_argument("--repeat",type=int,default=3,help="Timed runs per benchmark (the best is kept)")
+    parser.add_argument("--only",action='append',default=None,help="Only run this benchmark (repeatable)")
+    parser.add_argument("--database",action="store_true",
+                        help="Also run the PostgreSQL benchmarks against the stand-in database in config.benchmark_pg_config")
+    parser.add_argument("--load-database",action="store_true",help="Load the synthetic data into the stand-in database first")
+    parser.add_argument("--report-dir",default="diagnostics",help="Directory for the JSON reports and baselines")
+    parser.add_argument("--save-baseline",action="store_true",help="Store this run as the baseline for its scale")
+    parser.add_argument("--tolerance",type=float,default=TIME_TOLERANCE,help="Allowed slowdown before flagging a regression")
+    parser.add_argument("--verbose",action="store_true",help="Show the output of the benchmarked code")
+    args = parser.parse_args()
+
+    benchmarks = [benchmark for benchmark in BENCHMARKS if args.database or not benchmark[3]]
+    if args.only:
+        unknown = set(args.only) - {benchmark[0] for benchmark in BENCHMARKS}
+        if unknown:
+            print(f"ERROR: Unknown benchmark(s): {', '.join(sorted(unknown))}")
+            sys.exit(1)
+        benchmarks = [benchmark for benchmark in benchmarks if benchmark[0] in args.only]
+
+    print(f"Generating {args.scale} synthetic data (seed {args.seed})...")
+    dataset = SyntheticDataset(SCALES[args.scale],args.seed)
+    print(f"{dataset.store_count:,} stores, {len(dataset.items):,} items, {len(dataset.prices):,} prices")
+
+    if args.database or args.load_database:
+        import config
+
+        if not hasattr(config,'benchmark_pg_config'):
+            print("ERROR: config.py does not contain a 'benchmark_pg_config' dictionary for the stand-in database")
+            sys.exit(1)
+        # Every database path reads config.pg_config, so point it at the stand-in database
+        config.pg_config = config.benchmark_pg_config
+        if args.load_database:
+            import psycopg2
+
+            pg_conn = psycopg2.connect(**config.pg_config)
+            try:
+                load_into_postgres(pg_conn,dataset)
+            finally:
+                pg_conn.close()
+
+    report = run_benchmarks(dataset,benchmarks,args.repeat,args.verbose)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    save_report(report,os.path.join(args.report_dir,f"benchmark_{args.scale}_{stamp}.json"))
+
+    baseline = load_baseline(args.report_dir,args.scale)
+    if args.save_baseline:
+        if baseline is not None:
+            # Keep the baseline of benchmarks that were not run this time
+            report['benchmarks'] = dict(baseline['benchmarks'],**report['benchmarks'])
+        save_report(report,baseline_path(args.report_dir,args.scale))
+        sys.exit(0)
+
+    if baseline is None:
+        print(f"No baseline for {args.scale} yet; run with --save-baseline to store one")
+        sys.exit(0)
+    if baseline['seed'] != report['seed']:
+        print(f"The {args.scale} baseline uses seed {baseline['seed']}, not {report['seed']}; not comparing")
+        sys.exit(0)
+
+    regressions = compare_reports(baseline,report,args.tolerance)
+    if not regressions:
+        print(f"No regressions compared with the baseline from {baseline['created_at']}")
+        sys.exit(0)
+
+    print(f"\n⚠️  {len(regressions)} regression(s) compared with the baseline from {baseline['created_at']}:")
+    for regression in regressions:
+        print(f"  {regression}")
+    sys.exit(1)
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+
+from geojson_stream import atomic_open
+
+MANIFEST_VERSION = 1
+
+
+def hash_bytes(data):
+    """Return the SHA-256 hex digest of data"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path,chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_rows(rows,salt=None):
+    """
+    Return a SHA-256 hex digest of a sequence of row tuples.
+
+    Parameters:
+    rows (iterable): Rows of str/int/float/None values
+    salt: Optional extra value (e.g. export options) that changes the hash when it changes
+    """
+    digest = hashlib.sha256()
+    if salt is not None:
+        digest.update(repr(salt).encode('utf-8'))
+    for row in rows:
+        digest.update(repr(tuple(row)).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """
+    Content-hash manifest for incremental builds.
+
+    Each entry is keyed by a build unit (e.g. "store:ram_003") and records the hash of its
+    source rows, the hash of every output file it produced (paths relative to the manifest
+    directory), and optional metadata. Files written or removed during the run are collected
+    so a list of changed files can be handed to deployment.
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+        self.entries = {}
+        self.changed = set()
+        self.removed = set()
+        if os.path.exists(path):
+            with open(path,'r',encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data.get('entries',{})
+            else:
+                print(f"Ignoring manifest {path} with unsupported version {data.get('version')}")
+
+    def relative(self,path):
+        """Return path relative to the manifest directory, with forward slashes"""
+        return os.path.relpath(os.path.abspath(path),self.base_dir).replace(os.sep,'/')
+
+    def absolute(self,relative_path):
+        return os.path.join(self.base_dir,*relative_path.split('/'))
+
+    def get(self,key):
+        return self.entries.get(key)
+
+    def source_hash(self,key):
+        entry = self.entries.get(key)
+        return entry['source'] if entry else None
+
+    def is_current(self,key,source_hash):
+        """
+        Check whether key was built from the same source and all of its outputs still exist.
+        """
+        entry = self.entries.get(key)
+        if not entry or entry['source'] != source_hash:
+            return False
+        return all(os.path.exists(self.absolute(path)) for path in entry['files'])
+
+    def record(self,key,source_hash,files,meta=None):
+        """
+        Record a build unit. Files whose output hash differs from the previous build are
+        added to the changed list.
+
+        Parameters:
+        key (str): Build unit key
+        source_hash (str): Hash of the source rows
+        files (dict): Output path (absolute or relative to the working directory) -> output hash
+        meta: Optional JSON-serializable metadata kept with the entry
+        """
+        previous = self.entries.get(key,{}).get('files',{})
+        relative_files = {self.relative(path): digest for path,digest in files.items()}
+        for path,digest in relative_files.items():
+            if previous.get(path) != digest:
+                self.changed.add(path)
+        for path in previous:
+            if path not in relative_files:
+                self.removed.add(path)
+        entry = {'source': source_hash,'files': relative_files}
+        if meta is not None:
+            entry['meta'] = meta
+        self.entries[key] = entry
+
+    def remove(self,key,delete_files=True):
+        """Drop a build unit, optionally deleting its output files"""
+        entry = self.entries.pop(key,None)
+        if not entry:
+            return
+        for path in entry['files']:
+            self.removed.add(path)
+            if delete_files:
+                try:
+                    os.remove(self.absolute(path))
+                except FileNotFoundError:
+                    pass
+
+    def keys(self,prefix=''):
+        return [key for key in self.entries if key.startswith(prefix)]
+
+    def save(self):
+        with atomic_open(self.path,'w') as f:
+            json.dump({'version': MANIFEST_VERSION,'entries': self.entries},f,ensure_ascii=False,indent=1)
+
+    def write_changed_list(self,path):
+        """
+        Write the files changed and removed in this run as JSON, for deployment.
+        """
+        with atomic_open(path,'w') as f:
+            json.dump({
+                'changed': sorted(self.changed),
+                'removed': sorted(self.removed - self.changed)
+            },f,ensure_ascii=False,indent=2)
+        print(f"{len(self.changed)} changed and {len(self.removed - self.changed)} removed files listed in {path}")
@@ -1,7 +1,25 @@
 import csv
-import json
+import io
 import os
 import math
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+
+from build_manifest import BuildManifest,hash_bytes,hash_file
+from geojson_stream import stream_feature_collection
+from row_sanitizer import TEXT_CONVERTERS,RowSanitizer,infer_text_schema,strict_dumps,text_sanitizer
+from run_metrics import RunMetrics,metrics_from_argv
+from spatial_index import add_cheaper_neighbours
+from tile_pyramid import build_tile_pyramid
+
+# Number of rows read ahead to infer the column types
+SCHEMA_SAMPLE_SIZE = 1000
+
+# Approximate bytes of CSV converted by one worker task in the chunked (multi-process) mode
+CHUNK_SIZE = 8 * 1024 * 1024
 
 
 def is_valid_number(value):
@@ -11,138 +29,208 @@ def is_valid_number(value):
     return True
 
 
-def csv_to_geojson(csv_file,output_file):
+def record_boundaries(csv_file,chunk_size=CHUNK_SIZE,block_size=1 << 20):
+    """
+    Split the data rows of a CSV file into byte ranges of about chunk_size bytes that
+    start and end on row boundaries. A newline only ends a row when it is outside a quoted
+    field, i.e. when an even number of quote characters precede it (an escaped quote is
+    written as two quotes, so it does not change the parity).
+
+    Returns a list of offsets: the end of the header row, the chunk boundaries and the file size.
+
+    Parameters:
+    csv_file (str): Path to the CSV file
+    chunk_size (int): Approximate bytes per chunk
+    """
+    boundaries = []
+    target = 0  # the first boundary is the end of the header row
+    quotes = 0
+    offset = 0
+    with open(csv_file,'rb') as f:
+        for block in iter(lambda: f.read(block_size),b''):
+            start = 0
+            while True:
+                search_from = max(start,target - offset)
+                if search_from >= len(block):
+                    break
+                newline = block.find(b'\n',search_from)
+                if newline < 0:
+                    break
+                quotes += block.count(b'"',start,newline)
+                start = newline + 1
+                if quotes % 2 == 0:
+                    boundaries.append(offset + start)
+                    target = offset + start + chunk_size
+            quotes += block.count(b'"',start)
+            offset += len(block)
+    if not boundaries or boundaries[-1] < offset:
+        boundaries.append(offset)
+    return boundaries
+
+
+def _convert_chunk(task):
+    """
+    Worker for the chunked mode: convert the rows in one byte range of the CSV file and
+    write the serialized features, joined like FeatureCollectionWriter does, to part_file.
+    Returns (features written, stages, counters, skipped examples) of the chunk's RunMetrics,
+    with row numbers counted from the start of the chunk.
+    """
+    csv_file,start,end,columns,schema,part_file = task
+    metrics = RunMetrics('chunk')
+    sanitizer = RowSanitizer(columns,schema,TEXT_CONVERTERS)
+    width = len(columns)
+    with metrics.stage('read'):
+        with open(csv_file,'rb') as f:
+            f.seek(start)
+            text = f.read(end - start).decode('utf-8')
+
+    def rows():
+        for row in csv.reader(io.StringIO(text,newline='')):
+            if len(row) < width:
+                row = row + [''] * (width - len(row))
+            yield row
+
+    count = 0
+    with open(part_file,'w',encoding='utf-8') as out:
+        write = metrics.timed('write',out.write)
+        for feature in metrics.convert(metrics.timed_iter('read',rows()),sanitizer):
+            write((',\n' if count else '') + strict_dumps(feature))
+            count += 1
+    return count,metrics.stages,metrics.counters,metrics.skipped_examples
+
+
+def convert_in_chunks(csv_file,writer,workers,chunk_size=CHUNK_SIZE,metrics=None):
+    """
+    Convert a CSV file with a pool of worker processes. The file is split into byte ranges
+    aligned to row boundaries (see record_boundaries), each worker streams the features of
+    its range to a part file, and the part files are appended to the writer in file order,
+    so the output is identical to the serial conversion.
+
+    The schema is inferred from the same first rows as in the serial mode and shared by
+    every worker.
+
+    Parameters:
+    csv_file (str): Path to the CSV file
+    writer (FeatureCollectionWriter): Output writer
+    workers (int): Number of worker processes
+    chunk_size (int): Approximate bytes of CSV per worker task
+    metrics (RunMetrics): Receives the stages and counters of all workers
+    """
+    metrics = metrics or RunMetrics('convert_in_chunks')
+    with metrics.stage('read'):
+        with open(csv_file,'r',encoding='utf-8-sig',newline='') as f:
+            reader = csv.reader(f)
+            columns = next(reader)
+            sample = []
+            for row in reader:
+                sample.append(row)
+                if len(sample) >= SCHEMA_SAMPLE_SIZE:
+                    break
+    schema = infer_text_schema(columns,sample)
+
+    with metrics.stage('partition'):
+        boundaries = record_boundaries(csv_file,chunk_size)
+    ranges = [(start,end) for start,end in zip(boundaries,boundaries[1:]) if end > start]
+
+    part_dir = tempfile.mkdtemp(prefix='.csv_to_geojson.',dir=os.path.dirname(os.path.abspath(csv_file)))
+    try:
+        tasks = [
+            (csv_file,start,end,columns,schema,os.path.join(part_dir,f"{index:06d}.part"))
+            for index,(start,end) in enumerate(ranges)
+        ]
+        row_num = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map yields results in task order, so parts are appended in file order
+            for task,(count,stages,counters,skipped) in zip(tasks,executor.map(_convert_chunk,tasks)):
+                metrics.merge(stages,counters,skipped,row_offset=row_num)
+                with metrics.stage('write'):
+                    writer.write_serialized(task[-1],count)
+                os.unlink(task[-1])
+                row_num += counters['rows']
+    finally:
+        shutil.rmtree(part_dir,ignore_errors=True)
+
+
+def csv_to_geojson(csv_file,output_file,manifest=None,neighbours=False,workers=1,chunk_size=CHUNK_SIZE,metrics=None):
     """
     Convert a CSV file with latitude and longitude columns to GeoJSON format.
     Properly handles NULL, NaN, and invalid values.
 
+    Column types are inferred once from the first rows of the file, and every row is
+    then converted in a single pass with one converter per column. Features are written
+    to the output file as they are converted.
+
     Parameters:
     csv_file (str): Path to the CSV file
     output_file (str): Path to write the GeoJSON output
+    manifest (BuildManifest): Optional build manifest. If the CSV file is unchanged since the
+                              recorded build and the output still exists, nothing is written.
+    neighbours (bool): Add each store's nearest cheaper stores (see spatial_index.py). All
+                       features are held in memory to build the spatial index.
+    workers (int): Convert the file in byte-range chunks with this many processes (see
+                   convert_in_chunks). Ignored when neighbours is set.
+    chunk_size (int): Approximate bytes of CSV per chunk in the multi-process mode
+    metrics (RunMetrics): Optional metrics of the run (stage timings, skipped and cleaned values)
     """
+    metrics = metrics or RunMetrics('csv_to_geojson')
+
+    if manifest is not None:
+        source_hash = hash_file(csv_file)
+        if neighbours:
+            source_hash = hash_bytes(f"{source_hash}:neighbours".encode('utf-8'))
+        if manifest.is_current("stores_geojson",source_hash):
+            print(f"{csv_file} unchanged since the previous build, keeping {output_file}")
+            return
+
+    if workers > 1 and not neighbours:
+        with stream_feature_collection(output_file) as writer:
+            convert_in_chunks(csv_file,writer,workers,chunk_size,metrics)
+    else:
+        writer = _convert_serial(csv_file,output_file,neighbours,metrics)
+    metrics.add_output(output_file)
 
-    # Create a GeoJSON structure
-    geojson = {
-        "type": "FeatureCollection",
-        "features": []
-    }
+    metrics.print_skipped()
+    print(f"Converted {writer.count} features to GeoJSON")
+    print(f"Output saved to {output_file}")
 
+    if manifest is not None:
+        manifest.record("stores_geojson",source_hash,{output_file: hash_file(output_file)})
+
+
+def _convert_serial(csv_file,output_file,neighbours,metrics):
+    """Convert a CSV file in a single pass in this process and return the finished writer"""
     # Read the CSV file
-    with open(csv_file,'r',encoding='utf-8-sig') as f:  # Note the utf-8-sig encoding
-        reader = csv.DictReader(f)
-        row_num = 0
+    with open(csv_file,'r',encoding='utf-8-sig',newline='') as f:  # Note the utf-8-sig encoding
+        reader = csv.reader(f)
+        with metrics.stage('read'):
+            columns = next(reader)
+            width = len(columns)
 
-        for row in reader:
-            row_num += 1
-            # Skip if latitude or longitude are missing or invalid
-            if not row['latitude'] or not row['longitude']:
-                print(f"Skipping row {row_num} with missing coordinates: {row}")
-                continue
-
-            try:
-                # Convert latitude and longitude to float, ensuring they're valid numbers
-                lat = float(row['latitude'])
-                lng = float(row['longitude'])
-
-                # Check if coordinates are valid numbers (not NaN or Infinity)
-                if math.isnan(lat) or math.isnan(lng) or math.isinf(lat) or math.isinf(lng):
-                    print(f"Skipping row {row_num} with invalid coordinates: lat={lat}, lng={lng}")
-                    continue
-
-                # Create a GeoJSON feature
-                feature = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [lng,lat]
-                    },
-                    "properties": {}
-                }
-
-                # Add all properties from the CSV, properly handling NULL, NaN and invalid values
-                for key,value in row.items():
-                    if key != 'latitude' and key != 'longitude':
-                        # Handle empty values, "NULL", "NaN" and similar
-                        if not value or str(value).upper() == "NULL" or str(value).upper() == "NAN":
-                            feature["properties"][key] = None
-                        else:
-                            # Try to convert numeric values
-                            try:
-                                if isinstance(value,str) and '.' in value:
-                                    num_value = float(value)
-                                    # Check if it's a valid number
-                                    if math.isnan(num_value) or math.isinf(num_value):
-                                        print(f"Invalid numeric value in row {row_num}, key {key}: {value}")
-                                        feature["properties"][key] = None
-                                    else:
-                                        feature["properties"][key] = num_value
-                                elif isinstance(value,str) and value.lstrip('-').isdigit():
-                                    feature["properties"][key] = int(value)
-                                else:
-                                    feature["properties"][key] = value
-                            except (ValueError,TypeError) as e:
-                                print(f"Error converting value in row {row_num}, key {key}: {value}, Error: {e}")
-                                feature["properties"][key] = value
-
-                # Validate the feature to ensure all values are valid for JSON
-                for key,value in feature["properties"].items():
-                    if isinstance(value,(int,float)) and (math.isnan(value) or math.isinf(value)):
-                        print(f"Invalid numeric value in properties, row {row_num}, key {key}: {value}")
-                        feature["properties"][key] = None
-
-                # Add the feature to the collection
-                geojson["features"].append(feature)
-
-            except (ValueError,KeyError) as e:
-                print(f"Skipping row {row_num} due to error: {e}")
-                print(f"Problematic row: {row}")
-
-    # Validate the entire GeoJSON before writing
-    try:
-        # This will fail if there are any NaN or invalid values
-        test_json = json.dumps(geojson)
-        print(f"GeoJSON validation successful")
-    except (TypeError,ValueError) as e:
-        print(f"ERROR: Invalid GeoJSON: {e}")
-        # Try to find the problematic feature
-        for i,feature in enumerate(geojson["features"]):
-            try:
-                json.dumps(feature)
-            except (TypeError,ValueError) as e:
-                print(f"Problem in feature {i}: {e}")
-                print(f"Feature: {feature}")
-
-                # Try to find the problematic property
-                if "properties" in feature:
-                    for prop_key,prop_value in feature["properties"].items():
-                        try:
-                            json.dumps({prop_key: prop_value})
-                        except (TypeError,ValueError) as e:
-                            print(f"Problem in property {prop_key}: {prop_value}")
-                            # Fix the value
-                            feature["properties"][prop_key] = None
-
-    # Write the GeoJSON file
-    try:
-        with open(output_file,'w',encoding='utf-8') as f:
-            json.dump(geojson,f,ensure_ascii=False,indent=2)
-        print(f"Converted {len(geojson['features'])} features to GeoJSON")
-        print(f"Output saved to {output_file}")
-    except (TypeError,ValueError) as e:
-        print(f"ERROR: Failed to write GeoJSON: {e}")
-        # Write a safe version with filtered features
-        valid_features = []
-        for feature in geojson["features"]:
-            try:
-                json.dumps(feature)
-                valid_features.append(feature)
-            except:
-                print(f"Skipping invalid feature")
-
-        geojson["features"] = valid_features
-        with open(output_file,'w',encoding='utf-8') as f:
-            json.dump(geojson,f,ensure_ascii=False,indent=2)
-        print(f"Saved {len(valid_features)} valid features to {output_file}")
+            # Infer the schema from a sample of rows, then process the sample and the rest of the file
+            sample = []
+            for row in reader:
+                sample.append(row)
+                if len(sample) >= SCHEMA_SAMPLE_SIZE:
+                    break
+        sanitizer = text_sanitizer(columns,sample)
+
+        def rows():
+            for row in chain(sample,reader):
+                if len(row) < width:
+                    row = row + [''] * (width - len(row))
+                yield row
+
+        converted = metrics.convert(metrics.timed_iter('read',rows()),sanitizer)
+        if neighbours:
+            converted = list(converted)
+            with metrics.stage('neighbours'):
+                add_cheaper_neighbours(converted)
+
+        with stream_feature_collection(output_file) as writer:
+            write_feature = metrics.timed('write',writer.write_feature)
+            for feature in converted:
+                write_feature(feature)
+    return writer
 
 
 if __name__ == "__main__":
@@ -155,6 +243,19 @@ if __name__ == "__main__":
     # Path to write the GeoJSON output
     output_file = "data/stores.geojson"
 
-    csv_to_geojson(csv_file,output_file)
+    manifest = BuildManifest("data/build_manifest.json") if "--incremental" in sys.argv else None
+    # --workers N converts large files in chunks with N processes
+    workers = int(sys.argv[sys.argv.index("--workers") + 1]) if "--workers" in sys.argv else 1
+    # --metrics FILE sets the metrics file, --profile adds a cProfile dump
+    metrics,metrics_file = metrics_from_argv("csv_to_geojson",sys.argv)
+    csv_to_geojson(csv_file,output_file,manifest,neighbours="--neighbours" in sys.argv,workers=workers,metrics=metrics)
+
+    # Also write the zoom-level tile pyramid loaded by the map
+    if "--tiles" in sys.argv:
+        build_tile_pyramid(output_file,"data/tiles",manifest)
+
+    if manifest is not None:
+        manifest.save()
+        manifest.write_changed_list("data/changed_files.json")
 
-## Test
\ No newline at end of file
+    metrics.save(metrics_file)
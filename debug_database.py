@@ -1,19 +1,26 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import config
+import sys
 
+import storage
+from run_metrics import RunMetrics,metrics_from_argv
 
-def debug_database():
+
+def debug_database(metrics=None):
     """
     Debug the database to understand why store_price_comparisons view returns no results
+
+    Parameters:
+    metrics (RunMetrics): Optional metrics of the run; query and fetch times are recorded in it
     """
+    metrics = metrics or RunMetrics('debug_database')
 
     try:
-        # Connect to PostgreSQL using config
-        print("Connecting to PostgreSQL database...")
-        pg_conn = psycopg2.connect(**config.pg_config)
+        # Connect to PostgreSQL using config (or the local database, see storage.py)
+        print(f"Connecting to the {storage.describe_backend()}...")
+        with metrics.stage('connect'):
+            pg_conn = storage.connect()
 
-        with pg_conn.cursor(cursor_factory=RealDictCursor) as pg_cursor:
+        # Every query and fetch is timed in the metrics of the run
+        with pg_conn.cursor(cursor_factory=metrics.cursor_factory(storage.cursor_class(pg_conn,dict_rows=True))) as pg_cursor:
 
             print("\n" + "=" * 60)
             print("1. Checking available upload dates in allprices table")
@@ -206,4 +213,7 @@ def debug_database():
 
 
 if __name__ == "__main__":
-    debug_database()
\ No newline at end of file
+    # --metrics FILE sets the metrics file, --profile adds a cProfile dump
+    metrics,metrics_file = metrics_from_argv("debug_database",sys.argv)
+    debug_database(metrics)
+    metrics.save(metrics_file)
\ No newline at end of file
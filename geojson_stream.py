@@ -0,0 +1,102 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+from row_sanitizer import strict_dumps
+
+
+@contextmanager
+def atomic_open(output_file,mode='w',encoding='utf-8'):
+    """
+    Open a temporary file next to output_file and move it into place only after
+    writing finished successfully, so readers never see a half-written file.
+
+    Parameters:
+    output_file (str): Final path of the file
+    mode (str): 'w' for text or 'wb' for binary output
+    encoding (str): Text encoding (ignored in binary mode)
+    """
+    directory = os.path.dirname(os.path.abspath(output_file))
+    fd,tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(output_file) + '.',suffix='.tmp',dir=directory)
+    try:
+        if 'b' in mode:
+            f = os.fdopen(fd,mode)
+        else:
+            f = os.fdopen(fd,mode,encoding=encoding)
+        with f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file as 0600; the static host needs to read it
+        os.chmod(tmp_path,0o644)
+        os.replace(tmp_path,output_file)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class FeatureCollectionWriter:
+    """
+    Write a GeoJSON FeatureCollection to an open text file one feature at a time,
+    so the full list of features never has to be held in memory.
+    """
+
+    def __init__(self,f):
+        self.f = f
+        self.count = 0
+        self.bytes_written = 0
+        self._write('{"type": "FeatureCollection", "features": [\n')
+
+    def _write(self,text):
+        self.f.write(text)
+        self.bytes_written += len(text.encode('utf-8'))
+
+    def write_feature(self,feature):
+        """
+        Serialize and write a single feature.
+        Raises ValueError if the feature contains NaN or Infinity.
+        """
+        text = strict_dumps(feature)
+        if self.count:
+            self._write(',\n')
+        self._write(text)
+        self.count += 1
+
+    def write_serialized(self,fragment_file,count,block_size=1 << 20):
+        """
+        Append features that were already serialized with strict_dumps and joined with ',\n'
+        (e.g. part files written by worker processes), copying the file in blocks.
+
+        Parameters:
+        fragment_file (str): Path of the serialized features
+        count (int): Number of features in the file
+        """
+        if not count:
+            return
+        if self.count:
+            self._write(',\n')
+        with open(fragment_file,'r',encoding='utf-8') as fragment:
+            for block in iter(lambda: fragment.read(block_size),''):
+                self._write(block)
+        self.count += count
+
+    def close(self):
+        self._write('\n]}\n')
+
+
+@contextmanager
+def stream_feature_collection(output_file):
+    """
+    Context manager yielding a FeatureCollectionWriter whose output is atomically
+    moved to output_file when the block exits without an error.
+
+    Parameters:
+    output_file (str): Path to write the GeoJSON output
+    """
+    with atomic_open(output_file,'w') as f:
+        writer = FeatureCollectionWriter(f)
+        yield writer
+        writer.close()
@@ -0,0 +1,160 @@
+import argparse
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from spatial_index import StoreIndex,load_store_features,neighbour_summary
+
+# Defaults for the nearby head-to-head comparisons written into the export
+DEFAULT_NEARBY = 3
+DEFAULT_NEARBY_RADIUS_KM = 15.0
+# Pairs sharing fewer items are not compared: the median of a few prices says little
+DEFAULT_MIN_SHARED_ITEMS = 50
+# Nearest stores considered per store, so stores sharing too few items can be passed over
+CANDIDATES_PER_NEIGHBOUR = 3
+
+# Per-store prices as CSR arrays (see price_matrix.build_sparse_arrays): the prices of store i
+# are row_prices[row_indptr[i]:row_indptr[i + 1]], at the item indexes in row_items.
+# store_index maps store_code -> row.
+StorePrices = namedtuple('StorePrices',['store_index','item_count','row_indptr','row_items','row_prices'])
+
+
+def store_prices_from_matrix(matrix):
+    """StorePrices of a price matrix opened with price_matrix.PriceMatrix (memory-mapped, nothing is copied)"""
+    return StorePrices(matrix.store_index,matrix.item_count,matrix.row_indptr,matrix.row_items,matrix.row_prices)
+
+
+def store_prices_from_price_data(data):
+    """StorePrices of one upload date of prices encoded by price_aggregation.encode_price_data"""
+    from price_matrix import build_sparse_arrays
+
+    arrays = build_sparse_arrays(data.store_ids,data.item_ids,data.prices,data.store_count,data.item_count)
+    store_index = {code: index for index,code in enumerate(data.stores['store_code'])}
+    return StorePrices(store_index,data.item_count,arrays['row_indptr'],arrays['row_items'],arrays['row_prices'])
+
+
+def _row(store_prices,store_id):
+    """Item indexes and prices of a store, without missing, zero or negative prices"""
+    start,end = store_prices.row_indptr[store_id],store_prices.row_indptr[store_id + 1]
+    items = np.asarray(store_prices.row_items[start:end])
+    prices = np.asarray(store_prices.row_prices[start:end])
+    valid = prices > 0
+    return items[valid],prices[valid]
+
+
+def compare_prices(store_vector,items,prices):
+    """
+    Compare a neighbour's prices with a store's over the items both carry.
+
+    Returns (median_ratio, shared_items, cheaper_share): the median of neighbour price / store
+    price, the number of shared items and the share of them that the neighbour sells for less.
+
+    Parameters:
+    store_vector (ndarray): The store's prices as a dense vector over all items (NaN if not sold)
+    items, prices (ndarray): Item indexes and prices of the neighbour
+    """
+    store_item_prices = store_vector[items]
+    shared = ~np.isnan(store_item_prices)
+    shared_items = int(np.count_nonzero(shared))
+    if not shared_items:
+        return None,0,None
+    ratios = prices[shared] / store_item_prices[shared]
+    return float(np.median(ratios)),shared_items,float(np.count_nonzero(ratios < 1)) / shared_items
+
+
+def head_to_head_summary(distance_km,feature,median_ratio,shared_items,cheaper_share):
+    """Compact description of a head-to-head comparison with a neighbouring store for the store-details panel"""
+    summary = neighbour_summary(distance_km,feature)
+    summary["median_ratio"] = round(median_ratio,4)
+    summary["shared_items"] = shared_items
+    summary["cheaper_share"] = round(cheaper_share,3)
+    return summary
+
+
+def add_nearby_comparisons(features,store_prices,k=DEFAULT_NEARBY,max_radius_km=DEFAULT_NEARBY_RADIUS_KM,
+                           min_shared_items=DEFAULT_MIN_SHARED_ITEMS):
+    """
+    Add a nearby_comparison property to every store feature comparing it head-to-head with
+    its k nearest stores (of any chain, within max_radius_km) over the items both sell: the
+    median price ratio, the number of shared items and the share of them that are cheaper at
+    the neighbour. Features are updated in place.
+
+    Each store's prices are scattered once into a dense vector over all items, so comparing
+    it with a neighbour is a single gather over the neighbour's row of the sparse arrays.
+
+    Parameters:
+    features (list): Store features (see spatial_index.load_store_features)
+    store_prices (StorePrices): Prices of the stores, e.g. from store_prices_from_matrix
+    k (int): Neighbours compared per store
+    max_radius_km (float): Maximum distance of a neighbour
+    min_shared_items (int): Minimum number of shared items for a neighbour to be compared
+    """
+    index = StoreIndex(features)
+    store_vector = np.full(store_prices.item_count,np.nan,dtype=np.float64)
+    rows = {}
+
+    def row(store_code):
+        if store_code not in rows:
+            store_id = store_prices.store_index.get(store_code)
+            rows[store_code] = None if store_id is None else _row(store_prices,store_id)
+        return rows[store_code]
+
+    with_comparisons = 0
+    for feature in index.features:
+        props = feature['properties']
+        props['nearby_comparison'] = []
+        store_row = row(props.get('store_code'))
+        if store_row is None or not len(store_row[0]):
+            continue
+        items,prices = store_row
+        store_vector[items] = prices
+
+        lon,lat = feature['geometry']['coordinates'][:2]
+        candidates = index.nearest(lat,lon,k * CANDIDATES_PER_NEIGHBOUR,max_radius_km,exclude=props.get('store_code'))
+        for distance,neighbour in candidates:
+            neighbour_row = row(neighbour['properties'].get('store_code'))
+            if neighbour_row is None:
+                continue
+            median_ratio,shared_items,cheaper_share = compare_prices(store_vector,*neighbour_row)
+            if shared_items < min_shared_items:
+                continue
+            props['nearby_comparison'].append(
+                head_to_head_summary(distance,neighbour,median_ratio,shared_items,cheaper_share)
+            )
+            if len(props['nearby_comparison']) == k:
+                break
+
+        store_vector[items] = np.nan
+        if props['nearby_comparison']:
+            with_comparisons += 1
+    print(f"{with_comparisons} of {len(index)} stores compared with a store within {max_radius_km} km")
+    return features
+
+
+def add_nearby_comparisons_to_file(geojson_file,matrix_dir,**options):
+    """Rewrite a stores GeoJSON file with the nearby_comparison property added to every store"""
+    from geojson_stream import stream_feature_collection
+    from price_matrix import PriceMatrix
+
+    features = load_store_features(geojson_file)
+    add_nearby_comparisons(features,store_prices_from_matrix(PriceMatrix(matrix_dir)),**options)
+    with stream_feature_collection(geojson_file) as writer:
+        for feature in features:
+            writer.write_feature(feature)
+    print(f"Nearby comparisons saved to {geojson_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare every store head-to-head with its nearest stores")
+    parser.add_argument("--input",default="data/stores.geojson",help="Stores GeoJSON file to annotate")
+    parser.add_argument("--matrix",default="data/price_matrix",help="Price matrix directory (see price_matrix.py)")
+    parser.add_argument("-k",type=int,default=DEFAULT_NEARBY,help="Neighbours compared per store")
+    parser.add_argument("--radius",type=float,default=DEFAULT_NEARBY_RADIUS_KM,help="Maximum distance in km")
+    parser.add_argument("--min-shared",type=int,default=DEFAULT_MIN_SHARED_ITEMS,
+                        help="Minimum number of items both stores sell")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    add_nearby_comparisons_to_file(args.input,args.matrix,k=args.k,max_radius_km=args.radius,min_shared_items=args.min_shared)
+    print(f"Done in {time.perf_counter() - start:.2f}s")
@@ -55,19 +55,7 @@ document.addEventListener('DOMContentLoaded', function() {
             console.log("Average price diff:", avgPriceDiff.toFixed(2) + "%");
 
             // Determine icon color based on average price difference
-            let className;
-
-            if (avgPriceDiff <= -8) {
-                className = 'marker-cluster-dark-green'; // Below -8% - dark green
-            } else if (avgPriceDiff <= -3) {
-                className = 'marker-cluster-light-green'; // -8% to -3% - light green
-            } else if (avgPriceDiff <= 3) {
-                className = 'marker-cluster-yellow'; // -3% to 3% - yellow
-            } else if (avgPriceDiff <= 8) {
-                className = 'marker-cluster-orange'; // 3% to 8% - orange
-            } else {
-                className = 'marker-cluster-red'; // Above 8% - red
-            }
+            const className = clusterClassName(avgPriceDiff);
 
             // Debug - log selected class and criteria
             console.log("Average price diff:", avgPriceDiff, "Class selected:", className);
@@ -87,6 +75,20 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Cluster icon class for an average price difference
+    function clusterClassName(avgPriceDiff) {
+        if (avgPriceDiff <= -8) {
+            return 'marker-cluster-dark-green'; // Below -8% - dark green
+        } else if (avgPriceDiff <= -3) {
+            return 'marker-cluster-light-green'; // -8% to -3% - light green
+        } else if (avgPriceDiff <= 3) {
+            return 'marker-cluster-yellow'; // -3% to 3% - yellow
+        } else if (avgPriceDiff <= 8) {
+            return 'marker-cluster-orange'; // 3% to 8% - orange
+        }
+        return 'marker-cluster-red'; // Above 8% - red
+    }
+
     // Chain logo mapping
     const chainLogos = {
         'רמי לוי': 'ramiLevi.png',
@@ -120,6 +122,14 @@ document.addEventListener('DOMContentLoaded', function() {
     let storesData = [];
     let visibleMarkers = [];
 
+    // Tile pyramid written by tile_pyramid.py (null when only stores.geojson is available)
+    let tileIndex = null;
+    const tileSets = {};
+    const tileRequests = {};
+    const loadedStoreCodes = new Set();
+    const clusterLayer = L.layerGroup();
+    let tileUpdate = 0;
+
     // Store filter values
     const filters = {
         chain: 'all',
@@ -135,24 +145,183 @@ document.addEventListener('DOMContentLoaded', function() {
     const resetFiltersBtn = document.getElementById('reset-filters');
     const storeDetails = document.getElementById('store-details');
 
-    // Load GeoJSON data
-    fetch('data/stores.geojson')
-        .then(response => response.json())
-        .then(data => {
-            storesData = data.features;
-            initializeFilters(storesData);
-            addMarkersToMap(storesData);
+    // Load the tile pyramid index, falling back to the full GeoJSON file
+    fetch('data/tiles/index.json')
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(index => {
+            tileIndex = index;
+            Object.entries(index.tiles).forEach(([zoom, tiles]) => {
+                tileSets[zoom] = new Set(tiles);
+            });
+            populateFilterOptions(index.chains, index.cities);
+            map.on('moveend', updateTiles);
+            updateTiles();
         })
         .catch(error => {
-            console.error('Error loading GeoJSON data:', error);
-            alert('שגיאה בטעינת נתוני המפה. אנא נסה שוב מאוחר יותר.');
+            console.log('Tile pyramid not available, loading stores.geojson:', error.message);
+            loadAllStores();
         });
 
+    // Load GeoJSON data
+    function loadAllStores() {
+        fetch('data/stores.geojson')
+            .then(response => response.json())
+            .then(data => {
+                storesData = data.features;
+                initializeFilters(storesData);
+                addMarkersToMap(storesData);
+            })
+            .catch(error => {
+                console.error('Error loading GeoJSON data:', error);
+                alert('שגיאה בטעינת נתוני המפה. אנא נסה שוב מאוחר יותר.');
+            });
+    }
+
+    // Keys ("x/y") of the existing tiles of a zoom level that intersect the viewport
+    function visibleTileKeys(zoom) {
+        const bounds = map.getBounds();
+        const n = Math.pow(2, zoom);
+        const maxLat = 85.0511287798;
+        const tileX = lng => Math.min(n - 1, Math.max(0, Math.floor((lng + 180) / 360 * n)));
+        const tileY = lat => {
+            const rad = Math.max(-maxLat, Math.min(maxLat, lat)) * Math.PI / 180;
+            const y = Math.floor((1 - Math.log(Math.tan(rad) + 1 / Math.cos(rad)) / Math.PI) / 2 * n);
+            return Math.min(n - 1, Math.max(0, y));
+        };
+
+        const available = tileSets[zoom] || new Set();
+        const keys = [];
+        for (let x = tileX(bounds.getWest()); x <= tileX(bounds.getEast()); x++) {
+            for (let y = tileY(bounds.getNorth()); y <= tileY(bounds.getSouth()); y++) {
+                const key = `${x}/${y}`;
+                if (available.has(key)) {
+                    keys.push(key);
+                }
+            }
+        }
+        return keys;
+    }
+
+    // Fetch a tile once and return a promise of its features
+    function loadTile(zoom, key) {
+        const path = `${zoom}/${key}`;
+        if (!tileRequests[path]) {
+            tileRequests[path] = fetch(`data/tiles/${path}.geojson`)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! Status: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(data => data.features)
+                .catch(error => {
+                    console.error(`Error loading tile ${path}:`, error);
+                    delete tileRequests[path];
+                    return [];
+                });
+        }
+        return tileRequests[path];
+    }
+
+    function filtersActive() {
+        return filters.chain !== 'all' || filters.city !== 'all' || filters.priceDiff < 20;
+    }
+
+    // Load the tiles in the viewport. Below the feature zoom level, and while no filter is
+    // set, pre-aggregated clusters are shown; otherwise the stores of the feature tiles are
+    // added to the marker cluster group and filtered as usual.
+    function updateTiles() {
+        const update = ++tileUpdate;
+        const zoom = Math.round(map.getZoom());
+
+        if (zoom < tileIndex.feature_zoom && !filtersActive()) {
+            const tileZoom = Math.max(zoom, tileIndex.min_zoom);
+            Promise.all(visibleTileKeys(tileZoom).map(key => loadTile(tileZoom, key)))
+                .then(tiles => {
+                    if (update !== tileUpdate) {
+                        return;
+                    }
+                    map.removeLayer(markers);
+                    clusterLayer.clearLayers();
+                    tiles.flat().forEach(feature => {
+                        clusterLayer.addLayer(feature.properties.cluster ? createClusterMarker(feature) : createMarker(feature));
+                    });
+                    clusterLayer.addTo(map);
+                });
+            return;
+        }
+
+        const featureZoom = tileIndex.feature_zoom;
+        Promise.all(visibleTileKeys(featureZoom).map(key => loadTile(featureZoom, key)))
+            .then(tiles => {
+                if (update !== tileUpdate) {
+                    return;
+                }
+                tiles.flat().forEach(store => {
+                    if (!loadedStoreCodes.has(store.properties.store_code)) {
+                        loadedStoreCodes.add(store.properties.store_code);
+                        storesData.push(store);
+                    }
+                });
+                map.removeLayer(clusterLayer);
+                addMarkersToMap(storesData, false);
+            });
+    }
+
+    // Create a marker for a pre-aggregated cluster; clicking it zooms in
+    function createClusterMarker(cluster) {
+        const props = cluster.properties;
+        const latlng = [cluster.geometry.coordinates[1], cluster.geometry.coordinates[0]];
+        const priceDiff = props.average_price_diff !== null ? props.average_price_diff : 0;
+
+        const marker = L.marker(latlng, {
+            icon: new L.DivIcon({
+                html: '<div><span>' + props.count + '</span></div>',
+                className: 'marker-cluster ' + clusterClassName(priceDiff),
+                iconSize: new L.Point(40, 40)
+            })
+        });
+
+        // Chain mix, largest chains first
+        const chainMix = Object.entries(props.chains)
+            .slice(0, 5)
+            .map(([chain, count]) => `${chain || 'אחר'}: ${count}`)
+            .join('<br>');
+        marker.bindTooltip(`${props.count} חנויות<br>${chainMix}`);
+
+        marker.on('click', () => {
+            map.setView(latlng, Math.min(map.getZoom() + 2, tileIndex.feature_zoom));
+        });
+        return marker;
+    }
+
+    // Redraw the markers after a filter change
+    function refreshMarkers() {
+        if (tileIndex) {
+            updateTiles();
+        } else {
+            addMarkersToMap(storesData);
+        }
+    }
+
     // Initialize filter values
     function initializeFilters(data) {
         // Get unique chains
         const chains = [...new Set(data.map(store => store.properties.chainname).filter(Boolean))].sort();
 
+        // Get unique cities
+        const cities = [...new Set(data.map(store => store.properties.city).filter(Boolean))].sort();
+
+        populateFilterOptions(chains, cities);
+    }
+
+    // Fill the chain and city selects
+    function populateFilterOptions(chains, cities) {
         // Log all unique chain names to help identify missing logos
         console.log('Unique chain names in data:', chains);
 
@@ -164,9 +333,6 @@ document.addEventListener('DOMContentLoaded', function() {
             chainFilter.appendChild(option);
         });
 
-        // Get unique cities
-        const cities = [...new Set(data.map(store => store.properties.city).filter(Boolean))].sort();
-
         // Populate city select
         cities.forEach(city => {
             const option = document.createElement('option');
@@ -285,7 +451,7 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
     // Add markers to map
-    function addMarkersToMap(data) {
+    function addMarkersToMap(data, fitBounds = true) {
         // Add debug to check the first store's properties
         if (data && data.length > 0) {
             console.log("First store properties:", data[0].properties);
@@ -310,7 +476,7 @@ document.addEventListener('DOMContentLoaded', function() {
         map.addLayer(markers);
 
         // Fit map to markers bounds if there are any
-        if (visibleMarkers.length > 0) {
+        if (fitBounds && visibleMarkers.length > 0) {
             map.fitBounds(markers.getBounds(), { padding: [50, 50] });
         }
     }
@@ -404,6 +570,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 <span class="detail-label">קוד חנות:</span>
                 <span class="detail-value">${props.store_code || 'לא זמין'}</span>
             </div>
+            ${cheaperNearbyHTML(props.cheaper_nearby)}
+            ${nearbyComparisonHTML(props.nearby_comparison)}
             <div class="store-detail-item">
                 <button class="btn" onclick="showStorePrices('${props.store_code}')">הצג טבלת מחירים</button>
             </div>
@@ -412,6 +580,53 @@ document.addEventListener('DOMContentLoaded', function() {
         storeDetails.innerHTML = detailsHTML;
     }
 
+    // List of the nearest cheaper stores precomputed by spatial_index.py
+    function cheaperNearbyHTML(neighbours) {
+        if (!neighbours || neighbours.length === 0) {
+            return '';
+        }
+        const items = neighbours.map(store => {
+            const priceDiff = store.average_price_diff !== null ? parseFloat(store.average_price_diff).toFixed(1) : '';
+            return `
+                <li>
+                    <a href="#" class="nearby-store-link" data-lat="${store.coordinates[1]}" data-lng="${store.coordinates[0]}">
+                        ${store.chainname || ''} - ${store.store_name || store.store_code}
+                    </a>
+                    (${store.distance_km.toFixed(1)} ק"מ, <span class="number-wrapper">${priceDiff}%</span>)
+                </li>`;
+        }).join('');
+        return `
+            <div class="store-detail-item">
+                <span class="detail-label">חנויות זולות יותר בקרבת מקום:</span>
+                <ul class="nearby-stores">${items}</ul>
+            </div>`;
+    }
+
+    // Head-to-head price comparison with the nearest stores precomputed by head_to_head.py
+    function nearbyComparisonHTML(comparisons) {
+        if (!comparisons || comparisons.length === 0) {
+            return '';
+        }
+        const items = comparisons.map(store => {
+            const ratioDiff = ((store.median_ratio - 1) * 100).toFixed(1);
+            const cheaperShare = Math.round(store.cheaper_share * 100);
+            return `
+                <li>
+                    <a href="#" class="nearby-store-link" data-lat="${store.coordinates[1]}" data-lng="${store.coordinates[0]}">
+                        ${store.chainname || ''} - ${store.store_name || store.store_code}
+                    </a>
+                    (${store.distance_km.toFixed(1)} ק"מ): חציון <span class="number-wrapper">${ratioDiff > 0 ? '+' : ''}${ratioDiff}%</span>,
+                    זול יותר ב-<span class="number-wrapper">${cheaperShare}%</span>
+                    מתוך <span class="number-wrapper">${store.shared_items}</span> מוצרים משותפים
+                </li>`;
+        }).join('');
+        return `
+            <div class="store-detail-item">
+                <span class="detail-label">השוואת מחירים מול חנויות סמוכות:</span>
+                <ul class="nearby-stores">${items}</ul>
+            </div>`;
+    }
+
     // Update range slider output values
     function updateRangeOutputs() {
         priceDiffOutput.textContent = `${filters.priceDiff}%`;
@@ -422,13 +637,13 @@ document.addEventListener('DOMContentLoaded', function() {
     // Chain filter
     chainFilter.addEventListener('change', function() {
         filters.chain = this.value;
-        addMarkersToMap(storesData);
+        refreshMarkers();
     });
 
     // City filter
     cityFilter.addEventListener('change', function() {
         filters.city = this.value;
-        addMarkersToMap(storesData);
+        refreshMarkers();
     });
 
     // Price difference filter - now filters stores with price difference LESS THAN the max value
@@ -438,7 +653,7 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     priceDiffFilter.addEventListener('change', function() {
-        addMarkersToMap(storesData);
+        refreshMarkers();
     });
 
     // Reset filters
@@ -457,11 +672,19 @@ document.addEventListener('DOMContentLoaded', function() {
         updateRangeOutputs();
 
         // Update map
-        addMarkersToMap(storesData);
+        refreshMarkers();
     });
 
     // Handle popup link clicks
     document.addEventListener('click', function(e) {
+        if (e.target && e.target.classList.contains('nearby-store-link')) {
+            e.preventDefault();
+            const lat = parseFloat(e.target.getAttribute('data-lat'));
+            const lng = parseFloat(e.target.getAttribute('data-lng'));
+            map.setView([lat, lng], 16);
+            return;
+        }
+
         if (e.target && e.target.classList.contains('popup-link')) {
             e.preventDefault();
             const storeId = e.target.getAttribute('data-store-id');
@@ -529,26 +752,31 @@ document.addEventListener('DOMContentLoaded', function() {
         // Log the full URL we're fetching from
         const fetchUrl = `/data/store_files/${storeCode}.json`;
         console.log('Fetching from URL:', fetchUrl);
-        
-        // Fetch the store price data
-        fetch(fetchUrl)
-            .then(response => {
-                console.log('Fetch response status:', response.status);
-                if (!response.ok) {
-                    throw new Error(`Network response was not ok: ${response.status}`);
-                }
-                return response.json();
-            })
+
+        // Stores exported with --pages are loaded page by page; otherwise fetch the whole file
+        loadStorePages(storeCode)
+            .then(data => data || loadStoreFile(fetchUrl))
             .then(data => {
                 console.log('Data received:', data);
-                console.log('Number of prices:', data.prices ? data.prices.length : 0);
+                console.log('Number of prices:', getPriceRows(data).length);
                 
                 // Update modal title and store info
                 if (modalTitle) modalTitle.textContent = `טבלת מחירים - ${data.store_name}`;
                 if (modalStoreInfo) modalStoreInfo.textContent = `${data.chainname}${data.subchainname ? ' - ' + data.subchainname : ''}, ${data.city}`;
                 
                 // Create table with the price data
+                tableContainer.currentData = data;
                 createPriceTable(data, tableContainer);
+
+                // Later searches and sorts use the index once it arrives; the table is usable without it
+                const searchIndexUrl = data.pages
+                    ? (data.search_index ? data.pageBase + data.search_index : null)
+                    : `/data/store_files/${storeCode}.index.json`;
+                if (searchIndexUrl) {
+                    loadSearchIndex(searchIndexUrl).then(index => {
+                        data.loadedSearchIndex = index;
+                    });
+                }
                 
                 // Setup search functionality
                 if (searchInput && sortButtons) {
@@ -568,39 +796,346 @@ document.addEventListener('DOMContentLoaded', function() {
     };
     
 
-    // Create the price table
-    function createPriceTable(data, container, sortBy = 'name', sortDir = 'asc', searchTerm = '') {
-        // Make a copy of the prices array for sorting and filtering
-        let prices = [...data.prices];
+    function fetchJson(url) {
+        return fetch(url).then(response => {
+            if (!response.ok) {
+                throw new Error(`Network response was not ok: ${response.status}`);
+            }
+            return response.json();
+        });
+    }
 
-        // Filter by search term if provided
-        if (searchTerm) {
-            const term = searchTerm.toLowerCase();
-            prices = prices.filter(item =>
-                (item.itemname && item.itemname.toLowerCase().includes(term)) ||
-                (item.manufacturer && item.manufacturer.toLowerCase().includes(term)) ||
-                (item.brand && item.brand.toLowerCase().includes(term)) ||
-                (item.category && item.category.toLowerCase().includes(term))
+    // Fill in item names from the shared catalog for files exported with --catalog
+    function withCatalog(data) {
+        if (data.catalog) {
+            return loadItemCatalog().then(catalog => attachCatalog(data, catalog));
+        }
+        return Promise.resolve(data);
+    }
+
+    // Load a whole store file
+    function loadStoreFile(fetchUrl) {
+        return fetch(fetchUrl)
+            .then(response => {
+                console.log('Fetch response status:', response.status);
+                if (!response.ok) {
+                    throw new Error(`Network response was not ok: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(withCatalog);
+    }
+
+    // Stores exported with --pages have data/store_files/<store_code>/header.json with the store
+    // details and page index, and pages of items in the default (name) order. An export writes
+    // every store in the same layout, so the first header fetched tells whether the others exist:
+    // page 1 is only requested once a header was found, and after a missing header no store is
+    // looked up in the paged layout again. Once the layout is known to be paged, the header and
+    // the first page are fetched together, so the first rows appear at the same time for any store size.
+    // Resolves to null if the store has no paged layout.
+    let pagedLayout = null;  // null until the first header request, then true or false
+
+    function loadStorePages(storeCode) {
+        if (pagedLayout === false) {
+            return Promise.resolve(null);
+        }
+        const pageBase = `/data/store_files/${storeCode}/`;
+        let firstPage = null;
+        if (pagedLayout) {
+            firstPage = fetchJson(pageBase + '1.json');
+            firstPage.catch(() => {});  // handled below, after the header
+        }
+        return fetch(pageBase + 'header.json')
+            .then(response => response.ok ? response.json() : null)
+            .catch(() => null)
+            .then(header => {
+                if (!header || !Array.isArray(header.pages)) {
+                    if (pagedLayout === null) {
+                        pagedLayout = false;
+                    }
+                    return null;
+                }
+                pagedLayout = true;
+                header.pageBase = pageBase;
+                header.prices = [];
+                header.pagesLoaded = 0;
+                if (!header.pages.length) {
+                    return header;
+                }
+                header.nextPage = (firstPage || fetchJson(pageBase + header.pages[0].file))
+                    .then(page => appendPage(header, page))
+                    .finally(() => {
+                        header.nextPage = null;
+                    });
+                return header.nextPage;
+            });
+    }
+
+    function appendPage(data, page) {
+        return withCatalog(page).then(page => {
+            getPriceRows(page).forEach(row => data.prices.push(row));
+            data.pagesLoaded++;
+            // Search texts and sort orders were computed for the rows loaded so far
+            data.searchTexts = null;
+            data.sortOrders = null;
+            return data;
+        });
+    }
+
+    function hasMorePages(data) {
+        return Boolean(data.pages) && data.pagesLoaded < data.pages.length;
+    }
+
+    // Fetch the next page of a paged store; concurrent calls share the request
+    function loadNextPage(data) {
+        if (!hasMorePages(data)) {
+            return Promise.resolve(data);
+        }
+        if (!data.nextPage) {
+            data.nextPage = fetchJson(data.pageBase + data.pages[data.pagesLoaded].file)
+                .then(page => appendPage(data, page))
+                .finally(() => {
+                    data.nextPage = null;
+                });
+        }
+        return data.nextPage;
+    }
+
+    function loadAllPages(data) {
+        if (!hasMorePages(data)) {
+            return Promise.resolve(data);
+        }
+        return loadNextPage(data).then(loadAllPages);
+    }
+
+    // Shared items catalog (item code -> name, manufacturer, brand, category).
+    // Loaded once per page; the versioned file name lets the browser cache it indefinitely.
+    let itemCatalogPromise = null;
+
+    function loadItemCatalog() {
+        if (!itemCatalogPromise) {
+            itemCatalogPromise = fetch('/data/items_catalog.json')
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`Network response was not ok: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(pointer => fetch(`/data/${pointer.file}`))
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`Network response was not ok: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .catch(error => {
+                    // Allow a retry on the next modal open
+                    itemCatalogPromise = null;
+                    throw error;
+                });
+        }
+        return itemCatalogPromise;
+    }
+
+    // Fill in item descriptions from the catalog for a store file exported with --catalog
+    function attachCatalog(data, catalog) {
+        const fields = catalog.fields;
+        getPriceRows(data).forEach(row => {
+            const item = catalog.items[row.itemcode];
+            fields.forEach((field, i) => {
+                row[field] = item ? item[i] : null;
+            });
+        });
+        return data;
+    }
+
+    // Get the price rows of a store file. Files exported with --compact hold prices as
+    // parallel arrays (one per field); these are converted to row objects once and cached.
+    function getPriceRows(data) {
+        if (!data.prices) {
+            return [];
+        }
+        if (Array.isArray(data.prices)) {
+            return data.prices;
+        }
+        if (!data.priceRows) {
+            const columns = data.prices;
+            const fields = Object.keys(columns);
+            const count = columns.itemcode ? columns.itemcode.length : 0;
+            data.priceRows = new Array(count);
+            for (let i = 0; i < count; i++) {
+                const row = {};
+                fields.forEach(field => {
+                    row[field] = columns[field][i];
+                });
+                data.priceRows[i] = row;
+            }
+        }
+        return data.priceRows;
+    }
+
+    // Search index written by the exporter next to the store file (<store_code>.index.json, or
+    // search.json in the paged layout): n-gram postings over the normalized item texts and
+    // precomputed sort orders. Resolves to null if the store was exported without one.
+    function loadSearchIndex(url) {
+        return fetch(url)
+            .then(response => response.ok ? response.json() : null)
+            .catch(() => null);
+    }
+
+    // Same normalization as normalize_text in search_index.py: lowercase, no niqqud,
+    // final letters as regular letters and collapsed whitespace
+    const NIQQUD = /[\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7]/g;
+    const FINAL_LETTERS = {'\u05DA': '\u05DB', '\u05DD': '\u05DE', '\u05DF': '\u05E0', '\u05E3': '\u05E4', '\u05E5': '\u05E6'};
+
+    function normalizeSearchText(text) {
+        if (!text) {
+            return '';
+        }
+        return String(text)
+            .toLowerCase()
+            .replace(NIQQUD, '')
+            .replace(/[\u05DA\u05DD\u05DF\u05E3\u05E5]/g, letter => FINAL_LETTERS[letter])
+            .replace(/\s+/g, ' ')
+            .trim();
+    }
+
+    // Normalized searchable text of every row, computed once per store
+    function getSearchTexts(data) {
+        if (!data.searchTexts) {
+            data.searchTexts = getPriceRows(data).map(item =>
+                [item.itemname, item.manufacturer, item.brand, item.category].map(normalizeSearchText).join('\n')
             );
         }
+        return data.searchTexts;
+    }
+
+    // The loaded search index, once it covers every row (paged stores may still be loading)
+    function activeSearchIndex(data) {
+        const index = data.loadedSearchIndex;
+        return index && index.item_count === getPriceRows(data).length ? index : null;
+    }
+
+    // Rows containing an n-gram, decoded from the delta-encoded postings on first use
+    function getPostings(index, gram) {
+        if (!index.postings) {
+            index.postings = {};
+        }
+        if (!index.postings[gram]) {
+            const deltas = index.grams[gram] || [];
+            const rows = new Int32Array(deltas.length);
+            let row = 0;
+            for (let i = 0; i < deltas.length; i++) {
+                row += deltas[i];
+                rows[i] = row;
+            }
+            index.postings[gram] = rows;
+        }
+        return index.postings[gram];
+    }
+
+    function intersectSorted(a, b) {
+        const result = [];
+        let i = 0;
+        let j = 0;
+        while (i < a.length && j < b.length) {
+            if (a[i] < b[j]) {
+                i++;
+            } else if (a[i] > b[j]) {
+                j++;
+            } else {
+                result.push(a[i]);
+                i++;
+                j++;
+            }
+        }
+        return result;
+    }
+
+    // Flags (1 = match) for the rows containing a normalized search term. With an index, only the
+    // rows holding every n-gram of the term are checked; otherwise all rows are scanned.
+    function searchRows(data, term) {
+        const texts = getSearchTexts(data);
+        const matched = new Uint8Array(texts.length);
+        const index = activeSearchIndex(data);
+        if (!index || term.length < index.gram_size) {
+            texts.forEach((text, row) => {
+                if (text.includes(term)) matched[row] = 1;
+            });
+            return matched;
+        }
 
-        // Sort the data based on the selected sort option
-        prices.sort((a, b) => {
+        const grams = new Set();
+        for (let i = 0; i + index.gram_size <= term.length; i++) {
+            grams.add(term.substr(i, index.gram_size));
+        }
+        const lists = [...grams].map(gram => getPostings(index, gram)).sort((a, b) => a.length - b.length);
+        let candidates = lists[0];
+        for (let i = 1; i < lists.length && candidates.length; i++) {
+            candidates = intersectSorted(candidates, lists[i]);
+        }
+        candidates.forEach(row => {
+            if (texts[row].includes(term)) matched[row] = 1;
+        });
+        return matched;
+    }
+
+    // Row order for a sort option, from the index when available, otherwise sorted once and cached
+    function getSortOrder(data, sortBy, sortDir) {
+        if (!data.sortOrders) {
+            data.sortOrders = {};
+        }
+        const index = activeSearchIndex(data);
+        const key = `${index ? 'index' : 'sorted'}:${sortBy}:${sortDir}`;
+        if (data.sortOrders[key]) {
+            return data.sortOrders[key];
+        }
+
+        const prices = getPriceRows(data);
+        let order;
+        if (index && index.sort[sortBy]) {
+            order = index.sort[sortBy];
+        } else if (data.pages && data.sort === sortBy) {
+            // Pages are exported in this order already
+            order = prices.map((item, row) => row);
+        } else {
+            order = prices.map((item, row) => row);
             switch (sortBy) {
-                case 'name':
-                    return sortDir === 'asc'
-                        ? (a.itemname || '').localeCompare(b.itemname || '')
-                        : (b.itemname || '').localeCompare(a.itemname || '');
+                case 'name': {
+                    // Normalized names compared by code unit, as name_sort_key in search_index.py,
+                    // so the order is the same with or without a search index
+                    const names = prices.map(item => normalizeSearchText(item.itemname));
+                    order.sort((a, b) => (names[a] < names[b] ? -1 : names[a] > names[b] ? 1 : 0));
+                    break;
+                }
                 case 'price':
-                    const aPrice = a.price || 0;
-                    const bPrice = b.price || 0;
-                    return sortDir === 'asc' ? aPrice - bPrice : bPrice - aPrice;
+                    order.sort((a, b) => (prices[a].price || 0) - (prices[b].price || 0));
+                    break;
                 case 'diff':
-                    const aDiff = a.price_diff_pct || 0;
-                    const bDiff = b.price_diff_pct || 0;
-                    return sortDir === 'asc' ? aDiff - bDiff : bDiff - aDiff;
-                default:
-                    return 0;
+                    order.sort((a, b) => (prices[a].price_diff_pct || 0) - (prices[b].price_diff_pct || 0));
+                    break;
+            }
+        }
+        if (sortDir !== 'asc') {
+            order = order.slice().reverse();
+        }
+        data.sortOrders[key] = order;
+        return order;
+    }
+
+    // Create the price table
+    function createPriceTable(data, container, sortBy = 'name', sortDir = 'asc', searchTerm = '') {
+        const rows = getPriceRows(data);
+
+        // Filter by search term if provided
+        const term = normalizeSearchText(searchTerm);
+        const matched = term ? searchRows(data, term) : null;
+
+        // Walk the rows in the selected sort order, keeping the matches
+        const prices = [];
+        getSortOrder(data, sortBy, sortDir).forEach(row => {
+            if (!matched || matched[row]) {
+                prices.push(rows[row]);
             }
         });
 
@@ -671,6 +1206,11 @@ document.addEventListener('DOMContentLoaded', function() {
             </table>
         `;
 
+        // Paged stores: the rest of the items are fetched when this comes into view
+        if (hasMorePages(data)) {
+            tableHTML += '<p class="text-center price-table-more">טוען מוצרים נוספים...</p>';
+        }
+
         // Update the container with the table
         container.innerHTML = tableHTML;
     }
@@ -681,10 +1221,50 @@ document.addEventListener('DOMContentLoaded', function() {
         let currentSortDir = 'asc';
         let currentSearchTerm = '';
 
+        function render() {
+            // Another store was opened in the meantime
+            if (container.currentData !== data) {
+                return;
+            }
+            createPriceTable(data, container, currentSortBy, currentSortDir, currentSearchTerm);
+            watchMoreRows();
+        }
+
+        // Render what is loaded now, then again once every page of a paged store has arrived
+        function renderAll() {
+            render();
+            if (hasMorePages(data)) {
+                loadAllPages(data)
+                    .then(render)
+                    .catch(error => console.error('Error fetching store prices:', error));
+            }
+        }
+
+        // Fetch the next page when the end of the table is scrolled into view
+        function watchMoreRows() {
+            const more = container.querySelector('.price-table-more');
+            if (!more) {
+                return;
+            }
+            if (!('IntersectionObserver' in window)) {
+                renderAll();
+                return;
+            }
+            const observer = new IntersectionObserver(entries => {
+                if (entries.some(entry => entry.isIntersecting)) {
+                    observer.disconnect();
+                    loadNextPage(data)
+                        .then(render)
+                        .catch(error => console.error('Error fetching store prices:', error));
+                }
+            });
+            observer.observe(more);
+        }
+
         // Search input event
         searchInput.addEventListener('input', function() {
             currentSearchTerm = this.value;
-            createPriceTable(data, container, currentSortBy, currentSortDir, currentSearchTerm);
+            renderAll();
         });
 
         // Sort buttons event
@@ -705,9 +1285,12 @@ document.addEventListener('DOMContentLoaded', function() {
                 this.classList.add('active');
 
                 // Update the table
-                createPriceTable(data, container, currentSortBy, currentSortDir, currentSearchTerm);
+                renderAll();
             });
         });
+
+        // The first page was rendered by showStorePrices
+        watchMoreRows();
     }
 });
 
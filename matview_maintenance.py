@@ -0,0 +1,216 @@
+import argparse
+import sys
+import time
+
+import psycopg2
+import config
+
+from price_aggregation import DEFAULT_POPULARITY_THRESHOLD,EXCLUDED_CHAINS,EXCLUDED_SUBCHAINS
+
+POPULAR_ITEMS_VIEW = "popular_items_avg_prices_mv"
+STORE_COMPARISONS_VIEW = "store_price_comparisons_mv"
+
+# Views in refresh order: the store comparison is computed from the popular items view
+MATERIALIZED_VIEWS = (POPULAR_ITEMS_VIEW,STORE_COMPARISONS_VIEW)
+
+# Indexes on the base tables for the upload_date / itemcode / store_code access patterns
+BASE_TABLE_INDEXES = [
+    ("allprices_upload_date_itemcode_idx","allprices","(upload_date, itemcode)"),
+    ("allprices_upload_date_store_code_idx","allprices","(upload_date, store_code)"),
+    ("all_stores_store_code_idx","all_stores","(store_code)"),
+    ("items_new_itemcode_idx","items_new","(itemcode)")
+]
+
+# Popular items of the latest upload_date. allprices is scanned once; the store count
+# and the average price come from the same aggregation.
+POPULAR_ITEMS_SQL = f"""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS {POPULAR_ITEMS_VIEW} AS
+    WITH latest AS (
+        SELECT max(upload_date) AS upload_date FROM allprices
+    )
+    SELECT
+        p.itemcode,
+        latest.upload_date,
+        avg(p.itemprice) AS average_price,
+        count(DISTINCT p.store_code) AS store_count
+    FROM allprices p
+    JOIN latest ON p.upload_date = latest.upload_date
+    JOIN all_stores s ON s.store_code = p.store_code
+    WHERE p.itemprice > 0
+        AND s.chainname <> ALL (%(excluded_chains)s)
+        AND s.subchainname <> ALL (%(excluded_subchains)s)
+        AND EXISTS (SELECT 1 FROM items_new i WHERE i.itemcode = p.itemcode)
+    GROUP BY p.itemcode, latest.upload_date
+    HAVING count(DISTINCT p.store_code) > %(threshold)s
+    WITH DATA;
+    """
+
+STORE_COMPARISONS_SQL = f"""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS {STORE_COMPARISONS_VIEW} AS
+    SELECT
+        s.store_code,
+        s.storename AS store_name,
+        s.chainname,
+        s.subchainname,
+        s.storeid,
+        s.address,
+        s.city,
+        s.zipcode,
+        s.latitude,
+        s.longitude,
+        avg((p.itemprice - pi.average_price) / pi.average_price * 100) AS average_price_diff,
+        count(*) AS popular_item_count
+    FROM {POPULAR_ITEMS_VIEW} pi
+    JOIN allprices p ON p.itemcode = pi.itemcode AND p.upload_date = pi.upload_date
+    JOIN all_stores s ON s.store_code = p.store_code
+    WHERE p.itemprice > 0
+        AND pi.average_price > 0
+        AND s.chainname <> ALL (%(excluded_chains)s)
+        AND s.subchainname <> ALL (%(excluded_subchains)s)
+    GROUP BY s.store_code, s.storename, s.chainname, s.subchainname, s.storeid,
+        s.address, s.city, s.zipcode, s.latitude, s.longitude
+    WITH DATA;
+    """
+
+# REFRESH ... CONCURRENTLY requires a unique index on each materialized view
+MATERIALIZED_VIEW_INDEXES = [
+    (f"{POPULAR_ITEMS_VIEW}_itemcode_idx",POPULAR_ITEMS_VIEW,"(itemcode)",True),
+    (f"{STORE_COMPARISONS_VIEW}_store_code_idx",STORE_COMPARISONS_VIEW,"(store_code)",True),
+    (f"{STORE_COMPARISONS_VIEW}_chainname_idx",STORE_COMPARISONS_VIEW,"(chainname)",False)
+]
+
+REFRESH_LOG_SQL = """
+    CREATE TABLE IF NOT EXISTS matview_refresh_log (
+        id serial PRIMARY KEY,
+        view_name text NOT NULL,
+        refreshed_at timestamptz NOT NULL DEFAULT now(),
+        duration_seconds double precision NOT NULL,
+        row_count bigint,
+        concurrent boolean NOT NULL
+    );
+    """
+
+
+def connect():
+    """Open an autocommit connection (CREATE INDEX CONCURRENTLY cannot run in a transaction)"""
+    print("Connecting to PostgreSQL database...")
+    pg_conn = psycopg2.connect(**config.pg_config)
+    pg_conn.autocommit = True
+    return pg_conn
+
+
+def create_base_indexes(pg_cursor):
+    """
+    Create the indexes used by the popular items and store comparison queries.
+    Indexes are built CONCURRENTLY so uploads into allprices are not blocked.
+    """
+    for name,table,columns in BASE_TABLE_INDEXES:
+        start = time.perf_counter()
+        pg_cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {columns};")
+        print(f"Index {name} ready ({time.perf_counter() - start:.1f}s)")
+
+
+def create_materialized_views(pg_cursor,threshold=DEFAULT_POPULARITY_THRESHOLD,
+                              excluded_chains=EXCLUDED_CHAINS,excluded_subchains=EXCLUDED_SUBCHAINS,recreate=False):
+    """
+    Create the popular items and store comparison materialized views and their indexes.
+
+    Parameters:
+    pg_cursor: psycopg2 cursor on an autocommit connection
+    threshold (int): An item is popular if sold in more than this many stores
+    excluded_chains (sequence): Chain names left out of the comparison
+    excluded_subchains (sequence): Sub-chain names left out of the comparison
+    recreate (bool): Drop existing views first (needed when the parameters change)
+    """
+    params = {
+        'threshold': threshold,
+        'excluded_chains': list(excluded_chains),
+        'excluded_subchains': list(excluded_subchains)
+    }
+    if recreate:
+        for view in reversed(MATERIALIZED_VIEWS):
+            pg_cursor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view} CASCADE;")
+            print(f"Dropped {view}")
+
+    for view,view_sql in ((POPULAR_ITEMS_VIEW,POPULAR_ITEMS_SQL),(STORE_COMPARISONS_VIEW,STORE_COMPARISONS_SQL)):
+        start = time.perf_counter()
+        pg_cursor.execute(view_sql,params)
+        print(f"Materialized view {view} ready ({time.perf_counter() - start:.1f}s)")
+
+    for name,view,columns,unique in MATERIALIZED_VIEW_INDEXES:
+        pg_cursor.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {view} {columns};")
+
+    pg_cursor.execute(REFRESH_LOG_SQL)
+
+
+def refresh_materialized_views(pg_cursor,concurrently=True):
+    """
+    Refresh the materialized views in dependency order and record how long each refresh took
+    in matview_refresh_log. A concurrent refresh keeps the views readable while it runs.
+    Returns a list of (view, seconds, row_count).
+
+    Parameters:
+    pg_cursor: psycopg2 cursor on an autocommit connection
+    concurrently (bool): Use REFRESH MATERIALIZED VIEW CONCURRENTLY
+    """
+    timings = []
+    for view in MATERIALIZED_VIEWS:
+        start = time.perf_counter()
+        pg_cursor.execute(f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if concurrently else ''}{view};")
+        duration = time.perf_counter() - start
+
+        pg_cursor.execute(f"SELECT count(*) FROM {view};")
+        row_count = pg_cursor.fetchone()[0]
+        pg_cursor.execute(
+            "INSERT INTO matview_refresh_log (view_name, duration_seconds, row_count, concurrent) VALUES (%s, %s, %s, %s);",
+            (view,duration,row_count,concurrently)
+        )
+        print(f"Refreshed {view}: {row_count:,} rows in {duration:.1f}s")
+        timings.append((view,duration,row_count))
+    return timings
+
+
+def print_refresh_history(pg_cursor,limit=10):
+    """Print the most recent refreshes from matview_refresh_log"""
+    pg_cursor.execute(
+        "SELECT view_name, refreshed_at, duration_seconds, row_count, concurrent "
+        "FROM matview_refresh_log ORDER BY refreshed_at DESC LIMIT %s;",
+        (limit,)
+    )
+    for view,refreshed_at,duration,row_count,concurrent in pg_cursor.fetchall():
+        mode = "concurrent" if concurrent else "blocking"
+        print(f"  {refreshed_at:%Y-%m-%d %H:%M:%S}  {view}: {duration:.1f}s, {row_count:,} rows ({mode})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the price comparison materialized views")
+    subparsers = parser.add_subparsers(dest="command",required=True)
+
+    setup_parser = subparsers.add_parser("setup",help="Create indexes and materialized views")
+    setup_parser.add_argument("--threshold",type=int,default=DEFAULT_POPULARITY_THRESHOLD,
+                              help="Popularity threshold (number of stores)")
+    setup_parser.add_argument("--recreate",action="store_true",help="Drop and recreate the views")
+
+    refresh_parser = subparsers.add_parser("refresh",help="Refresh the views after an upload")
+    refresh_parser.add_argument("--blocking",action="store_true",help="Refresh without CONCURRENTLY")
+
+    subparsers.add_parser("status",help="Show recent refresh timings")
+    args = parser.parse_args()
+
+    try:
+        pg_conn = connect()
+        try:
+            with pg_conn.cursor() as pg_cursor:
+                if args.command == "setup":
+                    create_base_indexes(pg_cursor)
+                    create_materialized_views(pg_cursor,threshold=args.threshold,recreate=args.recreate)
+                elif args.command == "refresh":
+                    refresh_materialized_views(pg_cursor,concurrently=not args.blocking)
+                else:
+                    print_refresh_history(pg_cursor)
+        finally:
+            pg_conn.close()
+            print(f"Database connection closed")
+    except psycopg2.Error as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
@@ -0,0 +1,404 @@
+import codecs
+import csv
+import io
+import math
+import struct
+from array import array
+
+# Column layouts of the tables and views extracted with COPY. Every column is cast in the
+# COPY query to the PostgreSQL type matching its kind, so the binary decoder only has to
+# handle int8, float8 and text.
+STORE_PRICE_COMPARISONS_COLUMNS = [
+    ('store_code','str'),
+    ('store_name','str'),
+    ('chainname','str'),
+    ('subchainname','str'),
+    ('storeid','int'),
+    ('address','str'),
+    ('city','str'),
+    ('zipcode','str'),
+    ('latitude','float'),
+    ('longitude','float'),
+    ('average_price_diff','float'),
+    ('popular_item_count','int')
+]
+
+ALL_STORES_COLUMNS = [
+    ('store_code','str'),
+    ('storename','str'),
+    ('chainname','str'),
+    ('subchainname','str'),
+    ('storeid','int'),
+    ('address','str'),
+    ('city','str'),
+    ('zipcode','str'),
+    ('latitude','float'),
+    ('longitude','float')
+]
+
+ALLPRICES_COLUMNS = [
+    ('store_code','str'),
+    ('itemcode','int'),
+    ('itemprice','float')
+]
+
+ITEMS_NEW_COLUMNS = [
+    ('itemcode','int'),
+    ('itemname','str'),
+    ('manufacturer','str'),
+    ('brand','str'),
+    ('category','str')
+]
+
+_PG_CASTS = {
+    'int': 'int8',
+    'float': 'float8',
+    'str': 'text'
+}
+
+_BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+_BINARY_HEADER_SIZE = len(_BINARY_SIGNATURE) + 8
+_INT16 = struct.Struct('!h')
+_INT32 = struct.Struct('!i')
+_INT64 = struct.Struct('!q')
+_FLOAT64 = struct.Struct('!d')
+
+
+class ColumnTable:
+    """
+    Query results stored column by column instead of as one dict per row.
+    int columns are array('q'), float columns are array('d') with NaN for NULL,
+    and str columns are lists with None for NULL.
+    """
+
+    def __init__(self,columns):
+        self.names = [name for name,kind in columns]
+        self.kinds = dict(columns)
+        self.columns = {}
+        for name,kind in columns:
+            if kind == 'int':
+                self.columns[name] = array('q')
+            elif kind == 'float':
+                self.columns[name] = array('d')
+            else:
+                self.columns[name] = []
+        # Row indexes holding NULL in int columns (arrays of int64 cannot store NULL)
+        self.int_nulls = {name: set() for name,kind in columns if kind == 'int'}
+
+    def __len__(self):
+        return len(self.columns[self.names[0]]) if self.names else 0
+
+    def __getitem__(self,name):
+        return self.columns[name]
+
+    def schema(self):
+        """Return the {column: kind} schema, as used by row_sanitizer.RowSanitizer"""
+        return dict(self.kinds)
+
+    def rows(self):
+        """
+        Iterate over the rows as tuples in column order, restoring NULL in int columns.
+        NaN float values are returned as-is; the typed converters map them to None.
+        """
+        columns = [self.columns[name] for name in self.names]
+        if not any(self.int_nulls.values()):
+            return zip(*columns)
+        return self._rows_with_nulls(columns)
+
+    def _rows_with_nulls(self,columns):
+        null_sets = [self.int_nulls.get(name) for name in self.names]
+        for index,row in enumerate(zip(*columns)):
+            yield tuple(
+                None if nulls and index in nulls else value
+                for value,nulls in zip(row,null_sets)
+            )
+
+
+def _column_appenders(table):
+    """Build one append function per column that converts and stores a raw field value"""
+    appenders = []
+    for name in table.names:
+        kind = table.kinds[name]
+        target = table.columns[name]
+        if kind == 'int':
+            appenders.append(_int_appender(target,table.int_nulls[name]))
+        elif kind == 'float':
+            appenders.append(_float_appender(target))
+        else:
+            appenders.append(target.append)
+    return appenders
+
+
+def _int_appender(target,nulls):
+    def append(value):
+        if value is None:
+            nulls.add(len(target))
+            target.append(0)
+        else:
+            target.append(int(value))
+    return append
+
+
+def _float_appender(target):
+    def append(value):
+        target.append(math.nan if value is None else float(value))
+    return append
+
+
+class CsvCopyParser:
+    """
+    File-like sink for COPY ... TO STDOUT WITH (FORMAT csv).
+    Complete records are parsed into the table as data arrives, so the raw COPY
+    output is never held in memory as a whole.
+    """
+
+    def __init__(self,table):
+        self.table = table
+        self._appenders = _column_appenders(table)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._pending = ''
+
+    def write(self,data):
+        if isinstance(data,bytes):
+            data = self._decoder.decode(data)
+        self._pending += data
+
+        # A record ends at a newline outside of quotes; quoted fields may contain newlines
+        split = self._pending.rfind('\n') + 1
+        while split and self._pending.count('"',0,split) % 2:
+            split = self._pending.rfind('\n',0,split - 1) + 1
+        if split:
+            self._parse(self._pending[:split])
+            self._pending = self._pending[split:]
+
+    def close(self):
+        self._pending += self._decoder.decode(b'',final=True)
+        if self._pending:
+            self._parse(self._pending)
+            self._pending = ''
+
+    def _parse(self,text):
+        appenders = self._appenders
+        for record in csv.reader(io.StringIO(text,newline='')):
+            # COPY writes NULL as an unquoted empty field and '' as a quoted one;
+            # both read back as '', so empty strings are treated as NULL
+            for append,value in zip(appenders,record):
+                append(value if value != '' else None)
+
+
+class BinaryCopyParser:
+    """
+    File-like sink for COPY ... TO STDOUT WITH (FORMAT binary), where every column has
+    been cast to int8, float8 or text. Tuples are decoded as data arrives.
+    """
+
+    def __init__(self,table):
+        self.table = table
+        self._decoders = []
+        for name in table.names:
+            kind = table.kinds[name]
+            target = table.columns[name]
+            if kind == 'int':
+                self._decoders.append(_binary_int_decoder(target,table.int_nulls[name]))
+            elif kind == 'float':
+                self._decoders.append(_binary_float_decoder(target))
+            else:
+                self._decoders.append(_binary_text_decoder(target))
+        self._buffer = b''
+        self._header_done = False
+        self._finished = False
+
+    def write(self,data):
+        if isinstance(data,str):
+            raise ValueError("Binary COPY output must be written as bytes")
+        self._buffer += data
+        position = 0
+        if not self._header_done:
+            position = self._read_header()
+            if position is None:
+                return
+        self._buffer = self._buffer[self._read_tuples(position):]
+
+    def close(self):
+        if self._buffer or not self._finished:
+            raise ValueError("Truncated binary COPY stream")
+
+    def _read_header(self):
+        buffer = self._buffer
+        if len(buffer) < _BINARY_HEADER_SIZE:
+            return None
+        if not buffer.startswith(_BINARY_SIGNATURE):
+            raise ValueError("Not a binary COPY stream")
+        extension_length = _INT32.unpack_from(buffer,len(_BINARY_SIGNATURE) + 4)[0]
+        if len(buffer) < _BINARY_HEADER_SIZE + extension_length:
+            return None
+        self._header_done = True
+        return _BINARY_HEADER_SIZE + extension_length
+
+    def _read_tuples(self,position):
+        buffer = self._buffer
+        size = len(buffer)
+        decoders = self._decoders
+        while position + 2 <= size:
+            field_count = _INT16.unpack_from(buffer,position)[0]
+            if field_count == -1:
+                self._finished = True
+                return position + 2
+            if field_count != len(decoders):
+                raise ValueError(f"Expected {len(decoders)} fields per tuple, got {field_count}")
+
+            # Make sure the whole tuple is buffered before decoding any of its fields
+            fields = []
+            offset = position + 2
+            for _ in range(field_count):
+                if offset + 4 > size:
+                    return position
+                length = _INT32.unpack_from(buffer,offset)[0]
+                offset += 4
+                if length < 0:
+                    fields.append(None)
+                    continue
+                if offset + length > size:
+                    return position
+                fields.append((offset,length))
+                offset += length
+
+            for decode,field in zip(decoders,fields):
+                decode(buffer,field)
+            position = offset
+        return position
+
+
+def _binary_int_decoder(target,nulls):
+    def decode(buffer,field):
+        if field is None:
+            nulls.add(len(target))
+            target.append(0)
+        else:
+            target.append(_INT64.unpack_from(buffer,field[0])[0])
+    return decode
+
+
+def _binary_float_decoder(target):
+    def decode(buffer,field):
+        if field is None:
+            target.append(math.nan)
+        else:
+            target.append(_FLOAT64.unpack_from(buffer,field[0])[0])
+    return decode
+
+
+def _binary_text_decoder(target):
+    def decode(buffer,field):
+        if field is None:
+            target.append(None)
+        else:
+            offset,length = field
+            target.append(buffer[offset:offset + length].decode('utf-8'))
+    return decode
+
+
+def build_copy_sql(source,columns,where=None,order_by=None,copy_format='binary'):
+    """
+    Build a COPY (SELECT ...) TO STDOUT statement casting every column to its kind.
+
+    Parameters:
+    source (str): Table or view to read from
+    columns (list): (column, kind) pairs
+    where (str): Optional WHERE clause (already escaped, e.g. via cursor.mogrify)
+    order_by (str): Optional ORDER BY clause
+    copy_format (str): 'binary' or 'csv'
+    """
+    select_list = ', '.join(f"{name}::{_PG_CASTS[kind]}" for name,kind in columns)
+    query = f"SELECT {select_list} FROM {source}"
+    if where:
+        query += f" WHERE {where}"
+    if order_by:
+        query += f" ORDER BY {order_by}"
+    if copy_format == 'binary':
+        options = "FORMAT binary"
+    elif copy_format == 'csv':
+        options = "FORMAT csv"
+    else:
+        raise ValueError(f"Unknown COPY format: {copy_format}")
+    return f"COPY ({query}) TO STDOUT WITH ({options})"
+
+
+def copy_to_columns(pg_cursor,copy_sql,columns,copy_format='binary'):
+    """
+    Run a COPY ... TO STDOUT statement and parse its output straight into a ColumnTable.
+
+    Parameters:
+    pg_cursor: psycopg2 cursor (or any object with a compatible copy_expert method)
+    copy_sql (str): COPY statement, e.g. from build_copy_sql
+    columns (list): (column, kind) pairs matching the COPY output
+    copy_format (str): 'binary' or 'csv'
+    """
+    table = ColumnTable(columns)
+    if copy_format == 'binary':
+        parser = BinaryCopyParser(table)
+    else:
+        parser = CsvCopyParser(table)
+    pg_cursor.copy_expert(copy_sql,parser)
+    parser.close()
+    return table
+
+
+def extract_store_price_comparisons(pg_cursor,copy_format='binary',source='public.store_price_comparisons_mv'):
+    """
+    Extract the store price comparison with COPY. Reads the materialized view maintained by
+    matview_maintenance.py by default; pass source='public.store_price_comparisons' for the plain view.
+    """
+    copy_sql = build_copy_sql(source,STORE_PRICE_COMPARISONS_COLUMNS,
+                              order_by='store_code',copy_format=copy_format)
+    return copy_to_columns(pg_cursor,copy_sql,STORE_PRICE_COMPARISONS_COLUMNS,copy_format)
+
+
+def extract_all_stores(pg_cursor,copy_format='binary'):
+    """Extract the all_stores table with COPY"""
+    copy_sql = build_copy_sql('all_stores',ALL_STORES_COLUMNS,order_by='store_code',copy_format=copy_format)
+    return copy_to_columns(pg_cursor,copy_sql,ALL_STORES_COLUMNS,copy_format)
+
+
+def extract_allprices(pg_cursor,upload_date,copy_format='binary'):
+    """
+    Extract one upload_date of the allprices table with COPY.
+
+    Parameters:
+    pg_cursor: psycopg2 cursor
+    upload_date (str or date): Upload date to extract
+    copy_format (str): 'binary' or 'csv'
+    """
+    # COPY does not accept bind parameters, so the date is quoted client-side
+    where = pg_cursor.mogrify("upload_date = %s",(upload_date,))
+    if isinstance(where,bytes):
+        where = where.decode('utf-8')
+    copy_sql = build_copy_sql('allprices',ALLPRICES_COLUMNS,where=where,copy_format=copy_format)
+    return copy_to_columns(pg_cursor,copy_sql,ALLPRICES_COLUMNS,copy_format)
+
+
+def extract_items_new(pg_cursor,copy_format='binary'):
+    """Extract the items_new table with COPY"""
+    copy_sql = build_copy_sql('items_new',ITEMS_NEW_COLUMNS,order_by='itemcode',copy_format=copy_format)
+    return copy_to_columns(pg_cursor,copy_sql,ITEMS_NEW_COLUMNS,copy_format)
+
+
+def load_csv_columns(csv_file,columns,block_size=1 << 20):
+    """
+    Load a CSV file with a header row (e.g. a table written by synthetic_data.py) into a
+    ColumnTable, as if it had been extracted with COPY. Empty fields are NULL.
+
+    Parameters:
+    csv_file (str): Path of the CSV file
+    columns (list): (column, kind) pairs; the header must list the same columns
+    """
+    table = ColumnTable(columns)
+    parser = CsvCopyParser(table)
+    with open(csv_file,'r',encoding='utf-8-sig',newline='') as f:
+        header = next(csv.reader([f.readline()]))
+        if header != table.names:
+            raise ValueError(f"{csv_file} has columns {header}, expected {table.names}")
+        for block in iter(lambda: f.read(block_size),''):
+            parser.write(block)
+    parser.close()
+    return table
@@ -0,0 +1,204 @@
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Connections in the shared pool, and so the number of partitions extracted at once.
+# Extraction waits on the database, not the CPU, so threads are enough.
+DEFAULT_POOL_SIZE = 4
+
+# Partitions per connection when splitting by store_code range, so one slow range does not
+# leave the other connections idle at the end
+PARTITIONS_PER_CONNECTION = 4
+
+# Batches of fetched rows buffered per partition before its thread waits for the reader
+MAX_QUEUED_BATCHES = 4
+
+# One slice of an extraction: an SQL condition substituted for {partition} in the query,
+# and its parameters
+Partition = namedtuple('Partition',['label','condition','params'])
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(maxconn=DEFAULT_POOL_SIZE):
+    """
+    Return the connection pool shared by the extraction scripts, opening it on first use
+    with the connection settings in config.py (or over the local database, see storage.py).
+
+    Parameters:
+    maxconn (int): Maximum number of connections (only used when the pool is created)
+    """
+    global _pool
+    import storage
+
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            local_path = storage.local_db_path()
+            if local_path:
+                print(f"Opening a pool of up to {maxconn} connections to the local database {local_path}...")
+                _pool = storage.LocalConnectionPool(local_path,maxconn)
+            else:
+                import psycopg2.pool
+                import config
+
+                print(f"Opening a pool of up to {maxconn} PostgreSQL connections...")
+                _pool = psycopg2.pool.ThreadedConnectionPool(1,maxconn,**config.pg_config)
+        return _pool
+
+
+def close_pool():
+    """Close every connection of the shared pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+            print(f"Database connections closed")
+        _pool = None
+
+
+@contextmanager
+def pooled_connection(pool=None):
+    """
+    Borrow a connection from the pool for the duration of the block. The transaction is
+    rolled back before the connection is returned, so every borrower starts clean.
+
+    Parameters:
+    pool: psycopg2 connection pool (defaults to the shared pool)
+    """
+    pool = pool or get_pool()
+    pg_conn = pool.getconn()
+    try:
+        yield pg_conn
+    finally:
+        try:
+            pg_conn.rollback()
+        finally:
+            pool.putconn(pg_conn)
+
+
+def store_code_partitions(pg_cursor,count,source='all_stores',column='store_code'):
+    """
+    Split the store codes into up to count contiguous ranges with about the same number of
+    stores each. The first and last ranges are open-ended, so stores missing from source
+    are still extracted. Extracting the ranges in order keeps an ORDER BY store_code intact.
+
+    Parameters:
+    pg_cursor: psycopg2 cursor
+    count (int): Number of partitions
+    source (str): Table or view listing the store codes
+    column (str): Store code column in the extraction query (e.g. 's.store_code')
+    """
+    pg_cursor.execute(f"SELECT DISTINCT store_code FROM {source} WHERE store_code IS NOT NULL ORDER BY store_code")
+    codes = [row[0] for row in pg_cursor.fetchall()]
+    count = max(1,min(count,len(codes)))
+    bounds = [codes[len(codes) * i // count] for i in range(1,count)]
+
+    if not bounds:
+        return [Partition("all stores","TRUE",())]
+    partitions = [Partition(f"< {bounds[0]}",f"{column} < %s",(bounds[0],))]
+    for lower,upper in zip(bounds,bounds[1:]):
+        partitions.append(Partition(f"{lower} - {upper}",f"{column} >= %s AND {column} < %s",(lower,upper)))
+    partitions.append(Partition(f">= {bounds[-1]}",f"{column} >= %s",(bounds[-1],)))
+    return partitions
+
+
+def chain_partitions(pg_cursor,source='all_stores',column='chainname'):
+    """
+    One partition per chain, in chain name order, plus one for stores without a chain.
+
+    Parameters:
+    pg_cursor: psycopg2 cursor
+    source (str): Table or view listing the chains
+    column (str): Chain column in the extraction query (e.g. 's.chainname')
+    """
+    pg_cursor.execute(f"SELECT DISTINCT chainname FROM {source} WHERE chainname IS NOT NULL ORDER BY chainname")
+    partitions = [Partition(chain,f"{column} = %s",(chain,)) for chain, in pg_cursor.fetchall()]
+    partitions.append(Partition("no chain",f"{column} IS NULL",()))
+    return partitions
+
+
+class PartitionedExtraction:
+    """
+    Run one query per partition concurrently, each on its own pooled connection, and
+    yield the rows of all partitions as a single stream in partition order.
+
+    The query contains a {partition} placeholder that is replaced by each partition's
+    condition; its parameters follow the query's own params. Rows are read with server-side
+    cursors and at most MAX_QUEUED_BATCHES batches per partition are buffered, so memory stays
+    bounded while the partitions after the one being read are fetched ahead. The stream is
+    the same as running the whole query with the partitions' rows concatenated in order.
+
+    Parameters:
+    query (str): SQL with a {partition} placeholder
+    params (tuple): Parameters of the query itself
+    partitions (list): Partition tuples (see store_code_partitions, chain_partitions)
+    workers (int): Partitions extracted at once (limited to the pool size)
+    batch_size (int): Rows fetched from the server per round-trip
+    pool: psycopg2 connection pool (defaults to the shared pool)
+    """
+
+    def __init__(self,query,params,partitions,workers=DEFAULT_POOL_SIZE,batch_size=10000,pool=None):
+        self.query = query
+        self.params = tuple(params)
+        self.partitions = list(partitions)
+        self.pool = pool or get_pool(workers)
+        self.workers = max(1,min(workers,self.pool.maxconn))
+        self.batch_size = batch_size
+        # Column description of the result, available once the first rows arrived
+        self.description = None
+        self.row_counts = [0] * len(self.partitions)
+        self._cancelled = threading.Event()
+
+    def _put(self,batches,item):
+        # Wait for the reader, but give up if it stopped reading
+        while not self._cancelled.is_set():
+            try:
+                batches.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _extract(self,index,batches):
+        partition = self.partitions[index]
+        if self._cancelled.is_set():
+            return
+        try:
+            with pooled_connection(self.pool) as pg_conn:
+                with pg_conn.cursor(name=f'partition_{index}') as pg_cursor:
+                    pg_cursor.itersize = self.batch_size
+                    pg_cursor.execute(self.query.format(partition=partition.condition),self.params + tuple(partition.params))
+                    while not self._cancelled.is_set():
+                        rows = pg_cursor.fetchmany(self.batch_size)
+                        if not rows:
+                            break
+                        if self.description is None:
+                            self.description = pg_cursor.description
+                        self.row_counts[index] += len(rows)
+                        if not self._put(batches,rows):
+                            return
+            self._put(batches,None)
+        except BaseException as e:
+            self._put(batches,e)
+
+    def __iter__(self):
+        queues = [queue.Queue(maxsize=MAX_QUEUED_BATCHES) for partition in self.partitions]
+        self._cancelled.clear()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # Partitions are started in order, so the one being read is always running
+            for index,batches in enumerate(queues):
+                executor.submit(self._extract,index,batches)
+            try:
+                for batches in queues:
+                    while True:
+                        rows = batches.get()
+                        if rows is None:
+                            break
+                        if isinstance(rows,BaseException):
+                            raise rows
+                        yield from rows
+            finally:
+                self._cancelled.set()
@@ -1,18 +1,25 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import config
+import sys
 
+import storage
+from run_metrics import RunMetrics,metrics_from_argv
 
-def quick_debug():
+
+def quick_debug(metrics=None):
     """
     Quick debug to find the specific issue with the views
+
+    Parameters:
+    metrics (RunMetrics): Optional metrics of the run; query and fetch times are recorded in it
     """
+    metrics = metrics or RunMetrics('pg_quick_debug')
 
     try:
-        print("Connecting to PostgreSQL database...")
-        pg_conn = psycopg2.connect(**config.pg_config)
+        print(f"Connecting to the {storage.describe_backend()}...")
+        with metrics.stage('connect'):
+            pg_conn = storage.connect()
 
-        with pg_conn.cursor(cursor_factory=RealDictCursor) as pg_cursor:
+        # Every query and fetch is timed in the metrics of the run
+        with pg_conn.cursor(cursor_factory=metrics.cursor_factory(storage.cursor_class(pg_conn,dict_rows=True))) as pg_cursor:
 
             print("\n1. Testing popular_items_avg_prices view directly...")
             pg_cursor.execute("SELECT COUNT(*) as count FROM popular_items_avg_prices LIMIT 1;")
@@ -98,7 +105,7 @@ def quick_debug():
                     else:
                         print("❌ store_price_comparisons view is empty!")
 
-                except psycopg2.errors.QueryCanceled:
+                except storage.QUERY_CANCELED:
                     print("❌ store_price_comparisons view query timed out (>30s)")
                     print("   This suggests a performance issue in the view")
                 except Exception as e:
@@ -111,4 +118,7 @@ def quick_debug():
 
 
 if __name__ == "__main__":
-    quick_debug()
\ No newline at end of file
+    # --metrics FILE sets the metrics file, --profile adds a cProfile dump
+    metrics,metrics_file = metrics_from_argv("pg_quick_debug",sys.argv)
+    quick_debug(metrics)
+    metrics.save(metrics_file)
\ No newline at end of file
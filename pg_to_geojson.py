@@ -1,10 +1,58 @@
 import json
 import os
 import math
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import sys
-import config
+import storage
+from build_manifest import BuildManifest,hash_file
+from geojson_stream import atomic_open,stream_feature_collection
+from pg_copy import extract_store_price_comparisons
+from pg_extract import (DEFAULT_POOL_SIZE,PARTITIONS_PER_CONNECTION,PartitionedExtraction,chain_partitions,
+                        close_pool,get_pool,pooled_connection,store_code_partitions)
+from row_sanitizer import RowSanitizer,TYPED_CONVERTERS,pg_sanitizer
+from run_metrics import RunMetrics,metrics_from_argv
+from spatial_index import add_cheaper_neighbours_to_file
+from tile_pyramid import build_tile_pyramid
+
+
+# Reads the materialized view maintained by matview_maintenance.py, so the comparison is not
+# recomputed on every export
+DEFAULT_QUERY = """
+        SELECT 
+            store_code,
+            store_name,
+            chainname,
+            subchainname,
+            storeid,
+            address,
+            city,
+            zipcode,
+            latitude,
+            longitude,
+            average_price_diff,
+            popular_item_count
+        FROM public.store_price_comparisons_mv
+        ORDER BY store_code;
+        """
+
+# DEFAULT_QUERY restricted to one partition (see pg_extract.py)
+PARTITIONED_QUERY = """
+        SELECT 
+            store_code,
+            store_name,
+            chainname,
+            subchainname,
+            storeid,
+            address,
+            city,
+            zipcode,
+            latitude,
+            longitude,
+            average_price_diff,
+            popular_item_count
+        FROM public.store_price_comparisons_mv
+        WHERE {partition}
+        ORDER BY store_code;
+        """
 
 
 def is_valid_number(value):
@@ -14,35 +62,22 @@ def is_valid_number(value):
     return True
 
 
-def postgres_to_geojson(output_file,query=None):
+def postgres_to_geojson(output_file,query=None,metrics=None):
     """
-    Connect to PostgreSQL database using config.py and convert query results to GeoJSON format.
+    Connect to the database (PostgreSQL using config.py, or the local database; see storage.py)
+    and convert query results to GeoJSON format.
     Properly handles NULL, NaN, and invalid values.
 
     Parameters:
     output_file (str): Path to write the GeoJSON output
-    query (str): SQL query to execute (optional, defaults to selecting from store_price_comparisons view)
+    query (str): SQL query to execute (optional, defaults to selecting from the store_price_comparisons_mv materialized view)
+    metrics (RunMetrics): Optional metrics of the run (stage timings, skipped and cleaned values)
     """
+    metrics = metrics or RunMetrics('pg_to_geojson')
 
     # Default query to select from the view
     if query is None:
-        query = """
-        SELECT 
-            store_code,
-            store_name,
-            chainname,
-            subchainname,
-            storeid,
-            address,
-            city,
-            zipcode,
-            latitude,
-            longitude,
-            average_price_diff,
-            popular_item_count
-        FROM public.store_price_comparisons
-        ORDER BY store_code;
-        """
+        query = DEFAULT_QUERY
 
     # Create a GeoJSON structure
     geojson = {
@@ -51,128 +86,48 @@ def postgres_to_geojson(output_file,query=None):
     }
 
     try:
-        # Connect to PostgreSQL using config
+        # Connect to PostgreSQL using config (or the local database, see storage.py)
         print("Connecting to PostgreSQL database...")
-        pg_conn = psycopg2.connect(**config.pg_config)
+        with metrics.stage('connect'):
+            pg_conn = storage.connect()
 
-        # Use RealDictCursor to get results as dictionaries
-        with pg_conn.cursor(cursor_factory=RealDictCursor) as pg_cursor:
+        with pg_conn.cursor() as pg_cursor:
             print("Executing query...")
-            pg_cursor.execute(query)
+            with metrics.stage('query'):
+                pg_cursor.execute(query)
+
+            # Column types are taken from the cursor once, not checked per value
+            sanitizer = pg_sanitizer(pg_cursor.description)
 
             row_num = 0
             while True:
                 # Fetch rows in batches to handle large datasets efficiently
-                rows = pg_cursor.fetchmany(1000)
+                with metrics.stage('fetch'):
+                    rows = pg_cursor.fetchmany(1000)
                 if not rows:
                     break
 
-                for row in rows:
-                    row_num += 1
-
-                    # Convert row to regular dict for easier handling
-                    row_dict = dict(row)
-
-                    # Skip if latitude or longitude are missing or invalid
-                    if not row_dict.get('latitude') or not row_dict.get('longitude'):
-                        print(
-                            f"Skipping row {row_num} with missing coordinates: store_code={row_dict.get('store_code')}")
-                        continue
-
-                    try:
-                        # Convert latitude and longitude to float, ensuring they're valid numbers
-                        lat = float(row_dict['latitude'])
-                        lng = float(row_dict['longitude'])
-
-                        # Check if coordinates are valid numbers (not NaN or Infinity)
-                        if math.isnan(lat) or math.isnan(lng) or math.isinf(lat) or math.isinf(lng):
-                            print(f"Skipping row {row_num} with invalid coordinates: lat={lat}, lng={lng}")
-                            continue
-
-                        # Create a GeoJSON feature
-                        feature = {
-                            "type": "Feature",
-                            "geometry": {
-                                "type": "Point",
-                                "coordinates": [lng,lat]
-                            },
-                            "properties": {}
-                        }
-
-                        # Add all properties from the row, properly handling NULL, NaN and invalid values
-                        for key,value in row_dict.items():
-                            if key not in ['latitude','longitude']:
-                                # Handle None/NULL values
-                                if value is None:
-                                    feature["properties"][key] = None
-                                elif isinstance(value,(int,float)):
-                                    # Check if it's a valid number
-                                    if math.isnan(value) or math.isinf(value):
-                                        print(f"Invalid numeric value in row {row_num}, key {key}: {value}")
-                                        feature["properties"][key] = None
-                                    else:
-                                        feature["properties"][key] = value
-                                else:
-                                    # String or other types
-                                    feature["properties"][key] = str(value) if value is not None else None
-
-                        # Final validation of the feature properties
-                        for key,value in feature["properties"].items():
-                            if isinstance(value,(int,float)) and (math.isnan(value) or math.isinf(value)):
-                                print(f"Invalid numeric value in properties, row {row_num}, key {key}: {value}")
-                                feature["properties"][key] = None
-
-                        # Add the feature to the collection
-                        geojson["features"].append(feature)
-
-                    except (ValueError,KeyError,TypeError) as e:
-                        print(f"Skipping row {row_num} due to error: {e}")
-                        print(f"Problematic row: store_code={row_dict.get('store_code')}")
+                # Add the features to the collection
+                geojson["features"].extend(metrics.convert(rows,sanitizer,first_row=row_num + 1))
+                row_num += len(rows)
 
         pg_conn.close()
         print(f"Database connection closed")
 
-    except psycopg2.Error as e:
+    except storage.DATABASE_ERRORS as e:
         print(f"Database error: {e}")
         sys.exit(1)
     except Exception as e:
         print(f"Unexpected error: {e}")
         sys.exit(1)
 
-    # Validate the entire GeoJSON before writing
-    try:
-        # This will fail if there are any NaN or invalid values
-        test_json = json.dumps(geojson)
-        print(f"GeoJSON validation successful")
-    except (TypeError,ValueError) as e:
-        print(f"ERROR: Invalid GeoJSON: {e}")
-        # Try to find and fix problematic features
-        valid_features = []
-        for i,feature in enumerate(geojson["features"]):
-            try:
-                json.dumps(feature)
-                valid_features.append(feature)
-            except (TypeError,ValueError) as e:
-                print(f"Problem in feature {i}: {e}")
-                # Try to fix the feature by cleaning properties
-                if "properties" in feature:
-                    cleaned_properties = {}
-                    for prop_key,prop_value in feature["properties"].items():
-                        try:
-                            json.dumps({prop_key: prop_value})
-                            cleaned_properties[prop_key] = prop_value
-                        except (TypeError,ValueError):
-                            print(f"Cleaning problematic property {prop_key}: {prop_value}")
-                            cleaned_properties[prop_key] = None
-                    feature["properties"] = cleaned_properties
-                    valid_features.append(feature)
-
-        geojson["features"] = valid_features
-
-    # Write the GeoJSON file
+    # Write the GeoJSON file; the strict encoder rejects NaN/Infinity instead of writing invalid JSON
     try:
-        with open(output_file,'w',encoding='utf-8') as f:
-            json.dump(geojson,f,ensure_ascii=False,indent=2)
+        with metrics.stage('write'):
+            with atomic_open(output_file,'w') as f:
+                json.dump(geojson,f,ensure_ascii=False,allow_nan=False,indent=2)
+        metrics.add_output(output_file)
+        metrics.print_skipped()
         print(f"Converted {len(geojson['features'])} features to GeoJSON")
         print(f"Output saved to {output_file}")
     except (TypeError,ValueError) as e:
@@ -180,6 +135,163 @@ def postgres_to_geojson(output_file,query=None):
         sys.exit(1)
 
 
+def postgres_to_geojson_stream(output_file,query=None,batch_size=1000,metrics=None):
+    """
+    Streaming variant of postgres_to_geojson for large result sets (e.g. item-level layers).
+    Rows are read from a named server-side cursor and every feature is written to the
+    output file as soon as it is built, so memory use stays flat regardless of row count.
+    The file is written to a temporary path and renamed into place when complete.
+
+    Parameters:
+    output_file (str): Path to write the GeoJSON output
+    query (str): SQL query to execute (optional, defaults to selecting from the store_price_comparisons_mv materialized view)
+    batch_size (int): Number of rows fetched from the server per round-trip
+    metrics (RunMetrics): Optional metrics of the run (stage timings, skipped and cleaned values)
+    """
+    metrics = metrics or RunMetrics('pg_to_geojson')
+
+    if query is None:
+        query = DEFAULT_QUERY
+
+    try:
+        print("Connecting to PostgreSQL database...")
+        with metrics.stage('connect'):
+            pg_conn = storage.connect()
+
+        try:
+            with stream_feature_collection(output_file) as writer:
+                # A named cursor keeps the result set on the server; rows are
+                # transferred batch_size at a time while iterating
+                with pg_conn.cursor(name='geojson_export') as pg_cursor:
+                    pg_cursor.itersize = batch_size
+                    print("Executing query...")
+                    with metrics.stage('query'):
+                        pg_cursor.execute(query)
+
+                    # Named cursors only expose description after the first fetch
+                    rows = metrics.timed_iter('fetch',pg_cursor)
+                    write_feature = metrics.timed('write',writer.write_feature)
+                    for feature in metrics.convert(rows,lambda: pg_sanitizer(pg_cursor.description)):
+                        write_feature(feature)
+        finally:
+            pg_conn.close()
+            print(f"Database connection closed")
+        metrics.add_output(output_file)
+
+        metrics.print_skipped()
+        print(f"Converted {writer.count} features to GeoJSON")
+        print(f"Output saved to {output_file}")
+
+    except storage.DATABASE_ERRORS as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        sys.exit(1)
+
+
+def postgres_to_geojson_copy(output_file,copy_format='binary',metrics=None):
+    """
+    Export store_price_comparisons_mv to GeoJSON using COPY ... TO STDOUT instead of a cursor.
+    The COPY stream is parsed straight into typed column arrays (see pg_copy.py), so no
+    per-row dicts are created, and features are streamed to the output file.
+
+    Parameters:
+    output_file (str): Path to write the GeoJSON output
+    copy_format (str): COPY format to use, 'binary' or 'csv'
+    metrics (RunMetrics): Optional metrics of the run (stage timings, skipped and cleaned values)
+    """
+    metrics = metrics or RunMetrics('pg_to_geojson')
+
+    try:
+        print("Connecting to PostgreSQL database...")
+        with metrics.stage('connect'):
+            pg_conn = storage.connect()
+
+        try:
+            with pg_conn.cursor() as pg_cursor:
+                print(f"Copying store_price_comparisons_mv ({copy_format})...")
+                # COPY runs the query and transfers the rows in one operation
+                with metrics.stage('fetch'):
+                    table = extract_store_price_comparisons(pg_cursor,copy_format)
+        finally:
+            pg_conn.close()
+            print(f"Database connection closed")
+
+        sanitizer = RowSanitizer(table.names,table.schema(),TYPED_CONVERTERS)
+        with stream_feature_collection(output_file) as writer:
+            write_feature = metrics.timed('write',writer.write_feature)
+            for feature in metrics.convert(table.rows(),sanitizer):
+                write_feature(feature)
+        metrics.add_output(output_file)
+
+        metrics.print_skipped()
+        print(f"Converted {writer.count} features to GeoJSON")
+        print(f"Output saved to {output_file}")
+
+    except storage.DATABASE_ERRORS as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        sys.exit(1)
+
+
+def postgres_to_geojson_parallel(output_file,connections=DEFAULT_POOL_SIZE,partition_by='store_code',batch_size=1000,metrics=None):
+    """
+    Export store_price_comparisons_mv to GeoJSON over several pooled connections at once.
+    The view is split into store_code ranges (or chains), each extracted on its own connection
+    (see pg_extract.PartitionedExtraction), and the features are streamed to the output file
+    in partition order. With store_code ranges the file is the same as the serial export;
+    with chains the stores are grouped by chain.
+
+    Parameters:
+    output_file (str): Path to write the GeoJSON output
+    connections (int): Number of connections, i.e. partitions extracted at once
+    partition_by (str): 'store_code' or 'chain'
+    batch_size (int): Number of rows fetched from the server per round-trip
+    metrics (RunMetrics): Optional metrics of the run (stage timings, skipped and cleaned values)
+    """
+    metrics = metrics or RunMetrics('pg_to_geojson')
+
+    try:
+        with metrics.stage('connect'):
+            pool = get_pool(connections)
+        try:
+            # A plain cursor: the partition bounds are not data rows and must not be counted
+            with metrics.stage('partitions'):
+                with pooled_connection(pool) as pg_conn:
+                    with pg_conn.cursor(cursor_factory=storage.cursor_class(pg_conn)) as pg_cursor:
+                        if partition_by == 'chain':
+                            partitions = chain_partitions(pg_cursor,source='public.store_price_comparisons_mv')
+                        else:
+                            partitions = store_code_partitions(pg_cursor,connections * PARTITIONS_PER_CONNECTION,
+                                                               source='public.store_price_comparisons_mv')
+            print(f"Extracting {len(partitions)} partitions by {partition_by} over {connections} connections...")
+
+            extraction = PartitionedExtraction(PARTITIONED_QUERY,(),partitions,connections,batch_size,pool)
+            with stream_feature_collection(output_file) as writer:
+                # fetch is the time spent waiting for the partitions' rows
+                rows = metrics.timed_iter('fetch',extraction)
+                write_feature = metrics.timed('write',writer.write_feature)
+                for feature in metrics.convert(rows,lambda: pg_sanitizer(extraction.description)):
+                    write_feature(feature)
+        finally:
+            close_pool()
+        metrics.add_output(output_file)
+
+        metrics.print_skipped()
+        print(f"Converted {writer.count} features to GeoJSON")
+        print(f"Output saved to {output_file}")
+
+    except storage.DATABASE_ERRORS as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        sys.exit(1)
+
+
 def get_connection_params_from_env():
     """
     DEPRECATED: Connection parameters are now handled by config.py
@@ -201,16 +313,46 @@ if __name__ == "__main__":
     # Path to write the GeoJSON output
     output_file = "data/stores.geojson"
 
-    try:
-        # Verify config is properly loaded
-        if not hasattr(config,'pg_config'):
-            print("ERROR: config.py does not contain 'pg_config' dictionary")
-            sys.exit(1)
+    # --metrics FILE sets the metrics file, --profile adds a cProfile dump
+    metrics,metrics_file = metrics_from_argv("pg_to_geojson",sys.argv)
 
-        print(f"Using database connection from config.py")
+    try:
+        print(f"Using {storage.describe_backend()}")
 
         # Convert PostgreSQL data to GeoJSON
-        postgres_to_geojson(output_file)
+        if "--stream" in sys.argv:
+            postgres_to_geojson_stream(output_file,metrics=metrics)
+        elif "--copy" in sys.argv:
+            postgres_to_geojson_copy(output_file,metrics=metrics)
+        elif "--parallel" in sys.argv:
+            # --parallel N [--by-chain]: extract N partitions at once over a connection pool
+            connections = int(sys.argv[sys.argv.index("--parallel") + 1])
+            postgres_to_geojson_parallel(output_file,connections,'chain' if "--by-chain" in sys.argv else 'store_code',
+                                         metrics=metrics)
+        else:
+            postgres_to_geojson(output_file,metrics=metrics)
+
+        # Add each store's nearest cheaper stores for the store-details panel
+        if "--neighbours" in sys.argv:
+            add_cheaper_neighbours_to_file(output_file)
+
+        manifest = None
+        if "--incremental" in sys.argv:
+            # The query result is only known after the export, so the output hash doubles
+            # as the source hash; the file is listed as changed only if its bytes differ
+            manifest = BuildManifest("data/build_manifest.json")
+            output_hash = hash_file(output_file)
+            manifest.record("stores_geojson",output_hash,{output_file: output_hash})
+
+        # Also write the zoom-level tile pyramid loaded by the map
+        if "--tiles" in sys.argv:
+            build_tile_pyramid(output_file,"data/tiles",manifest)
+
+        if manifest is not None:
+            manifest.save()
+            manifest.write_changed_list("data/changed_files.json")
+
+        metrics.save(metrics_file)
 
     except ImportError:
         print("ERROR: Could not import config.py. Make sure the file exists and contains pg_config dictionary.")
@@ -0,0 +1,460 @@
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED,ProcessPoolExecutor,wait
+
+from build_manifest import BuildManifest,hash_bytes,hash_file
+from geojson_stream import atomic_open,stream_feature_collection
+from run_metrics import RunMetrics
+from storage import connect,describe_backend
+from store_files_export import page_size_argument
+
+# Cached intermediate artifacts and the incremental state of the store files. Kept out of
+# data/ so serve.py never serves them.
+ARTIFACT_DIR = ".pipeline"
+STORE_FILES_MANIFEST = os.path.join(ARTIFACT_DIR,"store_files_manifest.json")
+
+# Output stages are recorded here as pipeline:<stage>, next to the entries of the other exports
+MANIFEST_FILE = "data/build_manifest.json"
+CHANGED_FILES = "data/changed_files.json"
+
+OUTPUT_FILES = {
+    'csv': "data/store_price_comparisons.csv",
+    'geojson': "data/stores.geojson",
+    'tiles': "data/tiles",
+    'summary': "data/store_price_comparisons.json",
+    'store_files': "data/store_files"
+}
+
+# Source CSV files read with --source (as written by synthetic_data.py)
+SOURCE_TABLES = {
+    'prices': 'allprices.csv',
+    'stores': 'all_stores.csv',
+    'items': 'items_new.csv'
+}
+
+# A stage of the build graph.
+# inputs: stages whose results it reads; params: options that change its result;
+# modules: modules whose code changes its result; artifact: the result is a cached
+# intermediate value (pickled to ARTIFACT_DIR) instead of files in data/
+Stage = namedtuple('Stage',['name','inputs','params','modules','function','artifact'])
+
+
+def _extract(options,inputs,metrics):
+    """Extract one upload date of allprices, all_stores and items_new, from the database (see storage.py) or --source CSVs"""
+    from pg_copy import (ALL_STORES_COLUMNS,ALLPRICES_COLUMNS,ITEMS_NEW_COLUMNS,extract_all_stores,
+                         extract_allprices,extract_items_new,load_csv_columns)
+
+    if options['source']:
+        columns = {'prices': ALLPRICES_COLUMNS,'stores': ALL_STORES_COLUMNS,'items': ITEMS_NEW_COLUMNS}
+        tables = {}
+        with metrics.stage('read'):
+            for table,file_name in SOURCE_TABLES.items():
+                tables[table] = load_csv_columns(os.path.join(options['source'],file_name),columns[table])
+        print(f"Read {len(tables['prices']):,} prices for {len(tables['stores']):,} stores from {options['source']}")
+        return tables
+
+    with metrics.stage('connect'):
+        pg_conn = connect()
+    try:
+        with pg_conn.cursor() as pg_cursor:
+            with metrics.stage('fetch'):
+                print(f"Copying allprices for {options['upload_date']}...")
+                prices = extract_allprices(pg_cursor,options['upload_date'])
+                print(f"Copying all_stores and items_new...")
+                stores = extract_all_stores(pg_cursor)
+                items = extract_items_new(pg_cursor)
+    finally:
+        pg_conn.close()
+    print(f"Extracted {len(prices):,} prices for {len(stores):,} stores")
+    return {'prices': prices,'stores': stores,'items': items}
+
+
+def _aggregate(options,inputs,metrics):
+    """Compute the store price comparison, as the store_price_comparisons view does"""
+    from price_aggregation import aggregate_prices,encode_price_data
+
+    tables = inputs['extract']
+    data = encode_price_data(tables['prices'],tables['stores'])
+    result = aggregate_prices(data,known_items=tables['items']['itemcode'])
+    metrics.count('rows',len(tables['prices']))
+    return result
+
+
+def _write_csv(options,inputs,metrics):
+    from price_aggregation import write_store_comparisons_csv
+
+    output_file = OUTPUT_FILES['csv']
+    write_store_comparisons_csv(inputs['aggregate'],output_file)
+    return [output_file]
+
+
+def _write_geojson(options,inputs,metrics):
+    from pg_copy import STORE_PRICE_COMPARISONS_COLUMNS
+    from row_sanitizer import TYPED_CONVERTERS,RowSanitizer
+
+    output_file = OUTPUT_FILES['geojson']
+    sanitizer = RowSanitizer([name for name,kind in STORE_PRICE_COMPARISONS_COLUMNS],
+                             dict(STORE_PRICE_COMPARISONS_COLUMNS),TYPED_CONVERTERS)
+    features = metrics.convert(inputs['aggregate'].store_rows(),sanitizer)
+    if options['neighbours'] or options['head_to_head'] or options['tiles']:
+        features = list(features)
+    if options['neighbours']:
+        from spatial_index import add_cheaper_neighbours
+
+        with metrics.stage('neighbours'):
+            add_cheaper_neighbours(features)
+    if options['head_to_head']:
+        from head_to_head import add_nearby_comparisons,store_prices_from_price_data
+
+        with metrics.stage('head_to_head'):
+            add_nearby_comparisons(features,store_prices_from_price_data(inputs['aggregate'].data))
+
+    with stream_feature_collection(output_file) as writer:
+        write_feature = metrics.timed('write',writer.write_feature)
+        for feature in features:
+            write_feature(feature)
+    metrics.print_skipped()
+    print(f"Wrote {writer.count} features to {output_file}")
+    files = [output_file]
+
+    if options['tiles']:
+        from tile_pyramid import write_tile_pyramid
+
+        with metrics.stage('tiles'):
+            tiles = write_tile_pyramid(features,OUTPUT_FILES['tiles'])
+        print(f"Wrote {len(tiles)} tile pyramid files to {OUTPUT_FILES['tiles']}")
+        files += list(tiles)
+    return files
+
+
+def _write_summary(options,inputs,metrics):
+    from store_files_export import store_price_rows,store_summaries,write_summary_file
+
+    output_file = OUTPUT_FILES['summary']
+    summaries = store_summaries(store_price_rows(inputs['aggregate'],inputs['extract']['items']))
+    write_summary_file(summaries,output_file)
+    print(f"Wrote {len(summaries)} store summaries to {output_file}")
+    return [output_file]
+
+
+def _write_store_files(options,inputs,metrics):
+    """Export the per-store files, rewriting only the stores whose prices changed"""
+    from store_files_export import export_store_files,store_price_rows
+
+    manifest = BuildManifest(STORE_FILES_MANIFEST)
+    rows = store_price_rows(inputs['aggregate'],inputs['extract']['items'])
+    export_store_files(
+        rows,
+        OUTPUT_FILES['store_files'],
+        workers=options['workers'],
+        manifest=manifest,
+        compact=options['compact'],
+        compress=options['compress'],
+        catalog=options['catalog'],
+        search_index=options['search_index'],
+        page_size=options['pages']
+    )
+    manifest.save()
+    # Every file written by the export, so the pipeline entry lists them all for deployment
+    return {
+        manifest.absolute(path): digest
+        for key in manifest.keys()
+        for path,digest in manifest.get(key)['files'].items()
+    }
+
+
+STAGES = [
+    Stage('extract',(),('upload_date','source'),('pg_copy',),_extract,True),
+    Stage('aggregate',('extract',),(),('price_aggregation',),_aggregate,True),
+    Stage('csv',('aggregate',),(),('price_aggregation','geojson_stream'),_write_csv,False),
+    Stage('geojson',('aggregate',),('neighbours','head_to_head','tiles'),
+          ('pg_copy','row_sanitizer','geojson_stream','spatial_index','head_to_head','price_matrix','tile_pyramid'),
+          _write_geojson,False),
+    Stage('summary',('extract','aggregate'),(),('store_files_export',),_write_summary,False),
+    Stage('store_files',('extract','aggregate'),('compact','compress','catalog','search_index','pages'),
+          ('store_files_export','search_index','build_manifest','geojson_stream'),_write_store_files,False)
+]
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+OUTPUT_STAGES = [stage.name for stage in STAGES if not stage.artifact]
+
+# Options of a run and their defaults
+DEFAULT_OPTIONS = {
+    'upload_date': None,
+    'source': None,
+    'neighbours': False,
+    'head_to_head': False,
+    'tiles': False,
+    'workers': None,
+    'compact': False,
+    'compress': False,
+    'catalog': False,
+    'search_index': False,
+    'pages': 0
+}
+
+
+def artifact_path(name):
+    return os.path.join(ARTIFACT_DIR,f"{name}.pickle")
+
+
+def _state_path(name):
+    return os.path.join(ARTIFACT_DIR,f"{name}.json")
+
+
+def load_artifact_state(name):
+    """Return the {fingerprint, content} of a stage's cached artifact, or None if it is missing"""
+    try:
+        with open(_state_path(name),'r',encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not os.path.exists(artifact_path(name)):
+        return None
+    return state
+
+
+def _module_hashes(modules):
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return {module: hash_file(os.path.join(base_dir,f"{module}.py")) for module in modules}
+
+
+def stage_fingerprint(stage,options,input_hashes):
+    """
+    Hash of everything a stage's result depends on: its parameters, its code and the
+    content of its inputs. A stage is skipped when its fingerprint matches the recorded one.
+
+    Parameters:
+    stage (Stage): Stage to fingerprint
+    options (dict): Options of the run
+    input_hashes (dict): Content hash of every finished input stage
+    """
+    params = {name: options[name] for name in stage.params}
+    if stage.name == 'extract' and options['source']:
+        # Source files can change in place, so their content counts instead of the path
+        params['source'] = {table: hash_file(os.path.join(options['source'],file_name))
+                            for table,file_name in SOURCE_TABLES.items()}
+    elif stage.name == 'extract':
+        params['database'] = describe_backend()
+    key = {
+        'stage': stage.name,
+        'params': params,
+        'code': _module_hashes(stage.modules),
+        'inputs': {name: input_hashes[name] for name in stage.inputs}
+    }
+    return hash_bytes(json.dumps(key,sort_keys=True).encode('utf-8'))
+
+
+def _run_stage(name,options):
+    """
+    Run one stage in a worker process, reading its inputs from their cached artifacts.
+    Returns (files or artifact hash, stage timings, counters, skipped rows).
+    """
+    stage = STAGES_BY_NAME[name]
+    metrics = RunMetrics(name)
+    inputs = {}
+    with metrics.stage('load'):
+        for input_name in stage.inputs:
+            with open(artifact_path(input_name),'rb') as f:
+                inputs[input_name] = pickle.load(f)
+
+    result = stage.function(options,inputs,metrics)
+
+    if stage.artifact:
+        with metrics.stage('save'):
+            with atomic_open(artifact_path(name),'wb') as f:
+                pickle.dump(result,f,protocol=pickle.HIGHEST_PROTOCOL)
+        output = hash_file(artifact_path(name))
+    elif isinstance(result,dict):
+        output = result
+    else:
+        output = {path: hash_file(path) for path in result}
+    return output,metrics.stages,dict(metrics.counters),metrics.skipped_examples
+
+
+def required_stages(targets):
+    """Return the targets and every stage they depend on, in STAGES order"""
+    required = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(STAGES_BY_NAME[name].inputs)
+    return [stage.name for stage in STAGES if stage.name in required]
+
+
+def remove_dropped_outputs(manifest,key,output):
+    """
+    Delete the files of the previous build of key that are not in output, e.g. the tile
+    pyramid after a build without --tiles, so the files on disk match the removed files in the
+    changed list. Directories left empty are removed too.
+
+    Parameters:
+    manifest (BuildManifest): Manifest holding the previous build
+    key (str): Build unit key
+    output (dict): Output path -> hash of the new build
+    """
+    entry = manifest.get(key)
+    if not entry:
+        return
+    kept = {manifest.relative(path) for path in output}
+    for path in entry['files']:
+        if path in kept:
+            continue
+        file_path = manifest.absolute(path)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        directory = os.path.dirname(file_path)
+        while directory != manifest.base_dir and os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+
+def run_pipeline(targets=None,options=None,force=(),jobs=None,metrics=None):
+    """
+    Build the output stages in targets and the stages they depend on. A stage runs once all
+    of its inputs are done; stages whose fingerprint (see stage_fingerprint) matches the
+    previous build are skipped, and independent stages run in parallel worker processes.
+    Intermediate results are cached in ARTIFACT_DIR, so the outputs can be regenerated from
+    them without querying PostgreSQL again.
+
+    Parameters:
+    targets (list): Output stages to build (defaults to all of OUTPUT_STAGES)
+    options (dict): Options of the run, see DEFAULT_OPTIONS
+    force (sequence): Stages to run even if they are up to date. Extraction by upload date
+                      assumes the database does not change for a date, so force 'extract'
+                      to read it again.
+    jobs (int): Number of stages run at once (defaults to the CPU count)
+    metrics (RunMetrics): Optional metrics of the run, with the stage timings of every worker
+
+    Returns the names of the stages that failed.
+    """
+    options = dict(DEFAULT_OPTIONS,**(options or {}))
+    metrics = metrics or RunMetrics('pipeline')
+    names = required_stages(targets or OUTPUT_STAGES)
+    if 'extract' in names and not options['source'] and not options['upload_date']:
+        raise ValueError("An upload date (or --source) is needed to extract the prices")
+
+    os.makedirs(ARTIFACT_DIR,exist_ok=True)
+    os.makedirs("data",exist_ok=True)
+    manifest = BuildManifest(MANIFEST_FILE)
+    input_hashes = {}
+    fingerprints = {}
+    failed = []
+    waiting = list(names)
+    running = {}
+
+    def is_current(stage,fingerprint):
+        if stage.artifact:
+            state = load_artifact_state(stage.name)
+            return state is not None and state['fingerprint'] == fingerprint
+        return manifest.is_current(f"pipeline:{stage.name}",fingerprint)
+
+    def finish(stage,output):
+        fingerprint = fingerprints[stage.name]
+        if stage.artifact:
+            with atomic_open(_state_path(stage.name),'w') as f:
+                json.dump({'fingerprint': fingerprint,'content': output},f,indent=2)
+            input_hashes[stage.name] = output
+        else:
+            remove_dropped_outputs(manifest,f"pipeline:{stage.name}",output)
+            manifest.record(f"pipeline:{stage.name}",fingerprint,output)
+            input_hashes[stage.name] = fingerprint
+            if stage.name != 'store_files':
+                for path in output:
+                    metrics.add_output(path)
+
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        while waiting or running:
+            for name in list(waiting):
+                stage = STAGES_BY_NAME[name]
+                if any(input_name in failed for input_name in stage.inputs):
+                    print(f"Skipping {name}: an input stage failed")
+                    waiting.remove(name)
+                    failed.append(name)
+                elif all(input_name in input_hashes for input_name in stage.inputs):
+                    waiting.remove(name)
+                    fingerprints[name] = stage_fingerprint(stage,options,input_hashes)
+                    if name not in force and is_current(stage,fingerprints[name]):
+                        print(f"{name}: up to date")
+                        metrics.count('stages_skipped')
+                        input_hashes[name] = load_artifact_state(name)['content'] if stage.artifact else fingerprints[name]
+                    else:
+                        print(f"{name}: running...")
+                        running[pool.submit(_run_stage,name,options)] = (name,time.perf_counter())
+
+            if not running:
+                continue
+            done,_ = wait(running,return_when=FIRST_COMPLETED)
+            for future in done:
+                name,started = running.pop(future)
+                stage = STAGES_BY_NAME[name]
+                try:
+                    output,stages,counters,skipped = future.result()
+                except Exception as e:
+                    print(f"{name}: failed: {e}")
+                    failed.append(name)
+                    continue
+                seconds = time.perf_counter() - started
+                metrics.add_time(name,seconds)
+                metrics.merge({f"{name}.{key}": timing for key,timing in stages.items()},counters,skipped)
+                metrics.count('stages_run')
+                finish(stage,output)
+                print(f"{name}: done in {seconds:.1f}s")
+
+    manifest.save()
+    manifest.write_changed_list(CHANGED_FILES)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the site data: extract -> aggregate -> CSV, GeoJSON, summary and store files")
+    parser.add_argument("upload_date",nargs='?',default=None,help="Upload date to build (YYYY-MM-DD)")
+    parser.add_argument("--source",default=None,metavar="DIR",
+                        help="Read allprices.csv, all_stores.csv and items_new.csv from DIR instead of PostgreSQL")
+    parser.add_argument("--only",nargs='+',choices=OUTPUT_STAGES,default=None,help="Output stages to build (default all)")
+    parser.add_argument("--force",nargs='*',choices=[stage.name for stage in STAGES],default=None,
+                        help="Run these stages (all if none given) even if they are up to date")
+    parser.add_argument("--jobs",type=int,default=None,help="Number of stages run at once")
+    parser.add_argument("--workers",type=int,default=None,help="Worker processes of the store files export")
+    parser.add_argument("--neighbours",action="store_true",help="Add each store's nearest cheaper stores to the GeoJSON")
+    parser.add_argument("--head-to-head",action="store_true",
+                        help="Add each store's price comparison with its nearest stores to the GeoJSON")
+    parser.add_argument("--tiles",action="store_true",help="Also write the data/tiles/ tile pyramid")
+    parser.add_argument("--compact",action="store_true",help="Write minified columnar store files")
+    parser.add_argument("--compress",action="store_true",help="Also write pre-compressed .gz/.br store files")
+    parser.add_argument("--catalog",action="store_true",help="Write item descriptions once to a shared items catalog")
+    parser.add_argument("--search-index",action="store_true",help="Also write the store files search indexes")
+    parser.add_argument("--pages",type=page_size_argument,default=0,metavar="SIZE",help="Also write the store files in pages of SIZE items")
+    parser.add_argument("--metrics",default=None,metavar="FILE",help="Metrics file (default diagnostics/metrics/)")
+    parser.add_argument("--profile",action="store_true",help="Also write a cProfile dump next to the metrics file")
+    args = parser.parse_args()
+
+    force = [stage.name for stage in STAGES] if args.force == [] else (args.force or [])
+    options = {
+        'upload_date': args.upload_date,
+        'source': args.source,
+        'neighbours': args.neighbours,
+        'head_to_head': args.head_to_head,
+        'tiles': args.tiles,
+        'workers': args.workers,
+        'compact': args.compact,
+        'compress': args.compress,
+        'catalog': args.catalog,
+        'search_index': args.search_index,
+        'pages': args.pages
+    }
+    metrics = RunMetrics('pipeline',profile=args.profile)
+    try:
+        failed = run_pipeline(args.only,options,force,args.jobs,metrics)
+    except ValueError as e:
+        parser.error(str(e))
+    metrics.save(args.metrics)
+    if failed:
+        print(f"Failed stages: {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,280 @@
+import argparse
+import csv
+
+import numpy as np
+
+from geojson_stream import atomic_open
+from pg_copy import STORE_PRICE_COMPARISONS_COLUMNS,extract_all_stores,extract_allprices
+
+# Chains and sub-chains left out of the comparison, as in the store_price_comparisons view
+EXCLUDED_CHAINS = ('סופר פארם','Yellow','דור אלון')
+EXCLUDED_SUBCHAINS = ('Be','אונליין')
+
+# An item is popular if it is sold in more than this many stores (the view uses 10)
+DEFAULT_POPULARITY_THRESHOLD = 10
+
+
+class PriceData:
+    """
+    One upload_date of prices with stores and items encoded as integer IDs, ready for
+    grouped reductions. Built once by encode_price_data and reused across aggregations.
+
+    Attributes:
+    stores: all_stores ColumnTable; store IDs are row indexes into it
+    store_ids (ndarray): Store ID of every price row (-1 if the store is unknown)
+    itemcodes (ndarray): Sorted distinct item codes; item IDs are indexes into it
+    item_ids (ndarray): Item ID of every price row
+    prices (ndarray): itemprice of every price row (NaN for NULL)
+    """
+
+    def __init__(self,stores,store_ids,itemcodes,item_ids,prices):
+        self.stores = stores
+        self.store_ids = store_ids
+        self.itemcodes = itemcodes
+        self.item_ids = item_ids
+        self.prices = prices
+
+    @property
+    def store_count(self):
+        return len(self.stores)
+
+    @property
+    def item_count(self):
+        return len(self.itemcodes)
+
+
+class AggregationResult:
+    """
+    Result of aggregate_prices.
+
+    Attributes:
+    data (PriceData): Input the result was computed from
+    item_store_counts (ndarray): Distinct eligible stores per item ID
+    popular (ndarray): Boolean mask of popular item IDs
+    average_prices (ndarray): Average eligible price per item ID (NaN if not popular)
+    row_mask (ndarray): Boolean mask of the price rows used in the comparison
+    price_diff_pct (ndarray): Per-row price difference from the item average in percent
+                              (NaN outside row_mask)
+    store_average_diff (ndarray): Mean price_diff_pct per store ID (NaN if no popular items)
+    store_popular_counts (ndarray): Number of popular-item prices per store ID
+    """
+
+    def __init__(self,data,item_store_counts,popular,average_prices,row_mask,price_diff_pct,
+                 store_average_diff,store_popular_counts):
+        self.data = data
+        self.item_store_counts = item_store_counts
+        self.popular = popular
+        self.average_prices = average_prices
+        self.row_mask = row_mask
+        self.price_diff_pct = price_diff_pct
+        self.store_average_diff = store_average_diff
+        self.store_popular_counts = store_popular_counts
+
+    @property
+    def popular_itemcodes(self):
+        return self.data.itemcodes[self.popular]
+
+    def store_rows(self):
+        """
+        Yield one row per compared store in STORE_PRICE_COMPARISONS_COLUMNS order,
+        matching the rows of the store_price_comparisons view.
+        """
+        stores = self.data.stores
+        for store_id in np.flatnonzero(self.store_popular_counts):
+            yield (
+                stores['store_code'][store_id],
+                stores['storename'][store_id],
+                stores['chainname'][store_id],
+                stores['subchainname'][store_id],
+                None if store_id in stores.int_nulls['storeid'] else stores['storeid'][store_id],
+                stores['address'][store_id],
+                stores['city'][store_id],
+                stores['zipcode'][store_id],
+                stores['latitude'][store_id],
+                stores['longitude'][store_id],
+                float(self.store_average_diff[store_id]),
+                int(self.store_popular_counts[store_id])
+            )
+
+
+def _sorted_unique(values):
+    """Sorted distinct values of an integer array (sort-based; faster than np.unique here)"""
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    return values[np.concatenate(([True],values[1:] != values[:-1]))]
+
+
+def encode_price_data(prices,stores):
+    """
+    Integer-encode the stores and items of one upload_date of prices.
+
+    Parameters:
+    prices: ColumnTable with store_code, itemcode and itemprice (see pg_copy.extract_allprices)
+    stores: ColumnTable of all_stores (see pg_copy.extract_all_stores)
+    """
+    store_index = {code: index for index,code in enumerate(stores['store_code'])}
+    store_ids = np.array([store_index.get(code,-1) for code in prices['store_code']],dtype=np.int64)
+
+    raw_itemcodes = np.frombuffer(prices['itemcode'],dtype=np.int64)
+    itemcodes = _sorted_unique(raw_itemcodes)
+    item_ids = np.searchsorted(itemcodes,raw_itemcodes)
+    price_values = np.frombuffer(prices['itemprice'],dtype=np.float64)
+    return PriceData(stores,store_ids,itemcodes,item_ids,price_values)
+
+
+def eligible_stores(stores,excluded_chains=EXCLUDED_CHAINS,excluded_subchains=EXCLUDED_SUBCHAINS):
+    """
+    Boolean mask of the stores included in the comparison.
+    Stores with a NULL chainname or subchainname are excluded, as the view's <> filters do.
+    """
+    excluded_chains = set(excluded_chains)
+    excluded_subchains = set(excluded_subchains)
+    return np.array([
+        chainname is not None and subchainname is not None
+        and chainname not in excluded_chains and subchainname not in excluded_subchains
+        for chainname,subchainname in zip(stores['chainname'],stores['subchainname'])
+    ],dtype=bool)
+
+
+def aggregate_prices(data,popularity_threshold=DEFAULT_POPULARITY_THRESHOLD,
+                     excluded_chains=EXCLUDED_CHAINS,excluded_subchains=EXCLUDED_SUBCHAINS,known_items=None):
+    """
+    Compute popular items, their average prices, per-row price differences and per-store
+    average differences with grouped reductions, as the store_price_comparisons view does.
+
+    Parameters:
+    data (PriceData): Encoded prices from encode_price_data
+    popularity_threshold (int): An item is popular if sold in more than this many stores
+    excluded_chains (sequence): Chain names left out of the comparison
+    excluded_subchains (sequence): Sub-chain names left out of the comparison
+    known_items (sequence): Optional item codes present in items_new; other items are never popular
+    """
+    store_ok = eligible_stores(data.stores,excluded_chains,excluded_subchains)
+    known_store = data.store_ids >= 0
+    row_mask = known_store & (data.prices > 0)
+    row_mask[known_store] &= store_ok[data.store_ids[known_store]]
+
+    item_ids = data.item_ids[row_mask]
+    store_ids = data.store_ids[row_mask]
+    prices = data.prices[row_mask]
+
+    # Distinct stores per item: count unique (item, store) pairs
+    pairs = _sorted_unique(item_ids * data.store_count + store_ids)
+    item_store_counts = np.bincount(pairs // data.store_count,minlength=data.item_count)
+
+    popular = item_store_counts > popularity_threshold
+    if known_items is not None:
+        popular &= np.isin(data.itemcodes,np.asarray(known_items,dtype=np.int64))
+
+    sums = np.bincount(item_ids,weights=prices,minlength=data.item_count)
+    counts = np.bincount(item_ids,minlength=data.item_count)
+    average_prices = np.full(data.item_count,np.nan)
+    average_prices[popular] = sums[popular] / counts[popular]
+
+    # Per-row differences for popular items only
+    popular_rows = popular[item_ids]
+    row_average = average_prices[item_ids[popular_rows]]
+    row_diff = (prices[popular_rows] - row_average) / row_average * 100
+
+    price_diff_pct = np.full(len(data.prices),np.nan)
+    row_positions = np.flatnonzero(row_mask)[popular_rows]
+    price_diff_pct[row_positions] = row_diff
+    row_mask = np.zeros(len(data.prices),dtype=bool)
+    row_mask[row_positions] = True
+
+    diff_store_ids = store_ids[popular_rows]
+    store_popular_counts = np.bincount(diff_store_ids,minlength=data.store_count)
+    store_diff_sums = np.bincount(diff_store_ids,weights=row_diff,minlength=data.store_count)
+    store_average_diff = np.full(data.store_count,np.nan)
+    compared = store_popular_counts > 0
+    store_average_diff[compared] = store_diff_sums[compared] / store_popular_counts[compared]
+
+    return AggregationResult(data,item_store_counts,popular,average_prices,row_mask,price_diff_pct,
+                             store_average_diff,store_popular_counts)
+
+
+def load_price_data(pg_cursor,upload_date):
+    """
+    Load one upload_date of allprices and all_stores with COPY and encode them.
+
+    Parameters:
+    pg_cursor: psycopg2 cursor
+    upload_date (str): Upload date to load (YYYY-MM-DD)
+    """
+    print(f"Copying allprices for {upload_date}...")
+    prices = extract_allprices(pg_cursor,upload_date)
+    print(f"Copying all_stores...")
+    stores = extract_all_stores(pg_cursor)
+    print(f"Loaded {len(prices):,} prices for {len(stores):,} stores")
+    return encode_price_data(prices,stores)
+
+
+def load_known_items(pg_cursor):
+    """Return the item codes in items_new"""
+    pg_cursor.execute("SELECT itemcode FROM items_new;")
+    return np.fromiter((row[0] for row in pg_cursor),dtype=np.int64)
+
+
+def write_store_comparisons_csv(result,output_file):
+    """
+    Write the per-store comparison in the store_price_comparisons.csv format read by csv_to_geojson.
+
+    Parameters:
+    result (AggregationResult): Aggregation to write
+    output_file (str): Path of the CSV file
+    """
+    with atomic_open(output_file,'w') as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name,kind in STORE_PRICE_COMPARISONS_COLUMNS])
+        count = 0
+        for row in result.store_rows():
+            writer.writerow(['' if value is None else value for value in row])
+            count += 1
+    print(f"Wrote {count} store comparisons to {output_file}")
+
+
+def print_summary(result,popularity_threshold):
+    compared = int(np.count_nonzero(result.store_popular_counts))
+    print(f"Popular items (>{popularity_threshold} stores): {int(np.count_nonzero(result.popular)):,}")
+    print(f"Store-item combinations with valid price differences: {int(np.count_nonzero(result.row_mask)):,}")
+    print(f"Stores compared: {compared:,}")
+
+
+if __name__ == "__main__":
+    import time
+
+    import storage
+
+    parser = argparse.ArgumentParser(description="Compute the store price comparison in Python")
+    parser.add_argument("upload_date",help="Upload date to aggregate (YYYY-MM-DD)")
+    parser.add_argument("--threshold",type=int,nargs='+',default=[DEFAULT_POPULARITY_THRESHOLD],
+                        help="Popularity threshold(s) to compute, e.g. --threshold 10 5")
+    parser.add_argument("--exclude-chain",action='append',default=None,help="Chain to exclude (repeatable)")
+    parser.add_argument("--exclude-subchain",action='append',default=None,help="Sub-chain to exclude (repeatable)")
+    parser.add_argument("--csv",default=None,help="Write the comparison for the first threshold to this CSV file")
+    args = parser.parse_args()
+
+    excluded_chains = args.exclude_chain if args.exclude_chain is not None else EXCLUDED_CHAINS
+    excluded_subchains = args.exclude_subchain if args.exclude_subchain is not None else EXCLUDED_SUBCHAINS
+
+    print(f"Connecting to the {storage.describe_backend()}...")
+    pg_conn = storage.connect()
+    try:
+        with pg_conn.cursor() as pg_cursor:
+            data = load_price_data(pg_cursor,args.upload_date)
+            known_items = load_known_items(pg_cursor)
+    finally:
+        pg_conn.close()
+        print(f"Database connection closed")
+
+    results = []
+    for threshold in args.threshold:
+        start = time.perf_counter()
+        result = aggregate_prices(data,threshold,excluded_chains,excluded_subchains,known_items)
+        print(f"\nThreshold {threshold} ({time.perf_counter() - start:.2f}s)")
+        print_summary(result,threshold)
+        results.append(result)
+
+    if args.csv:
+        write_store_comparisons_csv(results[0],args.csv)
@@ -0,0 +1,426 @@
+import argparse
+import json
+import os
+import shutil
+from datetime import date as Date
+
+import numpy as np
+
+from geojson_stream import atomic_open
+
+HISTORY_VERSION = 1
+
+CATALOG_FILE = "catalog.json"
+
+# A full snapshot is written every this many partitions, so reconstructing a date never
+# has to apply more than this many deltas
+DEFAULT_CHECKPOINT_INTERVAL = 14
+
+# Item codes in order of first appearance; item ids are indexes into this array
+ITEMS_FILE = "items.npy"
+
+# Prices are keyed by item id << STORE_BITS | store id, so sorting keys orders entries by
+# item, then store. Item codes themselves are too wide (and may be negative) to pack.
+STORE_BITS = 20
+STORE_MASK = (1 << STORE_BITS) - 1
+
+PARTITION_FILES = ('item_ids','item_indptr','store_ids','prices')
+
+
+def _keys(item_ids,store_ids):
+    return (np.asarray(item_ids,dtype=np.int64) << STORE_BITS) | np.asarray(store_ids,dtype=np.int64)
+
+
+def _sorted_entries(keys,prices):
+    """Sort entries by key and keep the last price of repeated keys"""
+    order = np.argsort(keys,kind='stable')
+    keys = keys[order]
+    prices = prices[order]
+    keep = np.ones(len(keys),dtype=bool)
+    keep[:-1] = keys[1:] != keys[:-1]
+    return keys[keep],prices[keep]
+
+
+def diff_entries(old_keys,old_prices,new_keys,new_prices):
+    """
+    Return the (keys, prices) turning the sorted old entries into the sorted new entries:
+    added and changed prices, and NaN for removed keys.
+    """
+    position = np.searchsorted(old_keys,new_keys)
+    in_old = position < len(old_keys)
+    in_old[in_old] = old_keys[position[in_old]] == new_keys[in_old]
+    changed = ~in_old
+    changed[in_old] = old_prices[position[in_old]] != new_prices[in_old]
+
+    removed = np.ones(len(old_keys),dtype=bool)
+    removed[position[in_old]] = False
+
+    keys = np.concatenate((new_keys[changed],old_keys[removed]))
+    prices = np.concatenate((new_prices[changed],np.full(int(removed.sum()),np.nan,dtype=np.float32)))
+    order = np.argsort(keys,kind='stable')
+    return keys[order],prices[order]
+
+
+def apply_entries(keys,prices,delta_keys,delta_prices):
+    """Apply a delta (see diff_entries) to sorted entries and return the new sorted entries"""
+    keep = ~np.isin(keys,delta_keys,assume_unique=True)
+    present = ~np.isnan(delta_prices)
+    keys = np.concatenate((keys[keep],delta_keys[present]))
+    prices = np.concatenate((prices[keep],delta_prices[present]))
+    order = np.argsort(keys,kind='stable')
+    return keys[order],prices[order]
+
+
+class PriceHistory:
+    """
+    Append-only, date-partitioned price history.
+
+    Each upload date is one partition directory holding its entries as .npy files, sorted by
+    item then store, with an item index (item_ids + item_indptr). Most partitions
+    are deltas: only the prices that changed, appeared or disappeared (NaN) since the previous
+    date. Every checkpoint_interval partitions a full snapshot is written instead, so a date is
+    reconstructed from the nearest snapshot plus a bounded number of deltas. An item's price
+    series only reads that item's slice of each partition.
+
+    catalog.json lists the partitions, the store codes (store ids are indexes into that list)
+    and the number of item ids in items.npy. Both are append-only and rewritten after a
+    partition is complete, so readers never see a partial one.
+
+    Parameters:
+    history_dir (str): Directory of the history
+    checkpoint_interval (int): Partitions between full snapshots (for new histories)
+    """
+
+    def __init__(self,history_dir,checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.history_dir = history_dir
+        catalog_file = os.path.join(history_dir,CATALOG_FILE)
+        if os.path.exists(catalog_file):
+            with open(catalog_file,'r',encoding='utf-8') as f:
+                catalog = json.load(f)
+            if catalog.get('version') != HISTORY_VERSION:
+                raise ValueError(f"Unsupported price history version {catalog.get('version')} in {history_dir}")
+        else:
+            catalog = {
+                'version': HISTORY_VERSION,
+                'checkpoint_interval': checkpoint_interval,
+                'stores': [],
+                'item_count': 0,
+                'partitions': []
+            }
+        self.catalog = catalog
+        self.store_codes = catalog['stores']
+        self.store_index = {code: index for index,code in enumerate(self.store_codes)}
+        items_file = os.path.join(history_dir,ITEMS_FILE)
+        if catalog['item_count']:
+            self.itemcodes = np.load(items_file,allow_pickle=False)[:catalog['item_count']]
+        else:
+            self.itemcodes = np.empty(0,dtype=np.int64)
+        self.item_index = {itemcode: index for index,itemcode in enumerate(self.itemcodes.tolist())}
+        self._partitions = {}
+
+    @property
+    def partitions(self):
+        return self.catalog['partitions']
+
+    @property
+    def dates(self):
+        return [partition['date'] for partition in self.partitions]
+
+    def _save_catalog(self):
+        os.makedirs(self.history_dir,exist_ok=True)
+        with atomic_open(os.path.join(self.history_dir,CATALOG_FILE),'w') as f:
+            json.dump(self.catalog,f,ensure_ascii=False,indent=1)
+
+    def _load_partition(self,partition):
+        """Memory-map the arrays of a partition"""
+        name = partition['date']
+        if name not in self._partitions:
+            directory = os.path.join(self.history_dir,name)
+            self._partitions[name] = {
+                array: np.load(os.path.join(directory,f"{array}.npy"),mmap_mode='r',allow_pickle=False)
+                for array in PARTITION_FILES
+            }
+        return self._partitions[name]
+
+    def _partition_entries(self,partition):
+        arrays = self._load_partition(partition)
+        item_ids = np.repeat(np.asarray(arrays['item_ids']),np.diff(arrays['item_indptr']))
+        return _keys(item_ids,arrays['store_ids']),np.asarray(arrays['prices'])
+
+    def _partitions_until(self,date):
+        """Partitions needed to reconstruct date: the last snapshot at or before it and the deltas after it"""
+        date = str(date)
+        selected = [partition for partition in self.partitions if partition['date'] <= date]
+        if not selected:
+            raise KeyError(f"No price history at or before {date}")
+        start = max(index for index,partition in enumerate(selected) if partition['kind'] == 'full')
+        return selected[start:]
+
+    def snapshot(self,date):
+        """Return the sorted (keys, prices) of every price at a date (see key_columns)"""
+        keys = np.empty(0,dtype=np.int64)
+        prices = np.empty(0,dtype=np.float32)
+        for partition in self._partitions_until(date):
+            partition_keys,partition_prices = self._partition_entries(partition)
+            if partition['kind'] == 'full':
+                keys,prices = partition_keys,partition_prices
+            else:
+                keys,prices = apply_entries(keys,prices,partition_keys,partition_prices)
+        return keys,prices
+
+    def store_prices(self,store_code,date):
+        """
+        Return the (itemcodes, prices) of a store at a date, ordered by itemcode.
+        Only the snapshot and delta entries of that store are applied.
+        """
+        store_id = self.store_index[store_code]
+        prices = {}
+        for partition in self._partitions_until(date):
+            arrays = self._load_partition(partition)
+            rows = np.flatnonzero(np.asarray(arrays['store_ids']) == store_id)
+            item_ids = np.asarray(arrays['item_ids'])[np.searchsorted(arrays['item_indptr'],rows,side='right') - 1]
+            if partition['kind'] == 'full':
+                prices = {}
+            for itemcode,price in zip(self.itemcodes[item_ids].tolist(),np.asarray(arrays['prices'])[rows].tolist()):
+                if price != price:
+                    prices.pop(itemcode,None)
+                else:
+                    prices[itemcode] = price
+        itemcodes = np.array(sorted(prices),dtype=np.int64)
+        return itemcodes,np.array([prices[itemcode] for itemcode in itemcodes.tolist()],dtype=np.float32)
+
+    def key_columns(self,keys):
+        """Split snapshot keys into (store_codes, itemcodes) arrays"""
+        store_codes = np.array(self.store_codes,dtype=object)[keys & STORE_MASK]
+        return store_codes,self.itemcodes[keys >> STORE_BITS]
+
+    def _item_slice(self,partition,item_id):
+        arrays = self._load_partition(partition)
+        item_ids = arrays['item_ids']
+        index = int(np.searchsorted(item_ids,item_id))
+        if index >= len(item_ids) or item_ids[index] != item_id:
+            return None
+        start,end = arrays['item_indptr'][index],arrays['item_indptr'][index + 1]
+        return np.asarray(arrays['store_ids'][start:end]),np.asarray(arrays['prices'][start:end])
+
+    def item_series(self,itemcode,store_codes=None,start=None,end=None):
+        """
+        Return the price changes of an item as {store_code: [(date, price), ...]}, where price
+        is None from the date a store stopped selling the item.
+
+        Parameters:
+        itemcode (int): Item code
+        store_codes (iterable): Optional stores to include
+        start, end (str): Optional date range (inclusive); prices at start are included
+        """
+        item_id = self.item_index.get(itemcode)
+        if item_id is None:
+            return {}
+        wanted = None
+        if store_codes is not None:
+            wanted = {self.store_index[code] for code in store_codes if code in self.store_index}
+        partitions = self.partitions
+        if start is not None:
+            start = str(start)
+            # Begin at the snapshot in effect at the start of the range
+            snapshots = [p['date'] for p in partitions if p['kind'] == 'full' and p['date'] <= start]
+            if snapshots:
+                partitions = [p for p in partitions if p['date'] >= snapshots[-1]]
+        if end is not None:
+            partitions = [partition for partition in partitions if partition['date'] <= str(end)]
+
+        current = {}
+        series = {}
+        started = start is None
+
+        def change(store_id,day,price):
+            if current.get(store_id) == price:
+                return
+            current[store_id] = price
+            if started or day >= start:
+                series.setdefault(self.store_codes[store_id],[]).append((day,price))
+
+        def report_start():
+            # Prices in effect at the start of the range are reported on the start date
+            for store_id,price in current.items():
+                code = self.store_codes[store_id]
+                if price is not None and code not in series:
+                    series[code] = [(start,price)]
+
+        for partition in partitions:
+            day = partition['date']
+            if not started and day > start:
+                report_start()
+                started = True
+            entries = self._item_slice(partition,item_id)
+            store_ids,prices = entries if entries is not None else (np.empty(0),np.empty(0))
+            seen = set()
+            for store_id,price in zip(store_ids.tolist(),prices.tolist()):
+                if wanted is not None and store_id not in wanted:
+                    continue
+                seen.add(store_id)
+                change(store_id,day,None if price != price else price)
+            if partition['kind'] == 'full':
+                # A snapshot lists every price; stores missing from it no longer sell the item
+                for store_id in [store_id for store_id,price in current.items() if price is not None]:
+                    if store_id not in seen:
+                        change(store_id,day,None)
+
+        if not started:
+            report_start()
+        return series
+
+    def append(self,date,store_codes,itemcodes,prices):
+        """
+        Append the prices of a new upload date, after every existing partition.
+
+        Parameters:
+        date (str or date): Upload date (YYYY-MM-DD)
+        store_codes (sequence): Store code of every price
+        itemcodes (sequence): Item code of every price
+        prices (sequence): Prices (NaN or None entries are treated as missing)
+        """
+        date = str(date)
+        Date.fromisoformat(date)
+        if self.partitions and date <= self.partitions[-1]['date']:
+            raise ValueError(f"Partitions are append-only: {date} is not after {self.partitions[-1]['date']}")
+        if len(store_codes) != len(itemcodes) or len(itemcodes) != len(prices):
+            raise ValueError("store_codes, itemcodes and prices must have the same length")
+
+        for code in dict.fromkeys(store_codes):
+            if code not in self.store_index:
+                self.store_index[code] = len(self.store_codes)
+                self.store_codes.append(code)
+        if len(self.store_codes) > STORE_MASK:
+            raise ValueError(f"Too many stores for the price history key ({len(self.store_codes)})")
+
+        itemcodes = np.asarray(itemcodes,dtype=np.int64)
+        new_items = [itemcode for itemcode in np.unique(itemcodes).tolist() if itemcode not in self.item_index]
+        for itemcode in new_items:
+            self.item_index[itemcode] = len(self.item_index)
+        self.itemcodes = np.concatenate((self.itemcodes,np.array(new_items,dtype=np.int64)))
+
+        store_ids = np.array([self.store_index[code] for code in store_codes],dtype=np.int64)
+        item_ids = np.array([self.item_index[itemcode] for itemcode in itemcodes.tolist()],dtype=np.int64)
+        prices = np.asarray(prices,dtype=np.float32)
+        present = ~np.isnan(prices)
+        keys,prices = _sorted_entries(_keys(item_ids[present],store_ids[present]),prices[present])
+
+        since_snapshot = 0
+        for partition in reversed(self.partitions):
+            if partition['kind'] == 'full':
+                break
+            since_snapshot += 1
+        if not self.partitions or since_snapshot + 1 >= self.catalog['checkpoint_interval']:
+            kind = 'full'
+            entry_keys,entry_prices = keys,prices
+        else:
+            kind = 'delta'
+            entry_keys,entry_prices = diff_entries(*self.snapshot(self.partitions[-1]['date']),keys,prices)
+
+        self._write_partition(date,entry_keys,entry_prices)
+        if new_items:
+            with atomic_open(os.path.join(self.history_dir,ITEMS_FILE),'wb') as f:
+                np.save(f,self.itemcodes,allow_pickle=False)
+        self.catalog['item_count'] = len(self.itemcodes)
+        self.partitions.append({'date': date,'kind': kind,'entries': len(entry_keys),'prices': len(keys)})
+        self._save_catalog()
+        print(f"Appended {date} as a {kind} partition: {len(entry_keys):,} entries for {len(keys):,} prices")
+
+    def _write_partition(self,date,keys,prices):
+        directory = os.path.join(self.history_dir,date)
+        # A leftover directory is from an append that failed before the catalog was updated
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+
+        item_ids = keys >> STORE_BITS
+        unique_item_ids = np.unique(item_ids)
+        item_indptr = np.zeros(len(unique_item_ids) + 1,dtype=np.int64)
+        item_indptr[1:] = np.searchsorted(item_ids,unique_item_ids,side='right')
+        arrays = {
+            'item_ids': unique_item_ids,
+            'item_indptr': item_indptr,
+            'store_ids': (keys & STORE_MASK).astype(np.int32),
+            'prices': prices.astype(np.float32)
+        }
+        for name in PARTITION_FILES:
+            with atomic_open(os.path.join(directory,f"{name}.npy"),'wb') as f:
+                np.save(f,arrays[name],allow_pickle=False)
+
+    def append_price_matrix(self,date,matrix):
+        """Append the prices of a price_matrix.PriceMatrix as the given date"""
+        store_codes = np.repeat(np.array(matrix.store_codes,dtype=object),np.diff(matrix.row_indptr))
+        itemcodes = np.asarray(matrix.itemcodes)[np.asarray(matrix.row_items)]
+        self.append(date,store_codes,itemcodes,np.asarray(matrix.row_prices))
+
+    def append_price_data(self,date,data):
+        """Append one upload_date loaded with price_aggregation.load_price_data"""
+        known = data.store_ids >= 0
+        store_codes = np.array(data.stores['store_code'],dtype=object)[data.store_ids[known]]
+        self.append(date,store_codes,data.itemcodes[data.item_ids[known]],data.prices[known])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Date-partitioned price history")
+    parser.add_argument("--history",default="data/price_history",help="History directory")
+    subparsers = parser.add_subparsers(dest="command",required=True)
+
+    append_parser = subparsers.add_parser("append",help="Append an upload date")
+    append_parser.add_argument("date",help="Upload date (YYYY-MM-DD)")
+    append_parser.add_argument("--matrix",default=None,help="Read the prices from this price matrix instead of PostgreSQL")
+    append_parser.add_argument("--checkpoint-interval",type=int,default=DEFAULT_CHECKPOINT_INTERVAL,
+                               help="Partitions between full snapshots (new histories only)")
+
+    store_parser = subparsers.add_parser("store",help="Print a store's prices at a date")
+    store_parser.add_argument("store_code")
+    store_parser.add_argument("date")
+
+    item_parser = subparsers.add_parser("item",help="Print an item's price changes")
+    item_parser.add_argument("itemcode",type=int)
+    item_parser.add_argument("--store",action='append',default=None,help="Only this store (repeatable)")
+    item_parser.add_argument("--start",default=None)
+    item_parser.add_argument("--end",default=None)
+
+    subparsers.add_parser("status",help="List the partitions")
+    args = parser.parse_args()
+
+    if args.command == "append":
+        history = PriceHistory(args.history,args.checkpoint_interval)
+        if args.matrix:
+            from price_matrix import PriceMatrix
+            history.append_price_matrix(args.date,PriceMatrix(args.matrix))
+        else:
+            import storage
+            from price_aggregation import load_price_data
+
+            print(f"Connecting to the {storage.describe_backend()}...")
+            pg_conn = storage.connect()
+            try:
+                with pg_conn.cursor() as pg_cursor:
+                    data = load_price_data(pg_cursor,args.date)
+            finally:
+                pg_conn.close()
+                print(f"Database connection closed")
+            history.append_price_data(args.date,data)
+
+    elif args.command == "store":
+        history = PriceHistory(args.history)
+        itemcodes,prices = history.store_prices(args.store_code,args.date)
+        for itemcode,price in zip(itemcodes,prices):
+            print(f"{itemcode}  {price:8.2f}")
+        print(f"{len(prices)} items in {args.store_code} on {args.date}")
+
+    elif args.command == "item":
+        history = PriceHistory(args.history)
+        series = history.item_series(args.itemcode,args.store,args.start,args.end)
+        for store_code,changes in sorted(series.items()):
+            print(f"{store_code}: " + ", ".join(
+                f"{day} {'-' if price is None else f'{price:.2f}'}" for day,price in changes
+            ))
+
+    else:
+        history = PriceHistory(args.history)
+        for partition in history.partitions:
+            print(f"{partition['date']}  {partition['kind']:5s}  {partition['entries']:>10,} entries  "
+                  f"{partition['prices']:>10,} prices")
@@ -0,0 +1,323 @@
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from geojson_stream import atomic_open
+
+MATRIX_VERSION = 1
+
+META_FILE = "meta.json"
+
+# Store metadata kept with the matrix, in this order
+STORE_FIELDS = ('store_code','store_name','chainname','city','latitude','longitude')
+
+# The matrix is stored twice: row-major (CSR, one row per store; row_*) for store lookups and
+# column-major (CSC, one column per item; col_*) for item lookups. Each array is a plain .npy
+# file so it can be memory-mapped.
+ARRAY_FILES = {
+    'itemcodes': 'itemcodes.npy',
+    'row_indptr': 'row_indptr.npy',
+    'row_items': 'row_items.npy',
+    'row_prices': 'row_prices.npy',
+    'col_indptr': 'col_indptr.npy',
+    'col_stores': 'col_stores.npy',
+    'col_prices': 'col_prices.npy'
+}
+
+
+def _indptr(group_ids,group_count):
+    """Offsets of each group in an array sorted by group_ids"""
+    indptr = np.zeros(group_count + 1,dtype=np.int64)
+    np.cumsum(np.bincount(group_ids,minlength=group_count),out=indptr[1:])
+    return indptr
+
+
+def build_sparse_arrays(store_ids,item_ids,prices,store_count,item_count):
+    """
+    Build the CSR and CSC arrays of a store x item price matrix.
+    Rows with an unknown store (-1) or a missing price are dropped; if a store has several
+    prices for one item, the last one is kept.
+
+    Parameters:
+    store_ids (ndarray): Store index of every price
+    item_ids (ndarray): Item index of every price (into the sorted itemcodes)
+    prices (ndarray): Price values
+    store_count (int): Number of stores (matrix rows)
+    item_count (int): Number of items (matrix columns)
+    """
+    store_ids = np.asarray(store_ids,dtype=np.int64)
+    item_ids = np.asarray(item_ids,dtype=np.int64)
+    prices = np.asarray(prices,dtype=np.float64)
+
+    valid = (store_ids >= 0) & ~np.isnan(prices)
+    store_ids = store_ids[valid]
+    item_ids = item_ids[valid]
+    prices = prices[valid]
+
+    # Sort by store, then item (stable, so the last duplicate stays last)
+    order = np.lexsort((item_ids,store_ids))
+    store_ids = store_ids[order]
+    item_ids = item_ids[order]
+    prices = prices[order]
+    keep = np.ones(len(store_ids),dtype=bool)
+    keep[:-1] = (store_ids[1:] != store_ids[:-1]) | (item_ids[1:] != item_ids[:-1])
+    store_ids = store_ids[keep]
+    item_ids = item_ids[keep]
+    prices = prices[keep].astype(np.float32)
+
+    by_item = np.lexsort((store_ids,item_ids))
+    return {
+        'row_indptr': _indptr(store_ids,store_count),
+        'row_items': item_ids.astype(np.int32),
+        'row_prices': prices,
+        'col_indptr': _indptr(item_ids[by_item],item_count),
+        'col_stores': store_ids[by_item].astype(np.int32),
+        'col_prices': prices[by_item]
+    }
+
+
+def _clean(value):
+    """Replace NaN with None so the metadata is strict JSON"""
+    if isinstance(value,float) and np.isnan(value):
+        return None
+    return value
+
+
+def write_price_matrix(output_dir,stores,itemcodes,store_ids,item_ids,prices):
+    """
+    Write the price matrix to output_dir as memory-mappable .npy files plus meta.json.
+    meta.json is written last, so a reader never sees it before the arrays it describes.
+
+    Parameters:
+    output_dir (str): Directory of the matrix
+    stores (list): Store metadata dicts (STORE_FIELDS); store indexes refer to this list
+    itemcodes (ndarray): Sorted distinct item codes; item indexes refer to this array
+    store_ids, item_ids, prices: Coordinates and value of every price (see build_sparse_arrays)
+    """
+    itemcodes = np.asarray(itemcodes,dtype=np.int64)
+    arrays = build_sparse_arrays(store_ids,item_ids,prices,len(stores),len(itemcodes))
+    arrays['itemcodes'] = itemcodes
+
+    os.makedirs(output_dir,exist_ok=True)
+    for name,file_name in ARRAY_FILES.items():
+        with atomic_open(os.path.join(output_dir,file_name),'wb') as f:
+            np.save(f,arrays[name],allow_pickle=False)
+
+    meta = {
+        "version": MATRIX_VERSION,
+        "store_count": len(stores),
+        "item_count": len(itemcodes),
+        "price_count": len(arrays['row_prices']),
+        "stores": [{field: _clean(store.get(field)) for field in STORE_FIELDS} for store in stores],
+        "files": ARRAY_FILES
+    }
+    with atomic_open(os.path.join(output_dir,META_FILE),'w') as f:
+        json.dump(meta,f,ensure_ascii=False,allow_nan=False)
+
+    size = sum(os.path.getsize(os.path.join(output_dir,file_name)) for file_name in ARRAY_FILES.values())
+    print(f"Wrote {meta['price_count']:,} prices for {meta['store_count']} stores and "
+          f"{meta['item_count']:,} items to {output_dir} ({size / 1e6:.1f} MB)")
+    return meta
+
+
+def matrix_from_price_data(data,output_dir):
+    """
+    Write the price matrix of one upload_date loaded with price_aggregation.load_price_data.
+
+    Parameters:
+    data (PriceData): Encoded prices
+    output_dir (str): Directory of the matrix
+    """
+    stores = data.stores
+    store_meta = [
+        {
+            'store_code': stores['store_code'][i],
+            'store_name': stores['storename'][i],
+            'chainname': stores['chainname'][i],
+            'city': stores['city'][i],
+            'latitude': stores['latitude'][i],
+            'longitude': stores['longitude'][i]
+        }
+        for i in range(len(stores))
+    ]
+    return write_price_matrix(output_dir,store_meta,data.itemcodes,data.store_ids,data.item_ids,data.prices)
+
+
+def _document_prices(document):
+    """Return (itemcodes, prices) of a store file in either the array or the columnar layout"""
+    prices = document['prices']
+    if isinstance(prices,dict):
+        return prices['itemcode'],prices['price']
+    return [price['itemcode'] for price in prices],[price['price'] for price in prices]
+
+
+def matrix_from_store_files(store_dir,output_dir):
+    """
+    Write the price matrix of the per-store files written by store_files_export.py.
+
+    Parameters:
+    store_dir (str): Directory of the <store_code>.json files
+    output_dir (str): Directory of the matrix
+    """
+    stores = []
+    store_ids = []
+    raw_itemcodes = []
+    prices = []
+    for path in sorted(glob.glob(os.path.join(store_dir,'*.json'))):
+        if path.endswith('.index.json'):
+            # Search indexes written next to the store files (see search_index.py)
+            continue
+        with open(path,'r',encoding='utf-8') as f:
+            document = json.load(f)
+        itemcodes,store_prices = _document_prices(document)
+        store_ids.append(np.full(len(itemcodes),len(stores),dtype=np.int64))
+        raw_itemcodes.append(np.asarray(itemcodes,dtype=np.int64))
+        prices.append(np.array([np.nan if price is None else price for price in store_prices],dtype=np.float64))
+        stores.append({field: document.get(field) for field in STORE_FIELDS})
+
+    if not stores:
+        raise ValueError(f"No store files found in {store_dir}")
+    raw_itemcodes = np.concatenate(raw_itemcodes)
+    itemcodes,item_ids = np.unique(raw_itemcodes,return_inverse=True)
+    return write_price_matrix(output_dir,stores,itemcodes,np.concatenate(store_ids),item_ids,np.concatenate(prices))
+
+
+class PriceMatrix:
+    """
+    Read-only access to a price matrix written by write_price_matrix.
+
+    The arrays are memory-mapped, so opening the matrix reads only meta.json, and a lookup
+    touches only the pages holding the requested store row or item column.
+
+    Parameters:
+    matrix_dir (str): Directory of the matrix
+    """
+
+    def __init__(self,matrix_dir):
+        with open(os.path.join(matrix_dir,META_FILE),'r',encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != MATRIX_VERSION:
+            raise ValueError(f"Unsupported price matrix version {meta.get('version')} in {matrix_dir}")
+        self.meta = meta
+        self.stores = meta['stores']
+        self.store_codes = [store['store_code'] for store in self.stores]
+        self.store_index = {code: index for index,code in enumerate(self.store_codes)}
+        for name,file_name in meta['files'].items():
+            setattr(self,name,np.load(os.path.join(matrix_dir,file_name),mmap_mode='r',allow_pickle=False))
+        if len(self.row_prices) != meta['price_count'] or len(self.itemcodes) != meta['item_count']:
+            raise ValueError(f"Price matrix arrays in {matrix_dir} do not match {META_FILE}")
+
+    @property
+    def store_count(self):
+        return len(self.stores)
+
+    @property
+    def item_count(self):
+        return len(self.itemcodes)
+
+    def item_id(self,itemcode):
+        """Return the column index of an item code, or None if no store sells it"""
+        index = int(np.searchsorted(self.itemcodes,itemcode))
+        if index < len(self.itemcodes) and self.itemcodes[index] == itemcode:
+            return index
+        return None
+
+    def item_ids(self,itemcodes):
+        """Return the column indexes of several item codes (-1 for unknown items)"""
+        itemcodes = np.asarray(itemcodes,dtype=np.int64)
+        index = np.searchsorted(self.itemcodes,itemcodes)
+        found = index < len(self.itemcodes)
+        found[found] = self.itemcodes[index[found]] == itemcodes[found]
+        return np.where(found,index,-1)
+
+    def item_prices(self,itemcode):
+        """
+        Return the price of an item in every store as a float32 vector indexed like
+        store_codes, with NaN where the store does not sell it.
+        """
+        vector = np.full(self.store_count,np.nan,dtype=np.float32)
+        item_id = self.item_id(itemcode)
+        if item_id is not None:
+            start,end = self.col_indptr[item_id],self.col_indptr[item_id + 1]
+            vector[self.col_stores[start:end]] = self.col_prices[start:end]
+        return vector
+
+    def item_store_prices(self,itemcode):
+        """Return (store indexes, prices) of the stores selling an item"""
+        item_id = self.item_id(itemcode)
+        if item_id is None:
+            return np.empty(0,dtype=np.int32),np.empty(0,dtype=np.float32)
+        start,end = self.col_indptr[item_id],self.col_indptr[item_id + 1]
+        return self.col_stores[start:end],self.col_prices[start:end]
+
+    def store_prices(self,store_code):
+        """Return (itemcodes, prices) of every item sold by a store, ordered by itemcode"""
+        store_id = self.store_index[store_code]
+        start,end = self.row_indptr[store_id],self.row_indptr[store_id + 1]
+        return self.itemcodes[self.row_items[start:end]],self.row_prices[start:end]
+
+    def price(self,store_code,itemcode):
+        """Return the price of an item in a store, or None"""
+        store_id = self.store_index[store_code]
+        item_id = self.item_id(itemcode)
+        if item_id is None:
+            return None
+        start,end = self.row_indptr[store_id],self.row_indptr[store_id + 1]
+        items = self.row_items[start:end]
+        position = int(np.searchsorted(items,item_id))
+        if position < len(items) and items[position] == item_id:
+            return float(self.row_prices[start + position])
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the memory-mapped store x item price matrix")
+    parser.add_argument("--matrix",default="data/price_matrix",help="Directory of the matrix")
+    subparsers = parser.add_subparsers(dest="command",required=True)
+
+    build_parser = subparsers.add_parser("build",help="Build the matrix")
+    source = build_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--date",help="Build from PostgreSQL for this upload date (YYYY-MM-DD)")
+    source.add_argument("--store-files",help="Build from the per-store JSON files in this directory")
+
+    item_parser = subparsers.add_parser("item",help="Print an item's price in every store")
+    item_parser.add_argument("itemcode",type=int)
+
+    store_parser = subparsers.add_parser("store",help="Print a store's prices")
+    store_parser.add_argument("store_code")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.store_files:
+            matrix_from_store_files(args.store_files,args.matrix)
+        else:
+            import storage
+            from price_aggregation import load_price_data
+
+            print(f"Connecting to the {storage.describe_backend()}...")
+            pg_conn = storage.connect()
+            try:
+                with pg_conn.cursor() as pg_cursor:
+                    data = load_price_data(pg_cursor,args.date)
+            finally:
+                pg_conn.close()
+                print(f"Database connection closed")
+            matrix_from_price_data(data,args.matrix)
+
+    elif args.command == "item":
+        matrix = PriceMatrix(args.matrix)
+        store_ids,prices = matrix.item_store_prices(args.itemcode)
+        for store_id,price in sorted(zip(store_ids,prices),key=lambda pair: pair[1]):
+            store = matrix.stores[store_id]
+            print(f"{price:8.2f}  {store['store_code']}  {store['chainname']} - {store['store_name']}")
+        print(f"{len(prices)} stores sell item {args.itemcode}")
+
+    else:
+        matrix = PriceMatrix(args.matrix)
+        itemcodes,prices = matrix.store_prices(args.store_code)
+        for itemcode,price in zip(itemcodes,prices):
+            print(f"{itemcode}  {price:8.2f}")
+        print(f"{len(prices)} items in {args.store_code}")
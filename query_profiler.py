@@ -0,0 +1,282 @@
+import argparse
+import glob
+import json
+import os
+import sys
+from datetime import datetime
+
+import psycopg2
+import config
+
+from geojson_stream import atomic_open
+from price_aggregation import DEFAULT_POPULARITY_THRESHOLD,EXCLUDED_CHAINS,EXCLUDED_SUBCHAINS
+
+# Filters shared by the popular items checks, as in the store_price_comparisons view
+_ELIGIBLE_FILTER = """
+    p.upload_date = %(upload_date)s
+    AND p.itemprice > 0
+    AND p.itemprice IS NOT NULL
+    AND s.chainname <> ALL (%(excluded_chains)s)
+    AND s.subchainname <> ALL (%(excluded_subchains)s)
+    """
+
+# The checks run by debug_database.py and pg_quick_debug.py, as parameterized queries
+CHECKS = [
+    ("upload_dates","""
+        SELECT upload_date, COUNT(*) AS record_count
+        FROM allprices
+        GROUP BY upload_date
+        ORDER BY upload_date DESC
+        LIMIT 10
+        """),
+    ("store_count","SELECT COUNT(*) AS store_count FROM all_stores"),
+    ("stores_by_chain","""
+        SELECT chainname, COUNT(*) AS store_count
+        FROM all_stores
+        GROUP BY chainname
+        ORDER BY store_count DESC
+        LIMIT 10
+        """),
+    ("item_count","SELECT COUNT(*) AS item_count FROM items_new"),
+    ("popular_items",f"""
+        SELECT COUNT(*) FROM (
+            SELECT p.itemcode
+            FROM allprices p
+            JOIN all_stores s ON p.store_code = s.store_code
+            WHERE {_ELIGIBLE_FILTER}
+            GROUP BY p.itemcode
+            HAVING count(DISTINCT p.store_code) > %(threshold)s
+        ) popular_items
+        """),
+    ("popular_items_join_items_new",f"""
+        SELECT COUNT(*) FROM (
+            SELECT p.itemcode
+            FROM allprices p
+            JOIN all_stores s ON p.store_code = s.store_code
+            WHERE {_ELIGIBLE_FILTER}
+            GROUP BY p.itemcode
+            HAVING count(DISTINCT p.store_code) > %(threshold)s
+        ) popular_items
+        JOIN items_new i ON popular_items.itemcode = i.itemcode
+        """),
+    ("store_item_price_diffs",f"""
+        WITH popular_items AS (
+            SELECT p.itemcode, avg(p.itemprice) AS average_price
+            FROM allprices p
+            JOIN all_stores s ON p.store_code = s.store_code
+            WHERE {_ELIGIBLE_FILTER}
+            GROUP BY p.itemcode
+            HAVING count(DISTINCT p.store_code) > %(threshold)s
+        )
+        SELECT COUNT(*)
+        FROM allprices p
+        JOIN all_stores s ON p.store_code = s.store_code
+        JOIN popular_items pi ON p.itemcode = pi.itemcode
+        WHERE {_ELIGIBLE_FILTER}
+            AND pi.average_price > 0
+        """),
+    ("popular_items_avg_prices_view","SELECT COUNT(*) FROM popular_items_avg_prices"),
+    ("store_price_comparisons_view","SELECT COUNT(*) FROM store_price_comparisons"),
+    ("store_price_comparisons_mv","SELECT COUNT(*) FROM store_price_comparisons_mv"),
+    ("store_price_comparisons_sample","""
+        SELECT store_code, store_name, chainname, city, average_price_diff, popular_item_count, latitude, longitude
+        FROM store_price_comparisons
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        LIMIT 5
+        """)
+]
+
+# Regressions smaller than this are ignored, so noise on fast queries is not flagged
+MIN_REGRESSION_MS = 50.0
+
+
+def plan_shape(plan):
+    """
+    Return a compact signature of a plan tree (node types, join types and relations),
+    used to detect plan changes between runs independently of costs and timings.
+    """
+    label = plan.get("Node Type","?")
+    if "Join Type" in plan:
+        label += f"[{plan['Join Type']}]"
+    if "Relation Name" in plan:
+        label += f"({plan['Relation Name']})"
+    if "Index Name" in plan:
+        label += f"<{plan['Index Name']}>"
+    children = plan.get("Plans",[])
+    if children:
+        label += "{" + ",".join(plan_shape(child) for child in children) + "}"
+    return label
+
+
+def profile_query(pg_cursor,name,query,params,timeout_ms):
+    """
+    Run one check under EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) and return its profile.
+
+    Parameters:
+    pg_cursor: psycopg2 cursor
+    name (str): Check name
+    query (str): Parameterized SQL query
+    params (dict): Query parameters
+    timeout_ms (int): statement_timeout for the check
+    """
+    pg_cursor.execute("SET statement_timeout = %s;",(timeout_ms,))
+    try:
+        pg_cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}",params)
+    except psycopg2.extensions.QueryCanceledError:
+        pg_cursor.connection.rollback()
+        print(f"  {name}: timed out (>{timeout_ms / 1000:.0f}s)")
+        return {"name": name,"timed_out": True,"execution_ms": None,"shape": None}
+    except psycopg2.Error as e:
+        # e.g. a view that does not exist yet or a missing permission: record it and go on
+        pg_cursor.connection.rollback()
+        error = str(e).strip()
+        print(f"  {name}: failed: {error}")
+        return {"name": name,"error": error,"timed_out": False,"execution_ms": None,"shape": None}
+
+    explain = pg_cursor.fetchone()[0]
+    if isinstance(explain,str):
+        explain = json.loads(explain)
+    result = explain[0]
+    plan = result["Plan"]
+    pg_cursor.connection.rollback()
+
+    profile = {
+        "name": name,
+        "timed_out": False,
+        "planning_ms": result.get("Planning Time"),
+        "execution_ms": result.get("Execution Time"),
+        "rows": plan.get("Actual Rows"),
+        "shared_hit_blocks": plan.get("Shared Hit Blocks"),
+        "shared_read_blocks": plan.get("Shared Read Blocks"),
+        "temp_written_blocks": plan.get("Temp Written Blocks"),
+        "shape": plan_shape(plan),
+        "plan": plan
+    }
+    print(f"  {name}: {profile['execution_ms']:.1f} ms, "
+          f"{profile['shared_hit_blocks']} hit / {profile['shared_read_blocks']} read blocks")
+    return profile
+
+
+def latest_upload_date(pg_cursor):
+    pg_cursor.execute("SELECT max(upload_date) FROM allprices;")
+    return pg_cursor.fetchone()[0]
+
+
+def run_profile(pg_conn,upload_date=None,threshold=DEFAULT_POPULARITY_THRESHOLD,timeout_ms=60000,checks=None):
+    """
+    Profile every check and return the report dict.
+
+    Parameters:
+    pg_conn: psycopg2 connection
+    upload_date: Upload date to check (defaults to the latest in allprices)
+    threshold (int): Popularity threshold used by the popular items checks
+    timeout_ms (int): statement_timeout per check
+    checks (list): Optional subset of check names
+    """
+    with pg_conn.cursor() as pg_cursor:
+        if upload_date is None:
+            upload_date = latest_upload_date(pg_cursor)
+        params = {
+            "upload_date": upload_date,
+            "threshold": threshold,
+            "excluded_chains": list(EXCLUDED_CHAINS),
+            "excluded_subchains": list(EXCLUDED_SUBCHAINS)
+        }
+        print(f"Profiling checks for upload date {upload_date} (threshold {threshold})")
+        profiles = [
+            profile_query(pg_cursor,name,query,params,timeout_ms)
+            for name,query in CHECKS
+            if checks is None or name in checks
+        ]
+    return {
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "upload_date": str(upload_date),
+        "threshold": threshold,
+        "checks": profiles
+    }
+
+
+def compare_reports(previous,current,tolerance=0.25,min_regression_ms=MIN_REGRESSION_MS):
+    """
+    Compare two reports and return a list of regression messages: checks whose execution
+    time grew by more than tolerance (and min_regression_ms), whose plan shape changed,
+    or which newly time out. Checks that failed with a database error are always reported.
+    """
+    previous_checks = {check["name"]: check for check in previous.get("checks",[])}
+    regressions = []
+    for check in current["checks"]:
+        name = check["name"]
+        if check.get("error"):
+            regressions.append(f"{name}: failed: {check['error']}")
+            continue
+        before = previous_checks.get(name)
+        if before is None or before.get("error"):
+            continue
+        if check["timed_out"]:
+            if not before["timed_out"]:
+                regressions.append(f"{name}: now times out (was {before['execution_ms']:.1f} ms)")
+            continue
+        if before["timed_out"]:
+            continue
+        if check["shape"] != before["shape"]:
+            regressions.append(f"{name}: plan changed\n    before: {before['shape']}\n    after:  {check['shape']}")
+        slower = check["execution_ms"] - before["execution_ms"]
+        if slower > min_regression_ms and check["execution_ms"] > before["execution_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: {before['execution_ms']:.1f} ms -> {check['execution_ms']:.1f} ms")
+    return regressions
+
+
+def latest_report(report_dir):
+    """Return the most recent report in report_dir, or None"""
+    reports = sorted(glob.glob(os.path.join(report_dir,"query_profile_*.json")))
+    if not reports:
+        return None
+    with open(reports[-1],'r',encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_report(report,report_dir):
+    os.makedirs(report_dir,exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_file = os.path.join(report_dir,f"query_profile_{stamp}.json")
+    with atomic_open(report_file,'w') as f:
+        json.dump(report,f,ensure_ascii=False,indent=2,default=str)
+    print(f"Report saved to {report_file}")
+    return report_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the price database checks with EXPLAIN ANALYZE")
+    parser.add_argument("--date",default=None,help="Upload date to check (defaults to the latest)")
+    parser.add_argument("--threshold",type=int,default=DEFAULT_POPULARITY_THRESHOLD,help="Popularity threshold")
+    parser.add_argument("--timeout",type=int,default=60,help="statement_timeout per check, in seconds")
+    parser.add_argument("--check",action='append',default=None,help="Only run this check (repeatable)")
+    parser.add_argument("--report-dir",default="diagnostics",help="Directory for the JSON reports")
+    parser.add_argument("--tolerance",type=float,default=0.25,help="Allowed slowdown before flagging a regression")
+    parser.add_argument("--fail-on-regression",action="store_true",help="Exit with status 1 if a regression is found")
+    args = parser.parse_args()
+
+    print("Connecting to PostgreSQL database...")
+    pg_conn = psycopg2.connect(**config.pg_config)
+    try:
+        previous = latest_report(args.report_dir)
+        report = run_profile(pg_conn,args.date,args.threshold,args.timeout * 1000,args.check)
+    finally:
+        pg_conn.close()
+        print(f"Database connection closed")
+
+    save_report(report,args.report_dir)
+
+    if previous is None:
+        print("No previous report to compare with")
+        sys.exit(0)
+
+    regressions = compare_reports(previous,report,args.tolerance)
+    if not regressions:
+        print(f"No regressions compared with the report from {previous['created_at']}")
+        sys.exit(0)
+
+    print(f"\n⚠️  {len(regressions)} regression(s) compared with the report from {previous['created_at']}:")
+    for regression in regressions:
+        print(f"  {regression}")
+    sys.exit(1 if args.fail_on_regression else 0)
@@ -0,0 +1,205 @@
+import json
+import math
+import re
+
+# Cell values treated as missing (compared case-insensitively)
+NULL_TOKENS = frozenset(['','NULL','NAN'])
+
+COORDINATE_COLUMNS = ('latitude','longitude')
+
+# PostgreSQL type OIDs as reported in cursor.description
+PG_INT_OIDS = frozenset([20,21,23])  # int8, int2, int4
+PG_FLOAT_OIDS = frozenset([700,701,1700])  # float4, float8, numeric
+
+_INT_RE = re.compile(r'-?\d+$')
+_FLOAT_RE = re.compile(r'-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+# Strict encoder: raises ValueError on NaN/Infinity instead of writing invalid JSON
+STRICT_ENCODER = json.JSONEncoder(ensure_ascii=False,allow_nan=False)
+strict_dumps = STRICT_ENCODER.encode
+
+
+def is_null_token(value):
+    """Check if a CSV cell represents a missing value (empty, NULL or NaN)"""
+    return len(value) <= 4 and value.upper() in NULL_TOKENS
+
+
+def infer_text_schema(columns,sample_rows):
+    """
+    Infer a type ('int', 'float' or 'str') for each column of a text source such as a CSV file.
+    A column is numeric only if every non-missing value in the sample is numeric, so text
+    containing periods (e.g. Hebrew abbreviations like "ד.מ.") is never parsed as a number.
+
+    Parameters:
+    columns (list): Column names
+    sample_rows (list): Rows (lists of strings) used for inference
+    """
+    schema = {}
+    for index,name in enumerate(columns):
+        column_type = None
+        for row in sample_rows:
+            value = row[index] if index < len(row) else ''
+            if is_null_token(value):
+                continue
+            if _INT_RE.match(value):
+                column_type = column_type or 'int'
+            elif _FLOAT_RE.match(value):
+                column_type = 'float'
+            else:
+                column_type = 'str'
+                break
+        schema[name] = column_type or 'str'
+    return schema
+
+
+def infer_pg_schema(description):
+    """
+    Infer column types from a psycopg2 cursor.description.
+
+    Parameters:
+    description (sequence): cursor.description of an executed query
+    """
+    schema = {}
+    for column in description:
+        if column[1] in PG_INT_OIDS:
+            schema[column[0]] = 'int'
+        elif column[1] in PG_FLOAT_OIDS:
+            schema[column[0]] = 'float'
+        else:
+            schema[column[0]] = 'str'
+    return schema
+
+
+def _finite_or_none(number):
+    return number if math.isfinite(number) else None
+
+
+def _text_to_float(value):
+    if is_null_token(value):
+        return None
+    try:
+        return _finite_or_none(float(value))
+    except ValueError:
+        return value
+
+
+def _text_to_int(value):
+    if is_null_token(value):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return _text_to_float(value)
+
+
+def _text_to_str(value):
+    if is_null_token(value):
+        return None
+    return value
+
+
+def _typed_to_number(value):
+    if value is None:
+        return None
+    # float() also handles Decimal values returned for numeric columns
+    return _finite_or_none(float(value))
+
+
+def _typed_to_int(value):
+    return value
+
+
+def _typed_to_str(value):
+    if value is None:
+        return None
+    return str(value)
+
+
+# Converters for values read from text (CSV cells)
+TEXT_CONVERTERS = {
+    'int': _text_to_int,
+    'float': _text_to_float,
+    'str': _text_to_str
+}
+
+# Converters for values already typed by the database driver
+TYPED_CONVERTERS = {
+    'int': _typed_to_int,
+    'float': _typed_to_number,
+    'str': _typed_to_str
+}
+
+
+def parse_coordinate(value):
+    """Convert a coordinate to float, returning None if it is missing, NaN or Infinity"""
+    if not value:
+        return None
+    try:
+        return _finite_or_none(float(value))
+    except (ValueError,TypeError):
+        return None
+
+
+class RowSanitizer:
+    """
+    Converts positional rows to GeoJSON features in a single pass, using one converter
+    function per column chosen once from the inferred schema.
+    """
+
+    def __init__(self,columns,schema,converters):
+        self.columns = list(columns)
+        self.lat_index = self.columns.index('latitude')
+        self.lng_index = self.columns.index('longitude')
+        self._properties = [
+            (name,index,converters[schema[name]])
+            for index,name in enumerate(self.columns)
+            if name not in COORDINATE_COLUMNS
+        ]
+
+    def properties(self,row):
+        """Return the cleaned properties of a row (all columns except coordinates)"""
+        return {name: convert(row[index]) for name,index,convert in self._properties}
+
+    def coordinates(self,row):
+        """Return the [lng, lat] of a row, or None if either is missing, NaN or Infinity"""
+        lat = parse_coordinate(row[self.lat_index])
+        lng = parse_coordinate(row[self.lng_index])
+        if lat is None or lng is None:
+            return None
+        return [lng,lat]
+
+    def point_feature(self,row,coordinates):
+        """Return the GeoJSON feature of a row whose coordinates were checked by coordinates()"""
+        return {
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": coordinates
+            },
+            "properties": self.properties(row)
+        }
+
+    def feature(self,row):
+        """Return a GeoJSON feature for the row, or None if its coordinates are missing or invalid"""
+        coordinates = self.coordinates(row)
+        if coordinates is None:
+            return None
+        return self.point_feature(row,coordinates)
+
+    def cleaned_count(self,row,properties):
+        """Number of properties that had a value in the row but were cleaned to None (NULL, NaN, Infinity)"""
+        return sum(
+            1 for name,index,convert in self._properties
+            if properties[name] is None and row[index] is not None and row[index] != ''
+        )
+
+
+def text_sanitizer(columns,sample_rows):
+    """Build a RowSanitizer for rows of strings, inferring the schema from sample_rows"""
+    return RowSanitizer(columns,infer_text_schema(columns,sample_rows),TEXT_CONVERTERS)
+
+
+def pg_sanitizer(description):
+    """Build a RowSanitizer for tuples returned by a psycopg2 cursor"""
+    columns = [column[0] for column in description]
+    return RowSanitizer(columns,infer_pg_schema(description),TYPED_CONVERTERS)
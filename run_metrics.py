@@ -0,0 +1,278 @@
+import cProfile
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from geojson_stream import atomic_open
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Directory of the metrics files written by default
+METRICS_DIR = os.path.join("diagnostics","metrics")
+
+# Skipped rows kept as examples in the metrics file (all of them are counted)
+MAX_SKIPPED_EXAMPLES = 10
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its finished child processes, in MB"""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024 if os.uname().sysname == 'Darwin' else 1024)
+
+
+def describe_row(columns,row):
+    """Short description of a skipped row for messages and the metrics file"""
+    if 'store_code' in columns:
+        return f"store_code={row[columns.index('store_code')]}"
+    return str(list(row))
+
+
+class RunMetrics:
+    """
+    Timings and counters of one export run, written as a JSON metrics file for the
+    nightly job (see save).
+
+    Time is recorded per stage: connect, query, fetch (or read for files), validate
+    (coordinate checks), transform (building the features), write and any other stage
+    a script times. Counters hold the rows read, features written, rows skipped for
+    missing coordinates and values cleaned to null. Stage times from worker processes
+    are merged in, so stages can add up to more than the elapsed wall time.
+
+    Parameters:
+    name (str): Name of the run, e.g. the script name
+    profile (bool): Also run cProfile over the whole run (slows it down)
+    """
+
+    def __init__(self,name,profile=False):
+        self.name = name
+        self.started_at = datetime.now()
+        self.stages = {}
+        self.counters = Counter()
+        self.skipped_examples = []
+        self.outputs = []
+        self.bytes_written = 0
+        self._start = time.perf_counter()
+        self._profiler = None
+        if profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def add_time(self,stage,seconds,calls=1):
+        timing = self.stages.setdefault(stage,{'seconds': 0.0,'calls': 0})
+        timing['seconds'] += seconds
+        timing['calls'] += calls
+
+    @contextmanager
+    def stage(self,name):
+        """Time the block as one call of a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name,time.perf_counter() - start)
+
+    def timed(self,stage,function):
+        """Wrap function so every call is timed as the given stage"""
+        perf_counter = time.perf_counter
+
+        def call(*args,**kwargs):
+            start = perf_counter()
+            try:
+                return function(*args,**kwargs)
+            finally:
+                self.add_time(stage,perf_counter() - start)
+        return call
+
+    def timed_iter(self,stage,iterable):
+        """Iterate over iterable, timing the wait for each item as the given stage"""
+        perf_counter = time.perf_counter
+        iterator = iter(iterable)
+        seconds = 0.0
+        calls = 0
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += perf_counter() - start
+                    calls += 1
+                yield item
+        finally:
+            self.add_time(stage,seconds,calls)
+
+    def count(self,name,amount=1):
+        self.counters[name] += amount
+
+    def skip(self,row_num,description):
+        """Count a row skipped for missing or invalid coordinates, keeping the first few as examples"""
+        self.counters['skipped_rows'] += 1
+        if len(self.skipped_examples) < MAX_SKIPPED_EXAMPLES:
+            self.skipped_examples.append({'row': row_num,'row_desc': description})
+
+    def convert(self,rows,sanitizer,first_row=1):
+        """
+        Yield the GeoJSON features of rows, timing the validate and transform stages and
+        counting rows, skipped rows and cleaned values. Skipped rows are not printed one by
+        one; see print_skipped.
+
+        Parameters:
+        rows (iterable): Positional rows
+        sanitizer: RowSanitizer, or a function returning it, called on the first row (named
+                   cursors only expose their description after the first fetch)
+        first_row (int): Number of the first row in messages
+        """
+        perf_counter = time.perf_counter
+        validate = transform = 0.0
+        row_num = first_row - 1
+        features = cleaned = 0
+        if not hasattr(sanitizer,'coordinates'):
+            make_sanitizer,sanitizer = sanitizer,None
+        try:
+            for row in rows:
+                row_num += 1
+                if sanitizer is None:
+                    sanitizer = make_sanitizer()
+
+                start = perf_counter()
+                coordinates = sanitizer.coordinates(row)
+                validated = perf_counter()
+                validate += validated - start
+                if coordinates is None:
+                    self.skip(row_num,describe_row(sanitizer.columns,row))
+                    continue
+
+                feature = sanitizer.point_feature(row,coordinates)
+                cleaned += sanitizer.cleaned_count(row,feature['properties'])
+                transform += perf_counter() - validated
+                features += 1
+                yield feature
+        finally:
+            self.add_time('validate',validate,row_num - first_row + 1)
+            self.add_time('transform',transform,features)
+            self.counters['rows'] += row_num - first_row + 1
+            self.counters['features'] += features
+            self.counters['cleaned_values'] += cleaned
+
+    def merge(self,stages,counters,skipped_examples=(),row_offset=0):
+        """Add the stages, counters and skipped rows recorded by a worker process"""
+        for stage,timing in stages.items():
+            self.add_time(stage,timing['seconds'],timing['calls'])
+        self.counters.update(counters)
+        for example in skipped_examples:
+            if len(self.skipped_examples) >= MAX_SKIPPED_EXAMPLES:
+                break
+            self.skipped_examples.append(dict(example,row=example['row'] + row_offset))
+
+    def add_output(self,output_file):
+        """Record a file written by the run and its size"""
+        self.outputs.append(output_file)
+        self.bytes_written += os.path.getsize(output_file)
+
+    def cursor_factory(self,base=None):
+        """
+        Return a psycopg2 cursor class that times execute() as the query stage and the
+        fetch methods as the fetch stage, and counts the fetched rows.
+
+        Parameters:
+        base: Cursor class to extend (defaults to the plain psycopg2 cursor), e.g. RealDictCursor
+              or a cursor class from storage.cursor_class
+        """
+        if base is None:
+            import psycopg2.extensions
+            base = psycopg2.extensions.cursor
+
+        metrics = self
+
+        class TimedCursor(base):
+            def execute(self,query,vars=None):
+                with metrics.stage('query'):
+                    return super().execute(query,vars)
+
+            def fetchone(self):
+                with metrics.stage('fetch'):
+                    row = super().fetchone()
+                if row is not None:
+                    metrics.counters['rows'] += 1
+                return row
+
+            def fetchmany(self,size=None):
+                with metrics.stage('fetch'):
+                    rows = super().fetchmany(self.arraysize if size is None else size)
+                metrics.counters['rows'] += len(rows)
+                return rows
+
+            def fetchall(self):
+                with metrics.stage('fetch'):
+                    rows = super().fetchall()
+                metrics.counters['rows'] += len(rows)
+                return rows
+
+        return TimedCursor
+
+    def print_skipped(self):
+        """Print one line about the rows skipped for missing or invalid coordinates"""
+        skipped = self.counters['skipped_rows']
+        if not skipped:
+            return
+        examples = ', '.join(f"row {example['row']} ({example['row_desc']})" for example in self.skipped_examples[:3])
+        print(f"Skipped {skipped} rows with missing or invalid coordinates, e.g. {examples}")
+
+    def report(self):
+        elapsed = time.perf_counter() - self._start
+        return {
+            'name': self.name,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'elapsed_seconds': elapsed,
+            'stages': self.stages,
+            'rows_per_second': self.counters['rows'] / elapsed if elapsed > 0 else None,
+            'bytes_written': self.bytes_written,
+            'outputs': self.outputs,
+            'peak_rss_mb': peak_rss_mb(),
+            'counters': dict(self.counters),
+            'skipped_examples': self.skipped_examples
+        }
+
+    def save(self,metrics_file=None):
+        """
+        Write the metrics as JSON, by default to diagnostics/metrics/<name>_<timestamp>.json.
+        With profiling on, the cProfile statistics are dumped next to it as a .prof file
+        (open with python -m pstats or snakeviz).
+        """
+        if metrics_file is None:
+            stamp = self.started_at.strftime("%Y%m%d_%H%M%S")
+            metrics_file = os.path.join(METRICS_DIR,f"{self.name}_{stamp}.json")
+        os.makedirs(os.path.dirname(metrics_file) or '.',exist_ok=True)
+
+        report = self.report()
+        if self._profiler is not None:
+            self._profiler.disable()
+            profile_file = os.path.splitext(metrics_file)[0] + '.prof'
+            self._profiler.dump_stats(profile_file)
+            report['profile'] = profile_file
+            print(f"Profile saved to {profile_file}")
+
+        with atomic_open(metrics_file,'w') as f:
+            json.dump(report,f,ensure_ascii=False,indent=2)
+        print(f"Metrics saved to {metrics_file}")
+        return metrics_file
+
+
+def metrics_from_argv(name,argv):
+    """
+    Create the RunMetrics of a script from its command-line flags: --profile turns on
+    cProfile and --metrics FILE sets the metrics file. Returns (metrics, metrics_file).
+    """
+    metrics_file = argv[argv.index("--metrics") + 1] if "--metrics" in argv else None
+    return RunMetrics(name,profile="--profile" in argv),metrics_file
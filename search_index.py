@@ -0,0 +1,209 @@
+import argparse
+import glob
+import json
+import math
+import os
+import re
+import time
+
+from geojson_stream import atomic_open
+
+# Fields searched by the price table filter
+SEARCH_FIELDS = ('itemname','manufacturer','brand','category')
+
+# Length of the indexed substrings. Shorter search terms are matched by scanning the
+# normalized texts instead.
+GRAM_SIZE = 3
+
+# Hebrew points and cantillation marks (niqqud), removed before indexing and searching
+NIQQUD = re.compile('[\u0591-\u05bd\u05bf\u05c1\u05c2\u05c4\u05c5\u05c7]')
+WHITESPACE = re.compile(r'\s+')
+
+# Final letter forms are indexed as the regular letter, so "שמן" matches "שמנים"
+FINAL_LETTERS = str.maketrans('\u05da\u05dd\u05df\u05e3\u05e5','\u05db\u05de\u05e0\u05e4\u05e6')
+
+INDEX_VERSION = 1
+
+
+def normalize_text(text):
+    """
+    Normalize a value for searching: lowercase, without niqqud, with Hebrew final letters
+    replaced by the regular forms and runs of whitespace collapsed to one space.
+    js/map.js applies the same normalization to the search term.
+    """
+    if not text:
+        return ''
+    text = NIQQUD.sub('',str(text).lower()).translate(FINAL_LETTERS)
+    return WHITESPACE.sub(' ',text).strip()
+
+
+def ngrams(text,size=GRAM_SIZE):
+    """Return the set of substrings of the given length in text"""
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def encode_postings(rows):
+    """Delta-encode a sorted list of row numbers"""
+    previous = 0
+    deltas = []
+    for row in rows:
+        deltas.append(row - previous)
+        previous = row
+    return deltas
+
+
+def sort_permutation(values,key):
+    """Return the row numbers ordered by key(value), ties kept in row order"""
+    return sorted(range(len(values)),key=lambda row: key(values[row]))
+
+
+def name_sort_key(name):
+    """
+    Sort key of a normalized item name. Names are compared by UTF-16 code units, as the
+    plain < comparison of strings in js/map.js does, so the prebuilt "name" order is the
+    order the map computes when a store has no search index.
+    """
+    return name.encode('utf-16-be')
+
+
+def _number_key(value):
+    # The price table sorts missing values as 0
+    return value if value is not None and not (isinstance(value,float) and math.isnan(value)) else 0
+
+
+def build_search_index(prices):
+    """
+    Build the search index of one store's price table.
+
+    The index maps every GRAM_SIZE-character substring of the normalized SEARCH_FIELDS to
+    the rows containing it, as delta-encoded row numbers. A search term is looked up by
+    intersecting the rows of its substrings, and the candidates are checked against the
+    normalized texts. It also holds the row order for each sort of the price table (by name,
+    price and price difference, ascending), so sorting is a lookup as well.
+
+    Row numbers are positions in the store file's prices, in file order.
+
+    Parameters:
+    prices (list): Price dicts with the SEARCH_FIELDS, price and price_diff_pct
+    """
+    postings = {}
+    for row,price in enumerate(prices):
+        grams = set()
+        for field in SEARCH_FIELDS:
+            grams |= ngrams(normalize_text(price.get(field)))
+        for gram in grams:
+            postings.setdefault(gram,[]).append(row)
+
+    names = [normalize_text(price.get('itemname')) for price in prices]
+    return {
+        "version": INDEX_VERSION,
+        "item_count": len(prices),
+        "gram_size": GRAM_SIZE,
+        "fields": list(SEARCH_FIELDS),
+        "grams": {gram: encode_postings(rows) for gram,rows in sorted(postings.items())},
+        "sort": {
+            "name": sort_permutation(names,name_sort_key),
+            "price": sort_permutation([price.get('price') for price in prices],_number_key),
+            "diff": sort_permutation([price.get('price_diff_pct') for price in prices],_number_key)
+        }
+    }
+
+
+def encode_search_index(index):
+    """Serialize a search index to minified UTF-8 JSON bytes"""
+    return json.dumps(index,ensure_ascii=False,allow_nan=False,separators=(',',':')).encode('utf-8')
+
+
+def index_file_path(store_file):
+    """Path of the search index written next to a store file (<store_code>.index.json)"""
+    return store_file[:-len('.json')] + '.index.json'
+
+
+def load_catalog_items(store_dir):
+    """Return {itemcode: {field: value}} from the shared items catalog next to store_dir"""
+    catalog_dir = os.path.dirname(os.path.abspath(store_dir))
+    with open(os.path.join(catalog_dir,"items_catalog.json"),'r',encoding='utf-8') as f:
+        pointer = json.load(f)
+    with open(os.path.join(catalog_dir,pointer['file']),'r',encoding='utf-8') as f:
+        catalog = json.load(f)
+    return {
+        itemcode: dict(zip(catalog['fields'],values))
+        for itemcode,values in catalog['items'].items()
+    }
+
+
+def store_file_prices(document,catalog_items=None):
+    """
+    Return the prices of a store document as a list of dicts, for any export layout
+    (one dict per item or columnar, with or without the shared catalog).
+    """
+    prices = document.get('prices') or []
+    if isinstance(prices,dict):
+        fields = list(prices)
+        prices = [dict(zip(fields,values)) for values in zip(*(prices[field] for field in fields))]
+    if document.get('catalog'):
+        for price in prices:
+            price.update((catalog_items or {}).get(str(price['itemcode']),{}))
+    return prices
+
+
+def index_store_files(store_dir):
+    """
+    Write a search index next to every store file in store_dir, for store files that
+    were exported without one.
+    """
+    store_files = sorted(
+        path for path in glob.glob(os.path.join(store_dir,"*.json"))
+        if not path.endswith('.index.json')
+    )
+    catalog_items = None
+    total_bytes = 0
+    for store_file in store_files:
+        with open(store_file,'r',encoding='utf-8') as f:
+            document = json.load(f)
+        if document.get('catalog') and catalog_items is None:
+            catalog_items = load_catalog_items(store_dir)
+        data = encode_search_index(build_search_index(store_file_prices(document,catalog_items)))
+        with atomic_open(index_file_path(store_file),'wb') as f:
+            f.write(data)
+        total_bytes += len(data)
+    print(f"Wrote {len(store_files)} search indexes ({total_bytes:,} bytes) to {store_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build price table search indexes for exported store files")
+    parser.add_argument("--store-dir",default="data/store_files",help="Directory of the per-store files")
+    parser.add_argument("--query",default=None,metavar="STORE_CODE:TERM",
+                        help="Search one store's index instead of building (e.g. ram_054:שמנת)")
+    args = parser.parse_args()
+
+    if args.query is None:
+        index_store_files(args.store_dir)
+    else:
+        store_code,term = args.query.split(':',1)
+        store_file = os.path.join(args.store_dir,f"{store_code}.json")
+        with open(store_file,'r',encoding='utf-8') as f:
+            document = json.load(f)
+        catalog_items = load_catalog_items(args.store_dir) if document.get('catalog') else None
+        prices = store_file_prices(document,catalog_items)
+        with open(index_file_path(store_file),'r',encoding='utf-8') as f:
+            index = json.load(f)
+
+        texts = ['\n'.join(normalize_text(price.get(field)) for field in index['fields']) for price in prices]
+        start = time.perf_counter()
+        term = normalize_text(term)
+        candidates = None
+        for gram in ngrams(term,index['gram_size']):
+            rows = set()
+            row = 0
+            for delta in index['grams'].get(gram,[]):
+                row += delta
+                rows.add(row)
+            candidates = rows if candidates is None else candidates & rows
+        if candidates is None:
+            candidates = range(len(prices))
+        matches = sorted(row for row in candidates if term in texts[row])
+        elapsed = (time.perf_counter() - start) * 1000
+        for row in matches[:20]:
+            print(f"  {prices[row]['itemcode']}  {prices[row].get('itemname')}  {prices[row].get('price')}")
+        print(f"{len(matches)} matches in {elapsed:.1f} ms")
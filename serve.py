@@ -0,0 +1,382 @@
+import argparse
+import email.utils
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler,ThreadingHTTPServer
+from urllib.parse import unquote,urlsplit
+
+from build_manifest import BuildManifest
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it, br is only served from pre-compressed .br files
+    brotli = None
+
+# Paths under the site root that are served; everything else (scripts, config.py, .git) is not
+SERVED_PATHS = ('index.html','favicon.ico','js/','css/','img/','data/')
+
+# Content types compressed for clients that accept it
+COMPRESSIBLE_EXTENSIONS = {'.html','.js','.css','.json','.geojson','.csv','.svg','.txt'}
+
+# Files smaller than this are sent uncompressed
+MIN_COMPRESS_SIZE = 1024
+
+# Default byte budget of the in-memory cache
+DEFAULT_CACHE_MB = 256
+
+# Largest file kept in the cache, as a share of the budget; bigger files are streamed from disk
+MAX_CACHED_SHARE = 0.25
+
+# Content-hashed file names (the items catalog) never change and can be cached indefinitely
+IMMUTABLE_NAME = re.compile(r'\.[0-9a-f]{16}\.json$')
+
+# Preferred encodings, best first
+ENCODINGS = ('br','gzip')
+ENCODING_SUFFIXES = {'br': '.br','gzip': '.gz'}
+
+mimetypes.add_type('application/geo+json','.geojson')
+mimetypes.add_type('application/json','.json')
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a total byte budget.
+
+    Parameters:
+    max_bytes (int): Budget for the cached values
+    """
+
+    def __init__(self,max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self,key,value):
+        """Cache bytes under key, evicting the least recently used values to stay in budget"""
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key,None)
+            if previous is not None:
+                self.bytes -= len(previous)
+            self._items[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes:
+                evicted_key,evicted = self._items.popitem(last=False)
+                self.bytes -= len(evicted)
+
+
+class ContentHashes:
+    """
+    Strong ETag values for served files. Hashes recorded in the build manifest are used as-is
+    when the file was not modified after the manifest was written; other files are hashed once
+    per (size, mtime) and remembered.
+
+    Parameters:
+    manifest_path (str): Path of data/build_manifest.json (it need not exist)
+    """
+
+    def __init__(self,manifest_path):
+        self.manifest_path = manifest_path
+        self._manifest_mtime = None
+        self._manifest_files = {}
+        self._computed = {}
+        self._lock = threading.Lock()
+
+    def _manifest(self):
+        """Return {absolute path: hash} from the manifest, reloading it after each build"""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return {},None
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                manifest = BuildManifest(self.manifest_path)
+                self._manifest_files = {
+                    os.path.normcase(manifest.absolute(path)): digest
+                    for entry in manifest.entries.values()
+                    for path,digest in entry['files'].items()
+                }
+                self._manifest_mtime = mtime
+            return self._manifest_files,self._manifest_mtime
+
+    def get(self,path,stat):
+        files,manifest_mtime = self._manifest()
+        digest = files.get(os.path.normcase(os.path.abspath(path)))
+        if digest is not None and stat.st_mtime_ns <= manifest_mtime:
+            return digest
+
+        key = (path,stat.st_size,stat.st_mtime_ns)
+        with self._lock:
+            digest = self._computed.get(key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with open(path,'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20),b''):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+            with self._lock:
+                self._computed[key] = digest
+        return digest
+
+
+def accepted_encodings(header):
+    """Return the content codings accepted by an Accept-Encoding header, with q > 0"""
+    accepted = set()
+    for part in (header or '').split(','):
+        fields = part.strip().split(';')
+        coding = fields[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in fields[1:]:
+            name,_,value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(coding)
+    if '*' in accepted:
+        accepted.update(ENCODINGS)
+    return accepted
+
+
+def parse_range(header,size):
+    """
+    Parse a single-range "bytes=" Range header. Returns (start, end) inclusive, None if the
+    header is not a single byte range (the full file is sent), or False if unsatisfiable.
+    """
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*',header or '')
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        length = int(match.group(2))
+        if length == 0:
+            return False
+        return max(0,size - length),size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        return False
+    return start,min(end,size - 1)
+
+
+class CachingRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the map and its data files with strong ETags, Last-Modified, gzip/br content
+    negotiation (pre-compressed .gz/.br siblings are preferred), single byte ranges and an
+    in-memory LRU cache shared by all threads.
+    """
+
+    server_version = "EfoliknotHTTP/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.serve_file(head=False)
+
+    def do_HEAD(self):
+        self.serve_file(head=True)
+
+    def list_directory(self,path):
+        self.send_error(HTTPStatus.NOT_FOUND,"File not found")
+        return None
+
+    def served_path(self):
+        """Return the file system path of the request, or None if it is not served"""
+        url_path = unquote(urlsplit(self.path).path)
+        if url_path == '/':
+            url_path = '/index.html'
+        relative = url_path.lstrip('/')
+        if '..' in relative.split('/') or not relative.startswith(SERVED_PATHS):
+            return None
+        path = self.translate_path(url_path)
+        return path if os.path.isfile(path) else None
+
+    def select_encoding(self,path,size):
+        """
+        Pick the response encoding: returns (encoding, file to read) where encoding is None for
+        identity, and the file is a pre-compressed sibling when one is up to date.
+        """
+        if os.path.splitext(path)[1].lower() not in COMPRESSIBLE_EXTENSIONS or size < MIN_COMPRESS_SIZE:
+            return None,path
+        accepted = accepted_encodings(self.headers.get('Accept-Encoding'))
+        mtime = os.stat(path).st_mtime_ns
+        for encoding in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            sibling = path + ENCODING_SUFFIXES[encoding]
+            try:
+                if os.stat(sibling).st_mtime_ns >= mtime:
+                    return encoding,sibling
+            except FileNotFoundError:
+                pass
+            if encoding == 'gzip' or brotli is not None:
+                return encoding,path
+        return None,path
+
+    def read_body(self,path,source,encoding,stat):
+        """Return the (possibly compressed) body through the cache, or None to stream it from disk"""
+        cache = self.server.cache
+        key = (path,encoding,stat.st_size,stat.st_mtime_ns)
+        body = cache.get(key)
+        if body is not None:
+            return body
+        compress = encoding is not None and source == path
+        if not compress and stat.st_size > cache.max_bytes * MAX_CACHED_SHARE:
+            return None
+        with open(source,'rb') as f:
+            body = f.read()
+        if compress:
+            if encoding == 'br':
+                body = brotli.compress(body,mode=brotli.MODE_TEXT,quality=5)
+            else:
+                body = gzip.compress(body,compresslevel=6,mtime=0)
+        if len(body) <= cache.max_bytes * MAX_CACHED_SHARE:
+            cache.put(key,body)
+        return body
+
+    def not_modified(self,etag,stat):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or f'W/{etag}' in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError,ValueError,IndexError,OverflowError):
+                return False
+            return int(stat.st_mtime) <= since
+        return False
+
+    def serve_file(self,head):
+        path = self.served_path()
+        if path is None:
+            self.send_error(HTTPStatus.NOT_FOUND,"File not found")
+            return
+        stat = os.stat(path)
+        encoding,source = self.select_encoding(path,stat.st_size)
+        digest = self.server.hashes.get(path,stat)
+        etag = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+
+        headers = {
+            'ETag': etag,
+            'Last-Modified': self.date_time_string(stat.st_mtime),
+            'Cache-Control': 'public, max-age=31536000, immutable' if IMMUTABLE_NAME.search(path) else 'no-cache'
+        }
+        if os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if self.not_modified(etag,stat):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            for name,value in headers.items():
+                self.send_header(name,value)
+            self.end_headers()
+            return
+
+        body = self.read_body(path,source,encoding,stat)
+        size = len(body) if body is not None else os.path.getsize(source)
+        status = HTTPStatus.OK
+        start,end = 0,size - 1
+
+        # Ranges are served for the identity encoding only; If-Range must match the current file
+        if encoding is None and 'Range' in self.headers:
+            if_range = self.headers.get('If-Range')
+            if if_range is None or if_range.strip() == etag:
+                byte_range = parse_range(self.headers['Range'],size)
+                if byte_range is False:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header('Content-Range',f'bytes */{size}')
+                    self.send_header('Content-Length','0')
+                    self.end_headers()
+                    return
+                if byte_range is not None:
+                    status = HTTPStatus.PARTIAL_CONTENT
+                    start,end = byte_range
+
+        content_type = self.guess_type(path)
+        if content_type.startswith('text/') or content_type in ('application/json','application/geo+json','application/javascript'):
+            content_type += '; charset=utf-8'
+
+        self.send_response(status)
+        self.send_header('Content-Type',content_type)
+        self.send_header('Content-Length',str(end - start + 1))
+        if encoding:
+            self.send_header('Content-Encoding',encoding)
+        else:
+            self.send_header('Accept-Ranges','bytes')
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header('Content-Range',f'bytes {start}-{end}/{size}')
+        for name,value in headers.items():
+            self.send_header(name,value)
+        self.end_headers()
+        if head:
+            return
+
+        if body is not None:
+            self.wfile.write(body[start:end + 1])
+            return
+        with open(source,'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(1 << 20,remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class SiteServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the cache and content hashes shared by the request handlers"""
+
+    daemon_threads = True
+
+    def __init__(self,address,root='.',manifest_path='data/build_manifest.json',cache_bytes=DEFAULT_CACHE_MB << 20):
+        self.root = os.path.abspath(root)
+        self.cache = LRUCache(cache_bytes)
+        self.hashes = ContentHashes(os.path.join(self.root,manifest_path))
+        super().__init__(address,partial(CachingRequestHandler,directory=self.root))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the map and its data files with caching and compression")
+    parser.add_argument("--port",type=int,default=8000,help="Port to listen on")
+    parser.add_argument("--bind",default="",help="Address to bind to (default: all interfaces)")
+    parser.add_argument("--root",default=".",help="Site directory (containing index.html)")
+    parser.add_argument("--manifest",default="data/build_manifest.json",help="Build manifest with content hashes, relative to the root")
+    parser.add_argument("--cache-mb",type=int,default=DEFAULT_CACHE_MB,help="Byte budget of the in-memory cache in MB")
+    args = parser.parse_args()
+
+    server = SiteServer((args.bind,args.port),args.root,args.manifest,args.cache_mb << 20)
+    print(f"Serving {server.root} on http://{args.bind or 'localhost'}:{args.port}/ "
+          f"(cache {args.cache_mb} MB, brotli {'on' if brotli is not None else 'pre-compressed files only'})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nCache: {server.cache.hits} hits, {server.cache.misses} misses, {server.cache.bytes:,} bytes")
+    finally:
+        server.server_close()
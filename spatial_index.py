@@ -0,0 +1,318 @@
+import argparse
+import csv
+import heapq
+import json
+import math
+import time
+
+from geojson_stream import stream_feature_collection
+from row_sanitizer import text_sanitizer
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Stores per KD-tree leaf
+LEAF_SIZE = 16
+
+# Defaults for the cheaper neighbours written into the export
+DEFAULT_NEIGHBOURS = 3
+DEFAULT_RADIUS_KM = 10.0
+# A neighbour must be at least this many percentage points cheaper on average
+DEFAULT_MIN_SAVING = 1.0
+
+
+def to_unit_vector(lat,lon):
+    """Return the (x, y, z) position of a point on the unit sphere"""
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lon),cos_lat * math.sin(lon),math.sin(lat))
+
+
+def km_to_chord(distance_km):
+    """Squared chord length on the unit sphere of a great-circle distance"""
+    angle = min(distance_km / EARTH_RADIUS_KM,math.pi)
+    return (2.0 * math.sin(angle / 2.0)) ** 2
+
+
+def chord_to_km(chord_squared):
+    """Great-circle distance of a squared chord length on the unit sphere"""
+    return 2.0 * math.asin(min(1.0,math.sqrt(chord_squared) / 2.0)) * EARTH_RADIUS_KM
+
+
+class StoreIndex:
+    """
+    KD-tree over store positions for k-nearest and radius queries.
+
+    Stores are indexed by their position on the unit sphere, so the straight-line (chord)
+    distance used by the tree orders stores exactly like the great-circle distance and no
+    projection error is introduced. Queries can be filtered by chain and maximum
+    average_price_diff; filtered-out stores never count towards k.
+
+    Parameters:
+    features (list): GeoJSON point features with store properties
+    leaf_size (int): Maximum stores per leaf
+    """
+
+    def __init__(self,features,leaf_size=LEAF_SIZE):
+        self.features = [
+            feature for feature in features
+            if feature.get('geometry') and feature['geometry'].get('coordinates')
+        ]
+        self.points = []
+        self.price_diffs = []
+        self.chains = []
+        for feature in self.features:
+            lon,lat = feature['geometry']['coordinates'][:2]
+            self.points.append(to_unit_vector(lat,lon))
+            props = feature['properties']
+            diff = props.get('average_price_diff')
+            self.price_diffs.append(math.inf if diff is None else diff)
+            self.chains.append(props.get('chainname'))
+        self.by_code = {
+            feature['properties'].get('store_code'): index
+            for index,feature in enumerate(self.features)
+        }
+        self.leaf_size = leaf_size
+        self._root = self._build(list(range(len(self.points))))
+
+    def __len__(self):
+        return len(self.features)
+
+    def _build(self,indexes):
+        """
+        Build a subtree. Leaves are lists of store indexes; inner nodes are
+        (axis, split, left, right) tuples.
+        """
+        if len(indexes) <= self.leaf_size:
+            return indexes
+        points = self.points
+        # Split along the axis with the largest spread
+        spreads = [
+            max(points[i][axis] for i in indexes) - min(points[i][axis] for i in indexes)
+            for axis in range(3)
+        ]
+        axis = spreads.index(max(spreads))
+        indexes.sort(key=lambda i: points[i][axis])
+        middle = len(indexes) // 2
+        split = points[indexes[middle]][axis]
+        return (axis,split,self._build(indexes[:middle]),self._build(indexes[middle:]))
+
+    def _filter(self,max_price_diff,chains,exclude):
+        """Return a predicate on store indexes for the query filters, or None if there are none"""
+        if max_price_diff is None and chains is None and exclude is None:
+            return None
+        chains = set(chains) if chains is not None else None
+        price_diffs = self.price_diffs
+        store_chains = self.chains
+
+        def accept(index):
+            if index == exclude:
+                return False
+            if max_price_diff is not None and not price_diffs[index] <= max_price_diff:
+                return False
+            if chains is not None and store_chains[index] not in chains:
+                return False
+            return True
+        return accept
+
+    def _store_index(self,store_code):
+        if store_code is None:
+            return None
+        if store_code not in self.by_code:
+            raise KeyError(f"Unknown store_code: {store_code}")
+        return self.by_code[store_code]
+
+    def nearest(self,lat,lon,k=5,max_radius_km=None,max_price_diff=None,chains=None,exclude=None):
+        """
+        Return up to k stores nearest to a point as (distance_km, feature), nearest first.
+
+        Parameters:
+        lat, lon (float): Query point
+        k (int): Number of stores to return
+        max_radius_km (float): Optional maximum distance
+        max_price_diff (float): Only stores with average_price_diff <= this value
+        chains (iterable): Only stores of these chains
+        exclude (str): store_code to leave out (e.g. the store being queried from)
+        """
+        query = to_unit_vector(lat,lon)
+        accept = self._filter(max_price_diff,chains,self._store_index(exclude))
+        bound = km_to_chord(max_radius_km) if max_radius_km is not None else math.inf
+        points = self.points
+        # Max-heap of the k best matches as (-distance, -index)
+        best = []
+
+        def search(node):
+            if isinstance(node,list):
+                for index in node:
+                    point = points[index]
+                    dx = point[0] - query[0]
+                    dy = point[1] - query[1]
+                    dz = point[2] - query[2]
+                    distance = dx * dx + dy * dy + dz * dz
+                    if distance > bound or (accept is not None and not accept(index)):
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best,(-distance,-index))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best,(-distance,-index))
+                return
+            axis,split,left,right = node
+            offset = query[axis] - split
+            near,far = (left,right) if offset < 0 else (right,left)
+            search(near)
+            worst = -best[0][0] if len(best) == k else bound
+            if offset * offset <= worst:
+                search(far)
+
+        if k > 0:
+            search(self._root)
+        return [
+            (chord_to_km(-distance),self.features[-index])
+            for distance,index in sorted(best,reverse=True)
+        ]
+
+    def within(self,lat,lon,radius_km,max_price_diff=None,chains=None,exclude=None):
+        """
+        Return all stores within radius_km of a point as (distance_km, feature), nearest first.
+        Filters are the same as for nearest().
+        """
+        query = to_unit_vector(lat,lon)
+        accept = self._filter(max_price_diff,chains,self._store_index(exclude))
+        bound = km_to_chord(radius_km)
+        points = self.points
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node,list):
+                for index in node:
+                    point = points[index]
+                    dx = point[0] - query[0]
+                    dy = point[1] - query[1]
+                    dz = point[2] - query[2]
+                    distance = dx * dx + dy * dy + dz * dz
+                    if distance <= bound and (accept is None or accept(index)):
+                        found.append((distance,index))
+                continue
+            axis,split,left,right = node
+            offset = query[axis] - split
+            if offset < 0 or offset * offset <= bound:
+                stack.append(left)
+            if offset >= 0 or offset * offset <= bound:
+                stack.append(right)
+        found.sort()
+        return [(chord_to_km(distance),self.features[index]) for distance,index in found]
+
+    def nearest_cheaper(self,store_code,k=DEFAULT_NEIGHBOURS,max_radius_km=DEFAULT_RADIUS_KM,
+                        min_saving=DEFAULT_MIN_SAVING,chains=None):
+        """
+        Return up to k stores near a store whose average_price_diff is at least min_saving
+        percentage points lower, as (distance_km, feature), nearest first.
+        """
+        index = self._store_index(store_code)
+        price_diff = self.price_diffs[index]
+        if math.isinf(price_diff):
+            return []
+        lon,lat = self.features[index]['geometry']['coordinates'][:2]
+        return self.nearest(lat,lon,k,max_radius_km,price_diff - min_saving,chains,exclude=store_code)
+
+
+def neighbour_summary(distance_km,feature):
+    """Compact description of a neighbouring store for the store-details panel"""
+    props = feature['properties']
+    diff = props.get('average_price_diff')
+    return {
+        "store_code": props.get('store_code'),
+        "store_name": props.get('store_name'),
+        "chainname": props.get('chainname'),
+        "distance_km": round(distance_km,2),
+        "average_price_diff": round(diff,2) if diff is not None else None,
+        "coordinates": feature['geometry']['coordinates'][:2]
+    }
+
+
+def add_cheaper_neighbours(features,k=DEFAULT_NEIGHBOURS,max_radius_km=DEFAULT_RADIUS_KM,min_saving=DEFAULT_MIN_SAVING):
+    """
+    Add a cheaper_nearby property to every store feature listing its nearest cheaper
+    stores (see StoreIndex.nearest_cheaper). Features are updated in place.
+    """
+    index = StoreIndex(features)
+    with_neighbours = 0
+    for feature in index.features:
+        neighbours = index.nearest_cheaper(feature['properties'].get('store_code'),k,max_radius_km,min_saving)
+        feature['properties']['cheaper_nearby'] = [
+            neighbour_summary(distance,neighbour) for distance,neighbour in neighbours
+        ]
+        if neighbours:
+            with_neighbours += 1
+    print(f"{with_neighbours} of {len(index)} stores have a cheaper store within {max_radius_km} km")
+    return features
+
+
+def load_store_features(path):
+    """Load store features from a stores GeoJSON file or a store_price_comparisons CSV file"""
+    if path.endswith('.csv'):
+        with open(path,'r',encoding='utf-8-sig',newline='') as f:
+            reader = csv.reader(f)
+            columns = next(reader)
+            rows = [row + [''] * (len(columns) - len(row)) for row in reader]
+        sanitizer = text_sanitizer(columns,rows)
+        return [feature for feature in map(sanitizer.feature,rows) if feature is not None]
+    with open(path,'r',encoding='utf-8') as f:
+        return json.load(f)['features']
+
+
+def add_cheaper_neighbours_to_file(input_file,output_file=None,**options):
+    """
+    Write a stores GeoJSON file with the cheaper_nearby property added to every store.
+
+    Parameters:
+    input_file (str): Stores GeoJSON or store_price_comparisons CSV file
+    output_file (str): GeoJSON file to write (defaults to rewriting input_file, which must then be GeoJSON)
+    """
+    output_file = output_file or input_file
+    if output_file.endswith('.csv'):
+        raise ValueError(f"Refusing to write GeoJSON to the CSV file {output_file}")
+    features = add_cheaper_neighbours(load_store_features(input_file),**options)
+    with stream_feature_collection(output_file) as writer:
+        for feature in features:
+            writer.write_feature(feature)
+    print(f"Neighbours saved to {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query stores by location or add cheaper neighbours to the export")
+    parser.add_argument("--input",default="data/stores.geojson",help="Stores GeoJSON or CSV file")
+    subparsers = parser.add_subparsers(dest="command",required=True)
+
+    annotate_parser = subparsers.add_parser("annotate",help="Write the stores with cheaper_nearby added as GeoJSON")
+    annotate_parser.add_argument("--output",default="data/stores.geojson",help="GeoJSON file to write")
+    annotate_parser.add_argument("-k",type=int,default=DEFAULT_NEIGHBOURS,help="Neighbours per store")
+    annotate_parser.add_argument("--radius",type=float,default=DEFAULT_RADIUS_KM,help="Maximum distance in km")
+    annotate_parser.add_argument("--min-saving",type=float,default=DEFAULT_MIN_SAVING,
+                                 help="Minimum difference in average_price_diff (percentage points)")
+
+    query_parser = subparsers.add_parser("query",help="Find stores near a point")
+    query_parser.add_argument("lat",type=float)
+    query_parser.add_argument("lon",type=float)
+    query_parser.add_argument("-k",type=int,default=5,help="Number of stores")
+    query_parser.add_argument("--radius",type=float,default=None,help="Maximum distance in km")
+    query_parser.add_argument("--max-price-diff",type=float,default=None,help="Maximum average_price_diff")
+    query_parser.add_argument("--chain",action='append',default=None,help="Only this chain (repeatable)")
+    args = parser.parse_args()
+
+    if args.command == "annotate":
+        if args.output.endswith('.csv'):
+            parser.error("--output must be a GeoJSON file")
+        add_cheaper_neighbours_to_file(args.input,args.output,k=args.k,max_radius_km=args.radius,
+                                       min_saving=args.min_saving)
+    else:
+        index = StoreIndex(load_store_features(args.input))
+        start = time.perf_counter()
+        results = index.nearest(args.lat,args.lon,args.k,args.radius,args.max_price_diff,args.chain)
+        elapsed = (time.perf_counter() - start) * 1000
+        for distance,feature in results:
+            props = feature['properties']
+            print(f"{distance:6.2f} km  {props.get('store_code')}  {props.get('chainname')} - {props.get('store_name')}"
+                  f"  ({props.get('average_price_diff')})")
+        print(f"{len(results)} stores in {elapsed:.3f} ms")
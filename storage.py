@@ -0,0 +1,590 @@
+import argparse
+import csv
+import datetime
+import io
+import os
+import re
+import sqlite3
+import struct
+import time
+from pathlib import Path
+
+from pg_copy import (ALL_STORES_COLUMNS,ALLPRICES_COLUMNS,ITEMS_NEW_COLUMNS,STORE_PRICE_COMPARISONS_COLUMNS,
+                     extract_all_stores,extract_allprices,extract_items_new,load_csv_columns)
+
+try:
+    import psycopg2
+    import psycopg2.errors
+except ImportError:
+    # Optional: only the local database can be used without psycopg2
+    psycopg2 = None
+
+# Set to the path of a local database file (see snapshot) to run the extraction and debug
+# scripts against it instead of PostgreSQL
+LOCAL_DB_ENV = "EFOLIKNOT_LOCAL_DB"
+DEFAULT_LOCAL_DB = "local/prices.sqlite3"
+
+# Errors raised by either backend, for the scripts' error handling
+if psycopg2 is not None:
+    DATABASE_ERRORS = (psycopg2.Error,sqlite3.Error)
+    QUERY_CANCELED = (psycopg2.errors.QueryCanceled,)
+else:
+    DATABASE_ERRORS = (sqlite3.Error,)
+    QUERY_CANCELED = ()
+
+_SQLITE_TYPES = {
+    'int': 'INTEGER',
+    'float': 'REAL',
+    'str': 'TEXT'
+}
+
+# Tables of the local database, with the columns read by the scripts (see pg_copy.py)
+LOCAL_TABLES = {
+    'allprices': [('upload_date','str')] + ALLPRICES_COLUMNS,
+    'all_stores': ALL_STORES_COLUMNS,
+    'items_new': ITEMS_NEW_COLUMNS,
+    # The materialized views of matview_maintenance.py, stored as tables for the latest upload date
+    'popular_items_avg_prices_mv': [('itemcode','int'),('upload_date','str'),('average_price','float'),('store_count','int')],
+    'store_price_comparisons_mv': STORE_PRICE_COMPARISONS_COLUMNS
+}
+
+# The plain views read the materialized tables, so queries against either name work
+LOCAL_VIEWS = {
+    'popular_items_avg_prices': "SELECT itemcode, average_price FROM popular_items_avg_prices_mv",
+    'store_price_comparisons': "SELECT * FROM store_price_comparisons_mv"
+}
+
+# Indexes for the upload_date / itemcode / store_code access patterns of the views and exports
+# (as matview_maintenance.BASE_TABLE_INDEXES). The store_code index also holds itemcode and
+# itemprice, so a store's prices are read from the index alone in itemcode order.
+LOCAL_INDEXES = [
+    ("allprices_upload_date_itemcode_idx","allprices","(upload_date, itemcode)",False),
+    ("allprices_upload_date_store_code_idx","allprices","(upload_date, store_code, itemcode, itemprice)",False),
+    ("all_stores_store_code_idx","all_stores","(store_code)",False),
+    ("items_new_itemcode_idx","items_new","(itemcode)",False),
+    ("popular_items_avg_prices_mv_itemcode_idx","popular_items_avg_prices_mv","(itemcode)",True),
+    ("store_price_comparisons_mv_store_code_idx","store_price_comparisons_mv","(store_code)",True)
+]
+
+# Rows read ahead after a query to find the column types reported in cursor.description
+TYPE_SAMPLE_ROWS = 1000
+
+# Type codes reported in cursor.description, as PostgreSQL OIDs (see row_sanitizer.infer_pg_schema)
+_TYPE_CODES = {
+    int: 20,  # int8
+    float: 701,  # float8
+    str: 25  # text
+}
+_CAST_KINDS = {
+    'int8': 'int',
+    'float8': 'float',
+    'text': 'str'
+}
+_KIND_CONVERTERS = {
+    'int': int,
+    'float': float,
+    'str': str
+}
+
+# Header and trailer of a binary COPY stream (see pg_copy.BinaryCopyParser)
+_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii',0,0)
+_BINARY_TRAILER = struct.pack('!h',-1)
+_COPY_BUFFER_SIZE = 1 << 20
+
+_COPY_RE = re.compile(r'^\s*COPY\s*\((.*)\)\s*TO\s+STDOUT\s+WITH\s*\(\s*FORMAT\s+(\w+)\s*\)\s*;?\s*$',re.S | re.I)
+_CAST_RE = re.compile(r'::(\w+)(\[\])?')
+_NOT_ALL_RE = re.compile(r'<>\s*ALL\s*\(\s*ARRAY\s*\[(.*?)\]\s*\)',re.S | re.I)
+_SCHEMA_RE = re.compile(r'\bpublic\.')
+_PARAM_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+_SET_RE = re.compile(r'^\s*SET\s',re.I)
+
+sqlite3.register_adapter(datetime.date,datetime.date.isoformat)
+
+
+def local_db_path():
+    """Path of the local database to use instead of PostgreSQL (from EFOLIKNOT_LOCAL_DB), or None"""
+    return os.environ.get(LOCAL_DB_ENV) or None
+
+
+def describe_backend():
+    path = local_db_path()
+    if path:
+        return f"local database {path}"
+    return "PostgreSQL database from config.py"
+
+
+def connect():
+    """
+    Open a connection to the database of the run: the local database file when
+    EFOLIKNOT_LOCAL_DB is set, PostgreSQL with config.pg_config otherwise. Both connections
+    offer the psycopg2 methods the scripts use (cursors, named cursors, mogrify, copy_expert).
+    """
+    path = local_db_path()
+    if path:
+        return LocalConnection(path)
+    import psycopg2
+    import config
+
+    return psycopg2.connect(**config.pg_config)
+
+
+def cursor_class(connection,dict_rows=False):
+    """
+    Return the cursor class of a connection, e.g. to extend with RunMetrics.cursor_factory.
+
+    Parameters:
+    connection: Connection returned by connect()
+    dict_rows (bool): Return rows as dicts (psycopg2's RealDictCursor)
+    """
+    if isinstance(connection,LocalConnection):
+        return LocalDictCursor if dict_rows else LocalCursor
+    import psycopg2.extensions
+    import psycopg2.extras
+
+    return psycopg2.extras.RealDictCursor if dict_rows else psycopg2.extensions.cursor
+
+
+def translate_sql(query,has_params=True):
+    """
+    Translate the PostgreSQL dialect used by the scripts to SQLite: casts (::float8) are
+    dropped, <> ALL (ARRAY[...]) becomes NOT IN (...), the public. schema is dropped and
+    psycopg2 placeholders become SQLite ones.
+
+    Parameters:
+    query (str): PostgreSQL query
+    has_params (bool): The query is run with parameters, so %s and %% are placeholders
+    """
+    query = _SCHEMA_RE.sub('',query)
+    query = _NOT_ALL_RE.sub(r'NOT IN (\1)',query)
+    query = _CAST_RE.sub('',query)
+    if has_params:
+        query = _PARAM_RE.sub(_sqlite_placeholder,query)
+    return query
+
+
+def _sqlite_placeholder(match):
+    if match.group(1):
+        return f":{match.group(1)}"
+    return '?' if match.group(0) == '%s' else '%'
+
+
+def quote_literal(value):
+    """Quote a value as an SQL literal, as psycopg2's mogrify does"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value,bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value,(int,float)):
+        return repr(value)
+    if isinstance(value,datetime.date):
+        value = value.isoformat()
+    return "'" + str(value).replace("'","''") + "'"
+
+
+class LocalCursor:
+    """
+    Cursor of a LocalConnection with the psycopg2 cursor interface used by the scripts.
+    Queries are translated with translate_sql. The column types in description are taken
+    from the first rows of the result, since SQLite columns are not typed.
+    """
+
+    def __init__(self,connection,name=None):
+        self.connection = connection
+        self.name = name
+        self.itersize = 2000
+        self.arraysize = 1
+        self.description = None
+        self.rowcount = -1
+        self._cursor = connection.sqlite.cursor()
+        self._sample = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        self._cursor.close()
+
+    def execute(self,query,vars=None):
+        self.description = None
+        self._sample = []
+        if _SET_RE.match(query):
+            # Session settings such as statement_timeout have no local equivalent
+            return
+        self._cursor.execute(translate_sql(query,vars is not None),() if vars is None else vars)
+        self.rowcount = self._cursor.rowcount
+        if self._cursor.description is not None:
+            self._sample = self._cursor.fetchmany(TYPE_SAMPLE_ROWS)
+            self.description = self._describe([column[0] for column in self._cursor.description])
+
+    def _describe(self,names):
+        description = []
+        for index,name in enumerate(names):
+            kind = next((type(row[index]) for row in self._sample if row[index] is not None),str)
+            description.append((name,_TYPE_CODES.get(kind,25),None,None,None,None,None))
+        return description
+
+    def mogrify(self,query,vars=None):
+        """Return the query with its parameters quoted in, as bytes (like psycopg2)"""
+        if vars is None:
+            return query.encode('utf-8')
+        if isinstance(vars,dict):
+            values = {name: quote_literal(value) for name,value in vars.items()}
+        else:
+            values = iter([quote_literal(value) for value in vars])
+
+        def substitute(match):
+            if match.group(1):
+                return values[match.group(1)]
+            return next(values) if match.group(0) == '%s' else '%'
+        return _PARAM_RE.sub(substitute,query).encode('utf-8')
+
+    def _fetch(self,size):
+        rows = self._sample[:size]
+        del self._sample[:size]
+        if len(rows) < size:
+            rows += self._cursor.fetchmany(size - len(rows))
+        return rows
+
+    def _row(self,row):
+        return row
+
+    def fetchone(self):
+        rows = self._fetch(1)
+        return self._row(rows[0]) if rows else None
+
+    def fetchmany(self,size=None):
+        return [self._row(row) for row in self._fetch(self.arraysize if size is None else size)]
+
+    def fetchall(self):
+        rows = self._sample + self._cursor.fetchall()
+        self._sample = []
+        return [self._row(row) for row in rows]
+
+    def copy_expert(self,sql,file,size=8192):
+        """
+        Run COPY (SELECT ...) TO STDOUT WITH (FORMAT binary|csv) and write the output to file
+        in the same format as PostgreSQL, so pg_copy's parsers read it unchanged. Values are
+        converted to the kinds of the select list's casts (as written by pg_copy.build_copy_sql).
+        """
+        match = _COPY_RE.match(sql)
+        if not match:
+            raise sqlite3.NotSupportedError("Only COPY (SELECT ...) TO STDOUT is supported by the local database")
+        query,copy_format = match.group(1),match.group(2).lower()
+        select_list = re.split(r'\bFROM\b',query,maxsplit=1,flags=re.I)[0]
+        kinds = [_CAST_KINDS.get(cast) for cast,array in _CAST_RE.findall(select_list)]
+
+        if copy_format not in ('binary','csv'):
+            raise ValueError(f"Unknown COPY format: {copy_format}")
+
+        self.execute(query)
+        if len(kinds) != len(self.description):
+            # Not written by build_copy_sql: the values are copied as stored
+            kinds = [None] * len(self.description)
+        converters = [_KIND_CONVERTERS.get(kind) for kind in kinds]
+        encode_row = _binary_encoder(kinds) if copy_format == 'binary' else _csv_encoder()
+
+        chunks = [_BINARY_HEADER] if copy_format == 'binary' else []
+        buffered = 0
+        while True:
+            rows = self._fetch(self.itersize)
+            if not rows:
+                break
+            for row in rows:
+                data = encode_row([
+                    value if value is None or convert is None else convert(value)
+                    for value,convert in zip(row,converters)
+                ])
+                chunks.append(data)
+                buffered += len(data)
+            if buffered >= _COPY_BUFFER_SIZE:
+                file.write(b''.join(chunks))
+                chunks = []
+                buffered = 0
+        if copy_format == 'binary':
+            chunks.append(_BINARY_TRAILER)
+        if chunks:
+            file.write(b''.join(chunks))
+
+
+class LocalDictCursor(LocalCursor):
+    """LocalCursor returning rows as dicts (psycopg2's RealDictCursor)"""
+
+    def execute(self,query,vars=None):
+        super().execute(query,vars)
+        self._names = [column[0] for column in self.description or ()]
+
+    def _row(self,row):
+        return dict(zip(self._names,row))
+
+
+def _binary_encoder(kinds):
+    """Encode rows as binary COPY tuples of int8, float8 and text fields"""
+    count = struct.pack('!h',len(kinds))
+    null = struct.pack('!i',-1)
+    int8 = struct.Struct('!iq')
+    float8 = struct.Struct('!id')
+    length = struct.Struct('!i')
+
+    def encode(row):
+        fields = [count]
+        for value,kind in zip(row,kinds):
+            if value is None:
+                fields.append(null)
+            elif kind == 'int' or (kind is None and isinstance(value,int)):
+                fields.append(int8.pack(8,value))
+            elif kind == 'float' or (kind is None and isinstance(value,float)):
+                fields.append(float8.pack(8,value))
+            else:
+                data = str(value).encode('utf-8')
+                fields.append(length.pack(len(data)))
+                fields.append(data)
+        return b''.join(fields)
+    return encode
+
+
+def _csv_encoder():
+    """Encode rows as CSV COPY records (NULL is an empty field)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer,lineterminator='\n')
+
+    def encode(row):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(['' if value is None else value for value in row])
+        return buffer.getvalue().encode('utf-8')
+    return encode
+
+
+class LocalConnection:
+    """
+    Read-only connection to a local database file, with the parts of the psycopg2
+    connection interface used by the scripts.
+
+    Parameters:
+    path (str): Path of the local database (see snapshot)
+    """
+
+    def __init__(self,path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Local database {path} not found; create it with python storage.py snapshot")
+        self.path = path
+        self.autocommit = False
+        # Pooled connections are borrowed by the extraction threads, so any thread may use them
+        self.sqlite = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro",uri=True,check_same_thread=False)
+        self.sqlite.execute(f"PRAGMA mmap_size = {1 << 30}")
+
+    @property
+    def closed(self):
+        return self.sqlite is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def cursor(self,name=None,cursor_factory=None):
+        return (cursor_factory or LocalCursor)(self,name)
+
+    def commit(self):
+        self.sqlite.commit()
+
+    def rollback(self):
+        self.sqlite.rollback()
+
+    def close(self):
+        if self.sqlite is not None:
+            self.sqlite.close()
+            self.sqlite = None
+
+
+class LocalConnectionPool:
+    """
+    Stand-in for psycopg2's ThreadedConnectionPool over a local database file (see
+    pg_extract.get_pool). Every borrowed connection is a new SQLite connection.
+    """
+
+    def __init__(self,path,maxconn):
+        self.path = path
+        self.maxconn = maxconn
+        self.closed = False
+
+    def getconn(self):
+        return LocalConnection(self.path)
+
+    def putconn(self,connection):
+        connection.close()
+
+    def closeall(self):
+        self.closed = True
+
+
+def _create_table(db,name,columns):
+    column_list = ', '.join(f"{column} {_SQLITE_TYPES[kind]}" for column,kind in columns)
+    db.execute(f"CREATE TABLE {name} ({column_list})")
+
+
+def _insert_rows(db,name,columns,rows):
+    placeholders = ', '.join('?' * len(columns))
+    db.executemany(f"INSERT INTO {name} VALUES ({placeholders})",rows)
+
+
+def write_local_db(path,stores,items,price_tables):
+    """
+    Write a local database: the all_stores and items_new tables, the allprices of every
+    upload date, the materialized views (computed with price_aggregation.py for the latest
+    date), indexes and planner statistics. The file is written under a temporary name and
+    renamed into place when complete.
+
+    Parameters:
+    path (str): Path of the local database
+    stores: all_stores ColumnTable
+    items: items_new ColumnTable
+    price_tables (iterable): (upload_date, allprices ColumnTable) pairs, read one at a time
+    """
+    from price_aggregation import aggregate_prices,encode_price_data
+
+    os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    db = sqlite3.connect(temp_path)
+    try:
+        # A snapshot is written once, so durability during the load is not needed
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        for name,columns in LOCAL_TABLES.items():
+            _create_table(db,name,columns)
+        for name,query in LOCAL_VIEWS.items():
+            db.execute(f"CREATE VIEW {name} AS {query}")
+
+        _insert_rows(db,'all_stores',ALL_STORES_COLUMNS,stores.rows())
+        _insert_rows(db,'items_new',ITEMS_NEW_COLUMNS,items.rows())
+
+        latest_date = latest_prices = None
+        for upload_date,prices in price_tables:
+            upload_date = str(upload_date)
+            print(f"Writing {len(prices):,} prices for {upload_date}...")
+            _insert_rows(db,'allprices',LOCAL_TABLES['allprices'],((upload_date,) + row for row in prices.rows()))
+            if latest_date is None or upload_date > latest_date:
+                latest_date,latest_prices = upload_date,prices
+
+        if latest_prices is not None:
+            print(f"Computing the materialized views for {latest_date}...")
+            result = aggregate_prices(encode_price_data(latest_prices,stores),known_items=items['itemcode'])
+            popular_ids = result.popular.nonzero()[0]
+            _insert_rows(db,'popular_items_avg_prices_mv',LOCAL_TABLES['popular_items_avg_prices_mv'],(
+                (int(result.data.itemcodes[item_id]),latest_date,float(result.average_prices[item_id]),
+                 int(result.item_store_counts[item_id]))
+                for item_id in popular_ids
+            ))
+            _insert_rows(db,'store_price_comparisons_mv',STORE_PRICE_COMPARISONS_COLUMNS,result.store_rows())
+
+        print("Creating indexes...")
+        for index_name,table,columns,unique in LOCAL_INDEXES:
+            db.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX {index_name} ON {table} {columns}")
+        db.execute("ANALYZE")
+        db.commit()
+    finally:
+        db.close()
+    os.replace(temp_path,path)
+
+
+def snapshot_postgres(path,upload_dates):
+    """
+    Snapshot allprices for the given upload dates, all_stores and items_new from PostgreSQL
+    (config.pg_config) into a local database, extracting every table with COPY.
+
+    Parameters:
+    path (str): Path of the local database
+    upload_dates (list): Upload dates to copy (YYYY-MM-DD)
+    """
+    import psycopg2
+    import config
+
+    print("Connecting to PostgreSQL database...")
+    pg_conn = psycopg2.connect(**config.pg_config)
+    try:
+        with pg_conn.cursor() as pg_cursor:
+            print("Copying all_stores and items_new...")
+            stores = extract_all_stores(pg_cursor)
+            items = extract_items_new(pg_cursor)
+
+            def price_tables():
+                for upload_date in upload_dates:
+                    print(f"Copying allprices for {upload_date}...")
+                    yield upload_date,extract_allprices(pg_cursor,upload_date)
+
+            write_local_db(path,stores,items,price_tables())
+    finally:
+        pg_conn.close()
+        print(f"Database connection closed")
+
+
+def snapshot_source(path,source_dir,upload_date):
+    """
+    Write a local database from the allprices.csv, all_stores.csv and items_new.csv files in
+    source_dir (as written by synthetic_data.py), as prices of one upload date.
+    """
+    stores = load_csv_columns(os.path.join(source_dir,'all_stores.csv'),ALL_STORES_COLUMNS)
+    items = load_csv_columns(os.path.join(source_dir,'items_new.csv'),ITEMS_NEW_COLUMNS)
+    prices = load_csv_columns(os.path.join(source_dir,'allprices.csv'),ALLPRICES_COLUMNS)
+    write_local_db(path,stores,items,[(upload_date,prices)])
+
+
+def print_status(path):
+    """Print the upload dates and table sizes of a local database"""
+    connection = LocalConnection(path)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT upload_date, COUNT(*) FROM allprices GROUP BY upload_date ORDER BY upload_date")
+            for upload_date,count in cursor.fetchall():
+                print(f"  {upload_date}: {count:,} prices")
+            for table in LOCAL_TABLES:
+                if table != 'allprices':
+                    cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                    print(f"  {table}: {cursor.fetchone()[0]:,} rows")
+    finally:
+        connection.close()
+    print(f"{path}: {os.path.getsize(path) / (1024 * 1024):.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot PostgreSQL tables into a local database file")
+    parser.add_argument("--db",default=None,help=f"Local database file (default ${LOCAL_DB_ENV} or {DEFAULT_LOCAL_DB})")
+    subparsers = parser.add_subparsers(dest="command",required=True)
+
+    snapshot_parser = subparsers.add_parser("snapshot",help="Copy allprices, all_stores and items_new into the local database")
+    snapshot_parser.add_argument("upload_dates",nargs='+',help="Upload dates to copy (YYYY-MM-DD)")
+    snapshot_parser.add_argument("--source",default=None,metavar="DIR",
+                                 help="Read the tables from the CSV files in DIR (see synthetic_data.py) instead of PostgreSQL")
+
+    subparsers.add_parser("status",help="List the upload dates and table sizes")
+    args = parser.parse_args()
+
+    path = args.db or local_db_path() or DEFAULT_LOCAL_DB
+    if args.command == "snapshot":
+        start = time.perf_counter()
+        if args.source:
+            if len(args.upload_dates) != 1:
+                parser.error("--source holds the prices of a single upload date")
+            snapshot_source(path,args.source,args.upload_dates[0])
+        else:
+            snapshot_postgres(path,args.upload_dates)
+        print(f"Local database written to {path} in {time.perf_counter() - start:.1f}s")
+        print(f"Set {LOCAL_DB_ENV}={path} to run the scripts against it")
+    else:
+        print_status(path)
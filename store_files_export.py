@@ -0,0 +1,694 @@
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import math
+import os
+from concurrent.futures import FIRST_COMPLETED,ProcessPoolExecutor,wait
+
+import numpy as np
+
+from build_manifest import BuildManifest,hash_bytes,hash_file,hash_rows
+from geojson_stream import atomic_open
+from price_aggregation import DEFAULT_POPULARITY_THRESHOLD,EXCLUDED_CHAINS,EXCLUDED_SUBCHAINS
+from search_index import (build_search_index,encode_search_index,index_file_path,name_sort_key,normalize_text,
+                          sort_permutation)
+
+try:
+    import brotli
+except ImportError:
+    # Optional: .br siblings are only written when the brotli package is installed
+    brotli = None
+
+
+def _sql_array(values):
+    """PostgreSQL ARRAY[...] literal of strings, for the <> ALL filters"""
+    return "ARRAY[" + ", ".join("'" + value.replace("'","''") + "'" for value in values) + "]"
+
+
+# One bulk query for every store's prices, ordered so rows can be partitioned by store_code
+# as they arrive. The per-store average_price_diff is computed from price_diff_pct while
+# writing, so the slow store_price_comparisons view is not needed here. The popular items
+# view is not used either: it covers a single upload_date (pinned in production, the latest
+# date locally), so the popular items and their average prices are computed for the requested
+# date in the query, with the filters and threshold of price_aggregation.py and
+# matview_maintenance.py. The date is passed twice (see store_prices_params).
+STORE_PRICES_SELECT = f"""
+    WITH popular AS (
+        SELECT p.itemcode, avg(p.itemprice) AS average_price
+        FROM allprices p
+        JOIN all_stores s ON s.store_code = p.store_code
+        WHERE p.upload_date = %s
+            AND p.itemprice > 0
+            AND s.chainname <> ALL ({_sql_array(EXCLUDED_CHAINS)})
+            AND s.subchainname <> ALL ({_sql_array(EXCLUDED_SUBCHAINS)})
+            AND EXISTS (SELECT 1 FROM items_new i WHERE i.itemcode = p.itemcode)
+        GROUP BY p.itemcode
+        HAVING count(DISTINCT p.store_code) > {DEFAULT_POPULARITY_THRESHOLD}
+    )
+    SELECT
+        s.store_code,
+        s.storename AS store_name,
+        s.chainname,
+        s.subchainname,
+        s.city,
+        s.latitude::float8,
+        s.longitude::float8,
+        p.itemcode,
+        i.itemname,
+        i.manufacturer,
+        i.brand,
+        i.category,
+        p.itemprice::float8 AS price,
+        a.average_price::float8,
+        (CASE
+            WHEN a.average_price > 0 THEN (p.itemprice - a.average_price) / a.average_price * 100
+            ELSE NULL
+        END)::float8 AS price_diff_pct
+    FROM allprices p
+    JOIN all_stores s ON s.store_code = p.store_code
+    LEFT JOIN items_new i ON i.itemcode = p.itemcode
+    LEFT JOIN popular a ON a.itemcode = p.itemcode
+    WHERE p.upload_date = %s
+        AND p.itemprice > 0
+        AND p.itemprice IS NOT NULL"""
+STORE_PRICES_QUERY = STORE_PRICES_SELECT + """
+    ORDER BY s.store_code, p.itemcode;
+    """
+
+# STORE_PRICES_QUERY restricted to one partition of the stores (see pg_extract.py)
+PARTITIONED_STORE_PRICES_QUERY = STORE_PRICES_SELECT + """
+        AND {partition}
+    ORDER BY s.store_code, p.itemcode;
+    """
+
+
+def store_prices_params(upload_date):
+    """Parameters of STORE_PRICES_QUERY for one upload_date: the popular items CTE and the prices"""
+    return (upload_date,upload_date)
+
+
+# Positions of the store header columns and the price columns in STORE_PRICES_QUERY rows
+STORE_COLUMNS = ('store_code','store_name','chainname','subchainname','city','latitude','longitude')
+PRICE_COLUMNS = ('itemcode','itemname','manufacturer','brand','category','price','average_price','price_diff_pct')
+_PRICE_START = len(STORE_COLUMNS)
+
+# Item description fields moved to the shared items catalog when exporting with catalog=True
+ITEM_FIELDS = ('itemname','manufacturer','brand','category')
+
+# Decimal places kept in the compact layout: prices are rounded to agorot
+COMPACT_ROUNDING = {
+    'price': 2,
+    'average_price': 2,
+    'price_diff_pct': 2
+}
+
+# Export options accepted by export_store_files and passed to the workers
+DEFAULT_OPTIONS = {
+    'compact': False,  # minified columnar layout, prices rounded to agorot
+    'compress': False,  # pre-compressed .gz/.br siblings
+    'catalog': False,  # item descriptions in a shared catalog instead of every store file
+    'search_index': False,  # <store_code>.index.json with n-gram search postings and sort orders
+    'page_size': 0  # if set, also write <store_code>/ with a header and pages of this many items
+}
+
+# Items per page written with --pages
+DEFAULT_PAGE_SIZE = 500
+
+# Number of store partitions queued per worker before the reader waits for writers to catch up
+MAX_PENDING_PER_WORKER = 2
+
+
+def clean_number(value):
+    """Return value as a float, or None if it is NULL, NaN or Infinity"""
+    if value is None:
+        return None
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def round_or_none(value,digits):
+    """Round value to the given number of decimal places, keeping None as-is"""
+    return None if value is None else round(value,digits)
+
+
+def to_columnar(prices,fields):
+    """
+    Convert a list of price dicts to the compact columnar layout: one array per field,
+    with prices rounded to agorot.
+
+    Parameters:
+    prices (list): Price dicts as built by build_store_document
+    fields (sequence): Fields to include, in order
+    """
+    columns = {}
+    for field in fields:
+        digits = COMPACT_ROUNDING.get(field)
+        if digits is None:
+            columns[field] = [price[field] for price in prices]
+        else:
+            columns[field] = [round_or_none(price[field],digits) for price in prices]
+    return columns
+
+
+def build_store_document(rows,columnar=False,catalog=False):
+    """
+    Build the JSON document for one store from its STORE_PRICES_QUERY rows.
+    All NaN/Infinity values are replaced with None so the output is strict JSON.
+
+    Parameters:
+    rows (list): Rows of a single store, ordered by itemcode
+    columnar (bool): Store prices as parallel arrays (see to_columnar) instead of one dict per item
+    catalog (bool): Leave out the item descriptions, which are written to the shared items catalog
+    """
+    first = rows[0]
+    prices = []
+    diffs = []
+    for row in rows:
+        price_diff_pct = clean_number(row[_PRICE_START + 7])
+        if price_diff_pct is not None:
+            diffs.append(price_diff_pct)
+        price = {"itemcode": row[_PRICE_START]}
+        if not catalog:
+            price["itemname"] = row[_PRICE_START + 1]
+            price["manufacturer"] = row[_PRICE_START + 2]
+            price["brand"] = row[_PRICE_START + 3]
+            price["category"] = row[_PRICE_START + 4]
+        price["price"] = clean_number(row[_PRICE_START + 5])
+        price["average_price"] = clean_number(row[_PRICE_START + 6])
+        price["price_diff_pct"] = price_diff_pct
+        prices.append(price)
+
+    average_price_diff = sum(diffs) / len(diffs) if diffs else None
+    if columnar:
+        average_price_diff = round_or_none(average_price_diff,COMPACT_ROUNDING['price_diff_pct'])
+
+    fields = [field for field in PRICE_COLUMNS if not (catalog and field in ITEM_FIELDS)]
+    document = {
+        "store_code": first[0],
+        "store_name": first[1],
+        "chainname": first[2],
+        "subchainname": first[3],
+        "city": first[4],
+        "latitude": clean_number(first[5]),
+        "longitude": clean_number(first[6]),
+        "average_price_diff": average_price_diff,
+        "item_count": len(prices),
+        "prices": to_columnar(prices,fields) if columnar else prices
+    }
+    if catalog:
+        # Tells the front end to take item descriptions from data/items_catalog.json
+        document["catalog"] = True
+    return document
+
+
+def encode_store_document(document,compact=False):
+    """
+    Serialize a store document to UTF-8 JSON bytes.
+
+    Parameters:
+    document (dict): Document from build_store_document
+    compact (bool): Minify the output instead of indenting it
+    """
+    if compact:
+        text = json.dumps(document,ensure_ascii=False,allow_nan=False,separators=(',',':'))
+    else:
+        text = json.dumps(document,ensure_ascii=False,allow_nan=False,indent=2)
+    return text.encode('utf-8')
+
+
+def write_precompressed(output_file,data):
+    """
+    Write .gz (and .br, if brotli is installed) siblings of output_file so a static host
+    can serve them pre-compressed. gzip output has a fixed mtime so it is reproducible.
+    Returns {path: content hash} of the files written.
+
+    Parameters:
+    output_file (str): Path of the uncompressed file
+    data (bytes): Uncompressed file contents
+    """
+    written = {}
+    compressed = gzip.compress(data,compresslevel=9,mtime=0)
+    with atomic_open(output_file + '.gz','wb') as f:
+        f.write(compressed)
+    written[output_file + '.gz'] = hash_bytes(compressed)
+    if brotli is not None:
+        compressed = brotli.compress(data,mode=brotli.MODE_TEXT)
+        with atomic_open(output_file + '.br','wb') as f:
+            f.write(compressed)
+        written[output_file + '.br'] = hash_bytes(compressed)
+    return written
+
+
+def write_data_file(output_file,data,compress=False):
+    """
+    Atomically write a generated file, plus its pre-compressed siblings if compress is set.
+    Returns {path: content hash} of the files written.
+    """
+    with atomic_open(output_file,'wb') as f:
+        f.write(data)
+    written = {output_file: hash_bytes(data)}
+    if compress:
+        written.update(write_precompressed(output_file,data))
+    return written
+
+
+def index_prices(rows):
+    """
+    Price dicts for build_search_index, taken from the rows so item names are indexed even
+    when the store file leaves them to the catalog.
+    """
+    prices = []
+    for row in rows:
+        price = dict(zip(PRICE_COLUMNS,row[_PRICE_START:_PRICE_START + len(PRICE_COLUMNS)]))
+        price['price'] = clean_number(price['price'])
+        price['price_diff_pct'] = clean_number(price['price_diff_pct'])
+        prices.append(price)
+    return prices
+
+
+def write_store_pages(output_dir,rows,document,options):
+    """
+    Write the paged layout of one store to <output_dir>/<store_code>/: header.json with the
+    store metadata and the page index, and 1.json, 2.json, ... with page_size items each.
+    Items are in the price table's default order (by normalized item name), so the map can
+    render the first page without downloading the rest of the store. With search_index set,
+    a search index over the page order is written to search.json.
+    Pages left over from a previous, larger export are removed.
+    Returns {path: content hash} of the files written.
+
+    Parameters:
+    output_dir (str): Directory for the per-store files
+    rows (list): Rows of a single store, ordered by itemcode
+    document (dict): The store's document from build_store_document
+    options (dict): Export options (see DEFAULT_OPTIONS)
+    """
+    page_size = options['page_size']
+    store_dir = os.path.join(output_dir,document['store_code'])
+    os.makedirs(store_dir,exist_ok=True)
+
+    names = [normalize_text(row[_PRICE_START + 1]) for row in rows]
+    sorted_rows = [rows[row] for row in sort_permutation(names,name_sort_key)]
+    prices = build_store_document(sorted_rows,columnar=options['compact'],catalog=options['catalog'])['prices']
+    item_count = len(sorted_rows)
+
+    written = {}
+    pages = []
+    for start in range(0,item_count,page_size):
+        if options['compact']:
+            page_prices = {field: values[start:start + page_size] for field,values in prices.items()}
+        else:
+            page_prices = prices[start:start + page_size]
+        page = {"page": len(pages) + 1,"prices": page_prices}
+        if options['catalog']:
+            page["catalog"] = True
+        file_name = f"{page['page']}.json"
+        written.update(write_data_file(os.path.join(store_dir,file_name),encode_store_document(page,options['compact']),options['compress']))
+        pages.append({"file": file_name,"count": min(page_size,item_count - start)})
+
+    header = {key: value for key,value in document.items() if key != 'prices'}
+    header.update({"page_size": page_size,"sort": "name","pages": pages})
+    if options['search_index']:
+        index_data = encode_search_index(build_search_index(index_prices(sorted_rows)))
+        written.update(write_data_file(os.path.join(store_dir,"search.json"),index_data,options['compress']))
+        header["search_index"] = "search.json"
+    written.update(write_data_file(os.path.join(store_dir,"header.json"),encode_store_document(header,options['compact']),options['compress']))
+
+    page_files = {page['file'] for page in pages}
+    for old_file in glob.glob(os.path.join(store_dir,"*.json*")):
+        name = os.path.basename(old_file).split('.')[0]
+        if name.isdigit() and f"{name}.json" not in page_files:
+            os.remove(old_file)
+    return written
+
+
+def page_size_argument(value):
+    """argparse type of --pages: a page holds at least one item"""
+    size = int(value)
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"page size must be at least 1, got {value}")
+    return size
+
+
+def write_store_file(output_dir,rows,options,previous_source=None):
+    """
+    Write data/store_files/<store_code>.json for one store. Runs in a worker process.
+
+    Returns a dict with the store_code, the store summary (the document without its prices),
+    the source hash of the rows, the {path: hash} of the files written and the bytes written.
+    If previous_source matches the source hash nothing is written and files is None.
+
+    Parameters:
+    output_dir (str): Directory for the per-store files
+    rows (list): Rows of a single store, ordered by itemcode
+    options (dict): Export options (see DEFAULT_OPTIONS)
+    previous_source (str): Source hash recorded by the previous incremental build, if any
+    """
+    result = {'store_code': rows[0][0],'summary': None,'source': None,'files': None,'bytes': 0}
+    if previous_source is not None:
+        # Export options are part of the hash so a layout change rewrites every store
+        result['source'] = hash_rows(rows,salt=sorted(options.items()))
+        if result['source'] == previous_source:
+            return result
+
+    document = build_store_document(rows,columnar=options['compact'],catalog=options['catalog'])
+    data = encode_store_document(document,options['compact'])
+    output_file = os.path.join(output_dir,f"{document['store_code']}.json")
+    result['files'] = write_data_file(output_file,data,options['compress'])
+    if options['search_index']:
+        index_data = encode_search_index(build_search_index(index_prices(rows)))
+        result['files'].update(write_data_file(index_file_path(output_file),index_data,options['compress']))
+    if options['page_size']:
+        result['files'].update(write_store_pages(output_dir,rows,document,options))
+    result['summary'] = store_summary(document)
+    result['bytes'] = len(data)
+    return result
+
+
+def store_summary(document):
+    """The entry of a store in the summary file: its document without the prices"""
+    return {key: value for key,value in document.items() if key not in ('prices','subchainname','catalog')}
+
+
+def store_summaries(rows):
+    """
+    Build the summary of every store from rows ordered by store_code without writing the
+    store files, e.g. to refresh the summary file alone.
+
+    Parameters:
+    rows (iterable): STORE_PRICES_QUERY rows ordered by store_code
+    """
+    return [store_summary(build_store_document(partition)) for partition in partition_by_store(rows)]
+
+
+def write_summary_file(summaries,summary_file,manifest=None):
+    """
+    Write the JSON list of store summaries, sorted by store_code, and return its hash.
+
+    Parameters:
+    summaries (list): Store summaries (see store_summary)
+    summary_file (str): Path of the summary file
+    manifest (BuildManifest): Optional manifest to record the file in
+    """
+    summaries.sort(key=lambda summary: summary['store_code'])
+    data = json.dumps(summaries,ensure_ascii=False,allow_nan=False,indent=2).encode('utf-8')
+    with atomic_open(summary_file,'wb') as f:
+        f.write(data)
+    digest = hash_bytes(data)
+    if manifest is not None:
+        manifest.record("summary",digest,{summary_file: digest})
+    return digest
+
+
+def collect_items(rows,items):
+    """
+    Pass rows through unchanged while recording each item's description in items.
+
+    Parameters:
+    rows (iterable): STORE_PRICES_QUERY rows
+    items (dict): itemcode -> list of ITEM_FIELDS values, filled in place
+    """
+    for row in rows:
+        itemcode = row[_PRICE_START]
+        if itemcode not in items:
+            items[itemcode] = list(row[_PRICE_START + 1:_PRICE_START + 1 + len(ITEM_FIELDS)])
+        yield row
+
+
+def write_item_catalog(items,output_dir,compress=False):
+    """
+    Write the shared items catalog as data/items.<hash>.json, named by a hash of its
+    contents so it can be cached indefinitely, and point data/items_catalog.json at it.
+    Older catalog versions are removed. Returns the catalog file name.
+
+    Parameters:
+    items (dict): itemcode -> list of ITEM_FIELDS values
+    output_dir (str): Directory for the catalog files (the parent of store_files)
+    compress (bool): Also write pre-compressed .gz/.br siblings
+    """
+    catalog = {
+        "fields": list(ITEM_FIELDS),
+        "items": {str(itemcode): items[itemcode] for itemcode in sorted(items)}
+    }
+    data = json.dumps(catalog,ensure_ascii=False,allow_nan=False,separators=(',',':')).encode('utf-8')
+    version = hashlib.sha256(data).hexdigest()[:16]
+    file_name = f"items.{version}.json"
+    catalog_file = os.path.join(output_dir,file_name)
+
+    # The file name is the content hash, so an existing file is already up to date
+    if not os.path.exists(catalog_file):
+        with atomic_open(catalog_file,'wb') as f:
+            f.write(data)
+    if compress and not os.path.exists(catalog_file + '.gz'):
+        write_precompressed(catalog_file,data)
+
+    pointer = {"version": version,"file": file_name,"item_count": len(items)}
+    with atomic_open(os.path.join(output_dir,"items_catalog.json"),'w') as f:
+        json.dump(pointer,f,ensure_ascii=False,indent=2)
+
+    for old_file in glob.glob(os.path.join(output_dir,"items.*.json*")):
+        if not os.path.basename(old_file).startswith(file_name):
+            os.remove(old_file)
+
+    print(f"Wrote items catalog {file_name} with {len(items):,} items")
+    return file_name
+
+
+def partition_by_store(rows):
+    """
+    Group rows ordered by store_code into one list per store.
+
+    Parameters:
+    rows (iterable): Rows ordered by store_code (first column)
+    """
+    current_code = None
+    partition = []
+    for row in rows:
+        if row[0] != current_code:
+            if partition:
+                yield partition
+            current_code = row[0]
+            partition = []
+        partition.append(row)
+    if partition:
+        yield partition
+
+
+def store_price_rows(result,items):
+    """
+    Yield STORE_PRICES_QUERY rows computed in Python from an aggregation (see
+    price_aggregation.py) and the items_new table, instead of running the query.
+    Like the query, every store with a positive price is included, also those left out
+    of the comparison, and rows are ordered by store_code, itemcode.
+
+    Parameters:
+    result (AggregationResult): Aggregation of the upload date, computed with known_items
+                                so the average prices match popular_items_avg_prices
+    items: items_new ColumnTable (see pg_copy.extract_items_new)
+    """
+    data = result.data
+    stores = data.stores
+    store_codes = stores['store_code']
+    rows = np.flatnonzero((data.store_ids >= 0) & (data.prices > 0))
+
+    store_rank = np.empty(len(store_codes),dtype=np.int64)
+    store_rank[sorted(range(len(store_codes)),key=store_codes.__getitem__)] = np.arange(len(store_codes))
+    store_ids = data.store_ids[rows]
+    item_ids = data.item_ids[rows]
+    order = np.lexsort((data.itemcodes[item_ids],store_rank[store_ids]))
+    rows,store_ids,item_ids = rows[order],store_ids[order],item_ids[order]
+
+    prices = data.prices[rows]
+    average_prices = result.average_prices[item_ids]
+    price_diffs = (prices - average_prices) / average_prices * 100
+
+    item_index = {itemcode: index for index,itemcode in enumerate(items['itemcode'])}
+    descriptions = [items[field] for field in ITEM_FIELDS]
+    missing = (None,) * len(ITEM_FIELDS)
+    store_fields = [stores[name] for name in ('store_code','storename','chainname','subchainname','city','latitude','longitude')]
+
+    for store_id,itemcode,price,average_price,price_diff in zip(
+            store_ids.tolist(),data.itemcodes[item_ids].tolist(),prices.tolist(),average_prices.tolist(),price_diffs.tolist()):
+        item = item_index.get(itemcode)
+        yield (
+            *(field[store_id] for field in store_fields),
+            itemcode,
+            *(missing if item is None else (field[item] for field in descriptions)),
+            price,
+            None if math.isnan(average_price) else average_price,
+            None if math.isnan(price_diff) else price_diff
+        )
+
+
+def export_store_files(rows,output_dir,summary_file=None,workers=None,manifest=None,**options):
+    """
+    Write one JSON file per store from rows ordered by store_code, using a process pool
+    so the per-store serialization runs on all cores. Only a bounded number of store
+    partitions is queued at a time, so memory does not grow with the number of stores.
+
+    Parameters:
+    rows (iterable): STORE_PRICES_QUERY rows ordered by store_code
+    output_dir (str): Directory for the per-store files
+    summary_file (str): Optional path for a JSON list of all store summaries
+    workers (int): Number of worker processes (defaults to the CPU count)
+    manifest (BuildManifest): Optional manifest for an incremental build. Only stores whose
+             rows changed since the recorded build are rewritten, files of stores that no
+             longer have prices are removed, and the manifest is updated (but not saved).
+    options: Export options, see DEFAULT_OPTIONS. With catalog=True the item descriptions
+             are written once to a shared catalog next to output_dir.
+    """
+    options = dict(DEFAULT_OPTIONS,**options)
+    os.makedirs(output_dir,exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    summaries = []
+    total_bytes = 0
+    seen_keys = set()
+    unchanged = 0
+
+    def collect(result):
+        nonlocal total_bytes,unchanged
+        key = f"store:{result['store_code']}"
+        seen_keys.add(key)
+        if result['files'] is None:
+            unchanged += 1
+            summaries.append(manifest.get(key)['meta'])
+            return
+        summaries.append(result['summary'])
+        total_bytes += result['bytes']
+        if manifest is not None:
+            manifest.record(key,result['source'],result['files'],meta=result['summary'])
+
+    def previous_source(store_code):
+        if manifest is None:
+            return None
+        key = f"store:{store_code}"
+        entry = manifest.get(key)
+        # An empty string never matches a hash, but still asks the worker to compute one
+        if entry and 'meta' in entry and manifest.is_current(key,entry['source']):
+            return entry['source']
+        return ''
+
+    items = {}
+    if options['catalog']:
+        rows = collect_items(rows,items)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for partition in partition_by_store(rows):
+            if len(pending) >= workers * MAX_PENDING_PER_WORKER:
+                done,pending = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future.result())
+            pending.add(pool.submit(write_store_file,output_dir,partition,options,previous_source(partition[0][0])))
+
+        for future in pending:
+            collect(future.result())
+
+    if options['catalog']:
+        catalog_dir = os.path.dirname(os.path.abspath(output_dir))
+        file_name = write_item_catalog(items,catalog_dir,options['compress'])
+        if manifest is not None:
+            catalog_files = [os.path.join(catalog_dir,name) for name in (file_name,"items_catalog.json")]
+            if options['compress']:
+                catalog_files += glob.glob(os.path.join(catalog_dir,file_name + '.*'))
+            manifest.record("catalog",file_name,{path: hash_file(path) for path in catalog_files})
+
+    if manifest is not None:
+        for key in manifest.keys("store:"):
+            if key not in seen_keys:
+                print(f"Removing files of {key[len('store:'):]}, which has no prices in this build")
+                manifest.remove(key)
+        print(f"{unchanged} of {len(summaries)} stores unchanged since the previous build")
+
+    summaries.sort(key=lambda summary: summary['store_code'])
+    if summary_file:
+        write_summary_file(summaries,summary_file,manifest)
+
+    print(f"Wrote {len(summaries) - unchanged} store files ({total_bytes:,} bytes) to {output_dir}")
+    return summaries
+
+
+def postgres_to_store_files(upload_date,output_dir,summary_file=None,workers=None,batch_size=10000,connections=None,**options):
+    """
+    Export data/store_files/*.json from PostgreSQL for one upload date.
+    Prices are read with a single query through a server-side cursor, or with connections set,
+    as store_code ranges extracted concurrently over a connection pool (see pg_extract.py).
+    The ranges are read back in order, so the export sees the same ordered rows either way.
+
+    Parameters:
+    upload_date (str): Upload date to export (YYYY-MM-DD)
+    output_dir (str): Directory for the per-store files
+    summary_file (str): Optional path for a JSON list of all store summaries
+    workers (int): Number of worker processes (defaults to the CPU count)
+    batch_size (int): Number of rows fetched from the server per round-trip
+    connections (int): Number of pooled connections extracting store ranges at once
+    options: Passed to export_store_files (manifest and the export options in DEFAULT_OPTIONS)
+    """
+    if connections:
+        from pg_extract import (PARTITIONS_PER_CONNECTION,PartitionedExtraction,close_pool,get_pool,
+                                pooled_connection,store_code_partitions)
+
+        pool = get_pool(connections)
+        try:
+            with pooled_connection(pool) as pg_conn:
+                with pg_conn.cursor() as pg_cursor:
+                    partitions = store_code_partitions(pg_cursor,connections * PARTITIONS_PER_CONNECTION,column='s.store_code')
+            print(f"Executing store prices query for {upload_date} in {len(partitions)} store ranges "
+                  f"over {connections} connections...")
+            rows = PartitionedExtraction(PARTITIONED_STORE_PRICES_QUERY,store_prices_params(upload_date),partitions,connections,batch_size,pool)
+            return export_store_files(rows,output_dir,summary_file,workers,**options)
+        finally:
+            close_pool()
+
+    import storage
+
+    print(f"Connecting to the {storage.describe_backend()}...")
+    pg_conn = storage.connect()
+    try:
+        with pg_conn.cursor(name='store_files_export') as pg_cursor:
+            pg_cursor.itersize = batch_size
+            print(f"Executing store prices query for {upload_date}...")
+            pg_cursor.execute(STORE_PRICES_QUERY,store_prices_params(upload_date))
+            return export_store_files(pg_cursor,output_dir,summary_file,workers,**options)
+    finally:
+        pg_conn.close()
+        print(f"Database connection closed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export data/store_files/*.json from PostgreSQL")
+    parser.add_argument("upload_date",help="Upload date to export (YYYY-MM-DD)")
+    parser.add_argument("--workers",type=int,default=None,help="Number of worker processes")
+    parser.add_argument("--connections",type=int,default=None,
+                        help="Extract store ranges concurrently over this many pooled connections")
+    parser.add_argument("--compact",action="store_true",help="Write minified columnar files with prices rounded to agorot")
+    parser.add_argument("--compress",action="store_true",help="Also write pre-compressed .gz/.br siblings")
+    parser.add_argument("--catalog",action="store_true",help="Write item descriptions once to a shared items catalog")
+    parser.add_argument("--search-index",action="store_true",
+                        help="Also write <store_code>.index.json for fast search and sorting in the price table")
+    parser.add_argument("--pages",type=page_size_argument,nargs='?',const=DEFAULT_PAGE_SIZE,default=0,metavar="SIZE",
+                        help=f"Also write each store as a header and pages of SIZE items (default {DEFAULT_PAGE_SIZE})")
+    parser.add_argument("--incremental",action="store_true",
+                        help="Only rewrite stores whose prices changed (uses data/build_manifest.json)")
+    args = parser.parse_args()
+
+    manifest = BuildManifest("data/build_manifest.json") if args.incremental else None
+
+    postgres_to_store_files(
+        args.upload_date,
+        "data/store_files",
+        summary_file="data/store_price_comparisons.json",
+        workers=args.workers,
+        connections=args.connections,
+        manifest=manifest,
+        compact=args.compact,
+        compress=args.compress,
+        catalog=args.catalog,
+        search_index=args.search_index,
+        page_size=args.pages
+    )
+
+    if manifest is not None:
+        manifest.save()
+        manifest.write_changed_list("data/changed_files.json")
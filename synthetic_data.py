@@ -0,0 +1,358 @@
+import argparse
+import csv
+import io
+import os
+from array import array
+
+import numpy as np
+
+from geojson_stream import atomic_open
+from pg_copy import ALL_STORES_COLUMNS,ALLPRICES_COLUMNS,ITEMS_NEW_COLUMNS,STORE_PRICE_COMPARISONS_COLUMNS,ColumnTable
+from price_aggregation import DEFAULT_POPULARITY_THRESHOLD,aggregate_prices,encode_price_data
+from store_files_export import store_price_rows
+
+DEFAULT_SEED = 2025
+DEFAULT_UPLOAD_DATE = '2025-06-01'
+
+# Size of the current production data (one upload date). Scale 1 reproduces it; stores and
+# prices grow linearly with the scale and the item catalog with its square root.
+CURRENT_STORES = 250
+CURRENT_ITEMS = 78000
+CURRENT_PRICES_PER_STORE = 4200
+
+# Named scales accepted on the command line
+SCALES = {'1x': 1,'10x': 10,'100x': 100}
+
+# Item popularity follows a Zipf-like law: the item of rank r is weighted r ** -ZIPF_EXPONENT
+ZIPF_EXPONENT = 1.1
+
+# (store_code prefix, chainname, subchains, price level, relative store size)
+CHAINS = [
+    ('ram','רמי לוי',['רמי לוי','רמי לוי בשכונה'],0.90,1.6),
+    ('shu','שופרסל',['שופרסל דיל','שופרסל שלי','שופרסל אקספרס','יש חסד'],1.00,1.0),
+    ('vic','ויקטורי',['ויקטורי'],0.95,1.2),
+    ('yoh','יוחננוף',['יוחננוף'],0.93,1.5),
+    ('tiv','טיב טעם',['טיב טעם'],1.05,1.3),
+    ('osh','אושר עד',['אושר עד'],0.90,1.4),
+    ('haz','חצי חינם',['חצי חינם'],0.94,1.5),
+    ('sap','סופר ספיר',['ד.מ.','סופר ספיר'],1.10,0.4),
+    ('ampm','AM:PM',['AM:PM'],1.20,0.6),
+    ('stop','סטופ מרקט',['סטופ מרקט'],1.08,0.8),
+    ('yen','ינות ביתן',['מגה בעיר','ינות ביתן'],1.03,0.9),
+    ('goo','גוד מרקט',['גוד מרקט'],1.02,0.7)
+]
+
+# (city, latitude, longitude)
+CITIES = [
+    ('ירושלים',31.7683,35.2137),('תל אביב-יפו',32.0853,34.7818),('חיפה',32.7940,34.9896),
+    ('ראשון לציון',31.9730,34.7925),('פתח תקווה',32.0871,34.8878),('אשדוד',31.8014,34.6435),
+    ('נתניה',32.3215,34.8532),('באר שבע',31.2518,34.7913),('בני ברק',32.0807,34.8338),
+    ('חולון',32.0158,34.7874),('רמת גן',32.0684,34.8248),('אשקלון',31.6688,34.5743),
+    ('רחובות',31.8928,34.8113),('בית שמש',31.7470,34.9881),('קרית גת',31.6100,34.7642),
+    ('אור עקיבא',32.5086,34.9196),('גני תקווה',32.0597,34.8733),('מודיעין',31.8980,35.0104),
+    ('טבריה',32.7940,35.5312),('אילת',29.5577,34.9519),('נצרת',32.6996,35.3035),('עפולה',32.6078,35.2897)
+]
+STREETS = ['הרצל','ז\'בוטינסקי','בן גוריון','הנשיא','רוטשילד','ויצמן','העצמאות','הכרמל','אופנהימר',
+           'יפו','דרך השלום','הגפן','שדרות ירושלים','הרב קוק']
+
+PRODUCTS = ['חלב','שמנת','גבינה לבנה','יוגורט','קוטג\'','לחם','פיתות','חומוס','טחינה','במבה','ביסלי',
+            'שוקולד','קפה','תה','מיץ תפוזים','קולה זירו','מים מינרליים','אורז','פסטה','קמח','סוכר',
+            'שמן זית','שמן קנולה','רסק עגבניות','טונה','תירס','אפונה','עוגיות','דגני בוקר','נקניק',
+            'שניצל','פרגיות','ביצים','מרגרינה','חמאה','גבינה צהובה','קטשופ','מיונז','סבון כלים',
+            'נייר טואלט','אבקת כביסה','שמפו','משחת שיניים','חטיף אנרגיה','לבן','שוקו','גלידה']
+MODIFIERS = ['','','','אורגני','דל שומן','ללא גלוטן','מופחת סוכר','בטעם וניל','בטעם שוקולד','מלא',
+             'קלאסי','משפחתי','מהדרין','בד"צ','3%','5%','9%']
+SIZES = ['100 גרם','200 גר','250 מ"ל','330 מ"ל','500 גרם','1 ליטר','1.5 ליטר','750 מל','1 ק"ג',
+         '6 יח\'','12 יח','במשקל','400גר','50 גרם']
+MANUFACTURERS = ['תנובה','שטראוס','אסם','עלית','החברה המרכזית','טרה','יטבתה','סוגת','וילי פוד','דנשר',
+                 'מחלבת המושבה','פרי הגליל','יכין','זוגלובק','סנו','יוניליוור','נסטלה','ש. שסטוביץ']
+BRANDS = ['תנובה','עלית','אסם','פרילי','יטבתה','סוגת','סיציליה','סנו','טעמן','ויליפוד','פרי ניר','מילקי']
+CATEGORIES = ['מוצרי חלב','מאפים','חטיפים','משקאות','שימורים','ניקיון','טואלטיקה','בשר ועוף','יבשים',
+              'ממרחים','קפואים']
+
+# Hebrew points sprinkled on a few item names, as some chains publish them
+NIQQUD_MARKS = ['ָ','ַ','ִ','ּ','ְ']
+
+
+def _column_table(columns,values):
+    """Build a ColumnTable from {column: numpy array or list}"""
+    table = ColumnTable(columns)
+    for name,kind in columns:
+        if kind == 'int':
+            table.columns[name] = array('q',np.asarray(values[name],dtype=np.int64).tobytes())
+        elif kind == 'float':
+            table.columns[name] = array('d',np.asarray(values[name],dtype=np.float64).tobytes())
+        else:
+            table.columns[name] = list(values[name])
+    return table
+
+
+class SyntheticDataset:
+    """
+    Seeded synthetic price data shaped like one upload date of the production database:
+    all_stores, items_new and allprices as ColumnTables (see pg_copy.py), so they can be fed
+    to the same code as extracted data.
+
+    The data has Hebrew store, city and item names (with quotes, abbreviations and the odd
+    niqqud), NULL coordinates and item fields, NaN/zero/negative prices, chains with
+    different price levels and store sizes, and Zipf-distributed item popularity.
+
+    Parameters:
+    scale (float): Size relative to the current data (1 = ~250 stores, ~1M prices)
+    seed (int): Random seed; the same scale and seed always give the same data
+    """
+
+    def __init__(self,scale=1,seed=DEFAULT_SEED):
+        self.scale = scale
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.store_count = max(len(CHAINS),int(round(CURRENT_STORES * scale)))
+        self.item_count = int(round(CURRENT_ITEMS * scale ** 0.5))
+        self.stores,self.store_levels,self.store_sizes = self._generate_stores(rng)
+        self.items,self.base_prices = self._generate_items(rng)
+        self.prices = self._generate_prices(rng)
+        self._aggregation = None
+
+    def _generate_stores(self,rng):
+        count = self.store_count
+        chain_sizes = np.array([chain[4] for chain in CHAINS])
+        chain_ids = rng.choice(len(CHAINS),size=count,p=chain_sizes / chain_sizes.sum())
+        city_ids = rng.integers(0,len(CITIES),size=count)
+        numbers = {}
+        values = {name: [] for name,kind in ALL_STORES_COLUMNS}
+        levels = np.empty(count)
+        sizes = np.empty(count)
+        for store,(chain_id,city_id) in enumerate(zip(chain_ids,city_ids)):
+            prefix,chainname,subchains,level,size = CHAINS[chain_id]
+            city,lat,lon = CITIES[city_id]
+            numbers[prefix] = numbers.get(prefix,0) + rng.integers(1,7)
+            storeid = numbers[prefix]
+            values['store_code'].append(f"{prefix}_{storeid:03d}")
+            name = f"{city} {STREETS[rng.integers(len(STREETS))]}"
+            if rng.random() < 0.05:
+                name = f'{name} - "זכיין", {chainname}'
+            values['storename'].append(name)
+            values['chainname'].append(chainname)
+            values['subchainname'].append(None if rng.random() < 0.01 else subchains[rng.integers(len(subchains))])
+            values['storeid'].append(storeid)
+            values['address'].append('unknown' if rng.random() < 0.05 else f"{STREETS[rng.integers(len(STREETS))]} {rng.integers(1,200)}")
+            values['city'].append(city)
+            values['zipcode'].append('0' if rng.random() < 0.3 else str(rng.integers(1000000,9999999)))
+            # Stores spread ~5 km around the city centre; a few have no coordinates
+            values['latitude'].append(np.nan if rng.random() < 0.02 else lat + rng.normal(0,0.03))
+            values['longitude'].append(np.nan if rng.random() < 0.02 else lon + rng.normal(0,0.03))
+            levels[store] = level * rng.normal(1.0,0.02)
+            sizes[store] = size * rng.lognormal(0.0,0.35)
+
+        order = np.argsort(values['store_code'],kind='stable')
+        values = {name: [column[i] for i in order] for name,column in values.items()}
+        return _column_table(ALL_STORES_COLUMNS,values),levels[order],sizes[order] / sizes.mean()
+
+    def _generate_items(self,rng):
+        count = self.item_count
+        # Mostly 13-digit Israeli barcodes, plus short internal codes
+        barcodes = 7290000000000 + rng.choice(10 ** 10,size=count,replace=False)
+        internal = rng.random(count) < 0.08
+        barcodes[internal] = rng.choice(10 ** 8,size=int(internal.sum()),replace=False) + 10 ** 7
+        itemcodes = np.unique(barcodes)
+        rng.shuffle(itemcodes)  # popularity rank is independent of the code
+
+        values = {name: [] for name,kind in ITEMS_NEW_COLUMNS}
+        values['itemcode'] = itemcodes
+        for index in range(len(itemcodes)):
+            if rng.random() < 0.03:
+                values['itemname'].append(None)
+            else:
+                words = [PRODUCTS[rng.integers(len(PRODUCTS))],MODIFIERS[rng.integers(len(MODIFIERS))],
+                         SIZES[rng.integers(len(SIZES))]]
+                if rng.random() < 0.4:
+                    words.insert(0,BRANDS[rng.integers(len(BRANDS))])
+                name = ' '.join(word for word in words if word)
+                if rng.random() < 0.02:
+                    position = rng.integers(1,len(name))
+                    name = name[:position] + NIQQUD_MARKS[rng.integers(len(NIQQUD_MARKS))] + name[position:]
+                values['itemname'].append(name)
+            values['manufacturer'].append(None if rng.random() < 0.1 else MANUFACTURERS[rng.integers(len(MANUFACTURERS))])
+            values['brand'].append(None if rng.random() < 0.3 else BRANDS[rng.integers(len(BRANDS))])
+            values['category'].append(None if rng.random() < 0.2 else CATEGORIES[rng.integers(len(CATEGORIES))])
+        base_prices = np.round(rng.lognormal(2.3,0.8,size=len(itemcodes)),1) + 0.09
+        return _column_table(ITEMS_NEW_COLUMNS,values),base_prices
+
+    def _generate_prices(self,rng):
+        item_count = len(self.base_prices)
+        weights = np.arange(1,item_count + 1,dtype=np.float64) ** -ZIPF_EXPONENT
+        cumulative = np.cumsum(weights)
+        cumulative /= cumulative[-1]
+        itemcodes = np.frombuffer(self.items['itemcode'],dtype=np.int64)
+
+        store_ids = []
+        item_ids = []
+        for store in range(self.store_count):
+            wanted = min(item_count // 2,int(CURRENT_PRICES_PER_STORE * self.store_sizes[store]))
+            # Sampling with replacement until enough distinct items are drawn saturates the
+            # popular items, which every store carries, and thins out the long tail
+            drawn = np.empty(0,dtype=np.int64)
+            while True:
+                drawn = np.concatenate((drawn,np.searchsorted(cumulative,rng.random(wanted))))
+                distinct,first = np.unique(np.minimum(drawn,item_count - 1),return_index=True)
+                if len(distinct) >= wanted:
+                    break
+            drawn = np.sort(distinct[np.argsort(first)[:wanted]])
+            store_ids.append(np.full(len(drawn),store,dtype=np.int64))
+            item_ids.append(drawn)
+        store_ids = np.concatenate(store_ids)
+        item_ids = np.concatenate(item_ids)
+
+        prices = (self.base_prices[item_ids] * self.store_levels[store_ids]
+                  * rng.normal(1.0,0.08,size=len(item_ids)))
+        prices = np.round(np.maximum(prices,0.1),2)
+        noise = rng.random(len(prices))
+        prices[noise < 0.005] = np.nan
+        prices[(noise >= 0.005) & (noise < 0.007)] = 0.0
+        prices[(noise >= 0.007) & (noise < 0.008)] = -1.0
+
+        # Ordered by store_code, itemcode like the export queries
+        codes = itemcodes[item_ids]
+        order = np.lexsort((codes,store_ids))
+        store_codes = self.stores['store_code']
+        return _column_table(ALLPRICES_COLUMNS,{
+            'store_code': [store_codes[store] for store in store_ids[order]],
+            'itemcode': codes[order],
+            'itemprice': prices[order]
+        })
+
+    def aggregation(self,threshold=DEFAULT_POPULARITY_THRESHOLD):
+        """The store comparison computed from the data by price_aggregation.aggregate_prices"""
+        if self._aggregation is None or self._aggregation[0] != threshold:
+            data = encode_price_data(self.prices,self.stores)
+            known_items = np.frombuffer(self.items['itemcode'],dtype=np.int64)
+            self._aggregation = (threshold,aggregate_prices(data,threshold,known_items=known_items))
+        return self._aggregation[1]
+
+    def store_comparison_rows(self):
+        """
+        Rows in the store_price_comparisons.csv format, as strings, with the NULL/NaN spellings
+        found in exported files
+        """
+        rng = np.random.default_rng(self.seed + 1)
+        rows = []
+        for row in self.aggregation().store_rows():
+            row = ['' if value is None else str(value) for value in row]
+            noise = rng.random()
+            if noise < 0.01:
+                row[8] = 'NaN'
+            elif noise < 0.02:
+                row[9] = 'NULL'
+            elif noise < 0.03 and row[10] != '':
+                row[10] = 'nan'
+            rows.append(row)
+        return rows
+
+    def store_price_rows(self):
+        """Yield rows in the STORE_PRICES_QUERY format (see store_files_export.py), ordered by store_code, itemcode"""
+        return store_price_rows(self.aggregation(),self.items)
+
+
+def _write_csv(path,header,rows):
+    with atomic_open(path,'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def _table_rows(table):
+    for row in table.rows():
+        yield ['' if value is None or (isinstance(value,float) and np.isnan(value)) else value for value in row]
+
+
+def write_store_comparisons_csv(dataset,output_file):
+    """Write the store comparison of a dataset in the store_price_comparisons.csv format"""
+    _write_csv(output_file,[name for name,kind in STORE_PRICE_COMPARISONS_COLUMNS],dataset.store_comparison_rows())
+
+
+def write_dataset(dataset,output_dir):
+    """
+    Write a dataset as CSV files: store_price_comparisons.csv (the csv_to_geojson input) and
+    all_stores.csv, items_new.csv and allprices.csv (the database tables).
+    """
+    os.makedirs(output_dir,exist_ok=True)
+    write_store_comparisons_csv(dataset,os.path.join(output_dir,'store_price_comparisons.csv'))
+    _write_csv(os.path.join(output_dir,'all_stores.csv'),[name for name,kind in ALL_STORES_COLUMNS],_table_rows(dataset.stores))
+    _write_csv(os.path.join(output_dir,'items_new.csv'),[name for name,kind in ITEMS_NEW_COLUMNS],_table_rows(dataset.items))
+    _write_csv(os.path.join(output_dir,'allprices.csv'),[name for name,kind in ALLPRICES_COLUMNS],_table_rows(dataset.prices))
+    print(f"Wrote {dataset.store_count:,} stores, {len(dataset.items):,} items and {len(dataset.prices):,} prices to {output_dir}")
+
+
+# Tables of the local stand-in database, in the columns the export queries use
+STAND_IN_TABLES = {
+    'all_stores': "store_code text, storename text, chainname text, subchainname text, storeid int8, "
+                  "address text, city text, zipcode text, latitude float8, longitude float8",
+    'items_new': "itemcode int8, itemname text, manufacturer text, brand text, category text",
+    'allprices': "store_code text, itemcode int8, itemprice float8, upload_date date"
+}
+
+
+def load_into_postgres(pg_conn,dataset,upload_date=DEFAULT_UPLOAD_DATE):
+    """
+    Load a dataset into a local stand-in database and build the materialized views and the
+    popular_items_avg_prices table the exports read. Existing stand-in tables are replaced,
+    so never run this against the production database.
+
+    Parameters:
+    pg_conn: psycopg2 connection to the stand-in database
+    dataset (SyntheticDataset): Data to load
+    upload_date (str): upload_date given to every price
+    """
+    from matview_maintenance import MATERIALIZED_VIEWS,create_base_indexes,create_materialized_views
+
+    pg_conn.autocommit = True
+    with pg_conn.cursor() as pg_cursor:
+        for view in reversed(MATERIALIZED_VIEWS):
+            pg_cursor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view} CASCADE")
+        pg_cursor.execute("DROP TABLE IF EXISTS popular_items_avg_prices")
+        for table,columns in STAND_IN_TABLES.items():
+            pg_cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+            pg_cursor.execute(f"CREATE TABLE {table} ({columns})")
+
+        for table,source,extra in (('all_stores',dataset.stores,[]),('items_new',dataset.items,[]),
+                                   ('allprices',dataset.prices,[upload_date])):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in _table_rows(source):
+                writer.writerow(row + extra)
+            buffer.seek(0)
+            pg_cursor.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv)",buffer)
+            print(f"Loaded {len(source):,} rows into {table}")
+
+        create_base_indexes(pg_cursor)
+        create_materialized_views(pg_cursor)
+        pg_cursor.execute(
+            "CREATE TABLE popular_items_avg_prices AS "
+            "SELECT itemcode, average_price FROM popular_items_avg_prices_mv"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic price data for benchmarks")
+    parser.add_argument("--scale",default="1x",help=f"One of {', '.join(SCALES)} or a number")
+    parser.add_argument("--seed",type=int,default=DEFAULT_SEED,help="Random seed")
+    parser.add_argument("--output",default=None,help="Directory for the CSV files (default: diagnostics/benchmark_data/<scale>)")
+    parser.add_argument("--load-database",action="store_true",
+                        help="Load the data into the stand-in database in config.benchmark_pg_config")
+    args = parser.parse_args()
+
+    scale = SCALES.get(args.scale) or float(args.scale)
+    dataset = SyntheticDataset(scale,args.seed)
+    write_dataset(dataset,args.output or os.path.join("diagnostics","benchmark_data",args.scale))
+
+    if args.load_database:
+        import psycopg2
+        import config
+
+        print("Connecting to the stand-in database...")
+        pg_conn = psycopg2.connect(**config.benchmark_pg_config)
+        try:
+            load_into_postgres(pg_conn,dataset)
+        finally:
+            pg_conn.close()
+            print(f"Database connection closed")
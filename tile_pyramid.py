@@ -0,0 +1,222 @@
+import argparse
+import json
+import math
+import os
+from collections import Counter
+
+from build_manifest import BuildManifest,hash_bytes,hash_file
+from geojson_stream import atomic_open,stream_feature_collection
+
+# Zoom levels of the pyramid. Below FEATURE_ZOOM tiles hold pre-aggregated clusters;
+# FEATURE_ZOOM tiles hold the full store features and are used at every higher zoom.
+MIN_ZOOM = 6
+FEATURE_ZOOM = 11
+
+# Stores in a cluster tile are grouped into CLUSTER_GRID x CLUSTER_GRID cells per tile
+CLUSTER_GRID = 8
+
+# Web Mercator is undefined at the poles; latitudes are clamped like map tiles are
+MAX_LATITUDE = 85.0511287798
+
+INDEX_FILE = "index.json"
+
+
+def tile_xy(lon,lat,zoom):
+    """Return the (x, y) Web Mercator tile containing a point at the given zoom level"""
+    lat = max(-MAX_LATITUDE,min(MAX_LATITUDE,lat))
+    n = 1 << zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x,0),n - 1),min(max(y,0),n - 1)
+
+
+def _coordinates(feature):
+    lon,lat = feature['geometry']['coordinates'][:2]
+    return lon,lat
+
+
+def cluster_feature(features):
+    """
+    Aggregate stores into one cluster point feature: store count, mean average_price_diff
+    over stores that have one, and the number of stores per chain (largest first).
+    A single store is returned as-is.
+    """
+    if len(features) == 1:
+        return features[0]
+
+    lon_sum = lat_sum = 0.0
+    diff_sum = 0.0
+    diff_count = 0
+    chains = Counter()
+    for feature in features:
+        lon,lat = _coordinates(feature)
+        lon_sum += lon
+        lat_sum += lat
+        props = feature['properties']
+        diff = props.get('average_price_diff')
+        if diff is not None:
+            diff_sum += diff
+            diff_count += 1
+        chains[props.get('chainname') or ''] += 1
+
+    count = len(features)
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [round(lon_sum / count,6),round(lat_sum / count,6)]
+        },
+        "properties": {
+            "cluster": True,
+            "count": count,
+            "average_price_diff": round(diff_sum / diff_count,2) if diff_count else None,
+            "chains": dict(chains.most_common())
+        }
+    }
+
+
+def build_tiles(features,zoom,cluster_grid=None):
+    """
+    Group features into the tiles of one zoom level.
+    Returns {(x, y): [feature, ...]}. With cluster_grid, the features of each tile are
+    replaced by one cluster per grid cell.
+
+    Parameters:
+    features (list): GeoJSON point features
+    zoom (int): Zoom level
+    cluster_grid (int): Optional cells per tile side (a power of two)
+    """
+    if not cluster_grid:
+        tiles = {}
+        for feature in features:
+            tiles.setdefault(tile_xy(*_coordinates(feature),zoom),[]).append(feature)
+        return tiles
+
+    # Cells of the grid are the tiles of a deeper zoom level
+    shift = cluster_grid.bit_length() - 1
+    cells = {}
+    for feature in features:
+        cells.setdefault(tile_xy(*_coordinates(feature),zoom + shift),[]).append(feature)
+
+    tiles = {}
+    for (cell_x,cell_y),cell_features in sorted(cells.items()):
+        tile = (cell_x >> shift,cell_y >> shift)
+        tiles.setdefault(tile,[]).append(cluster_feature(cell_features))
+    return tiles
+
+
+def load_features(geojson_file):
+    """Return the point features of a GeoJSON file that have coordinates"""
+    with open(geojson_file,'r',encoding='utf-8') as f:
+        data = json.load(f)
+    return [
+        feature for feature in data['features']
+        if feature.get('geometry') and feature['geometry'].get('coordinates')
+    ]
+
+
+def write_tile_pyramid(features,output_dir,min_zoom=MIN_ZOOM,feature_zoom=FEATURE_ZOOM,cluster_grid=CLUSTER_GRID):
+    """
+    Write the tile pyramid to output_dir/<z>/<x>/<y>.geojson and an index.json listing the
+    non-empty tiles of every zoom level, the zoom range and the chain and city filter values.
+    Tiles left over from a previous pyramid are removed.
+    Returns {path: hash} of every file written.
+
+    Parameters:
+    features (list): GeoJSON point features (e.g. from load_features)
+    output_dir (str): Directory of the pyramid
+    min_zoom (int): Lowest zoom level
+    feature_zoom (int): Zoom level holding the full features
+    cluster_grid (int): Cluster cells per tile side below feature_zoom
+    """
+    if cluster_grid & (cluster_grid - 1):
+        raise ValueError(f"cluster_grid must be a power of two, got {cluster_grid}")
+
+    files = {}
+    index_tiles = {}
+    for zoom in range(min_zoom,feature_zoom + 1):
+        tiles = build_tiles(features,zoom,None if zoom == feature_zoom else cluster_grid)
+        index_tiles[str(zoom)] = [f"{x}/{y}" for x,y in sorted(tiles)]
+        for (x,y),tile_features in tiles.items():
+            tile_file = os.path.join(output_dir,str(zoom),str(x),f"{y}.geojson")
+            os.makedirs(os.path.dirname(tile_file),exist_ok=True)
+            with stream_feature_collection(tile_file) as writer:
+                for feature in tile_features:
+                    writer.write_feature(feature)
+            files[tile_file] = hash_file(tile_file)
+        print(f"Zoom {zoom}: {len(tiles)} tiles")
+
+    index = {
+        "min_zoom": min_zoom,
+        "feature_zoom": feature_zoom,
+        "store_count": len(features),
+        "chains": sorted({f['properties'].get('chainname') for f in features} - {None,''}),
+        "cities": sorted({f['properties'].get('city') for f in features} - {None,''}),
+        "tiles": index_tiles
+    }
+    index_data = json.dumps(index,ensure_ascii=False,separators=(',',':')).encode('utf-8')
+    index_file = os.path.join(output_dir,INDEX_FILE)
+    with atomic_open(index_file,'wb') as f:
+        f.write(index_data)
+    files[index_file] = hash_bytes(index_data)
+
+    written = {os.path.abspath(path) for path in files}
+    for root,dirs,names in os.walk(output_dir,topdown=False):
+        for name in names:
+            path = os.path.join(root,name)
+            if name.endswith('.geojson') and os.path.abspath(path) not in written:
+                os.remove(path)
+        if root != output_dir and not os.listdir(root):
+            os.rmdir(root)
+    return files
+
+
+def build_tile_pyramid(geojson_file,output_dir,manifest=None,**options):
+    """
+    Build the tile pyramid of a stores GeoJSON file.
+
+    Parameters:
+    geojson_file (str): Path of the stores GeoJSON (e.g. data/stores.geojson)
+    output_dir (str): Directory of the pyramid
+    manifest (BuildManifest): Optional build manifest. If the GeoJSON file is unchanged since the
+                              recorded build, the pyramid is not rebuilt.
+    **options: min_zoom, feature_zoom and cluster_grid for write_tile_pyramid
+    """
+    source_hash = None
+    if manifest is not None:
+        source_hash = hash_bytes(repr((hash_file(geojson_file),sorted(options.items()))).encode('utf-8'))
+        if manifest.is_current("tiles",source_hash):
+            print(f"{geojson_file} unchanged since the previous build, keeping {output_dir}")
+            return
+
+    features = load_features(geojson_file)
+    files = write_tile_pyramid(features,output_dir,**options)
+    print(f"Wrote {len(files)} tile pyramid files for {len(features)} stores to {output_dir}")
+
+    if manifest is not None:
+        manifest.record("tiles",source_hash,files)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a zoom-level tile pyramid of the stores GeoJSON")
+    parser.add_argument("--input",default="data/stores.geojson",help="Stores GeoJSON file")
+    parser.add_argument("--output",default="data/tiles",help="Output directory")
+    parser.add_argument("--min-zoom",type=int,default=MIN_ZOOM,help="Lowest zoom level")
+    parser.add_argument("--feature-zoom",type=int,default=FEATURE_ZOOM,help="Zoom level with full store features")
+    parser.add_argument("--cluster-grid",type=int,default=CLUSTER_GRID,help="Cluster cells per tile side")
+    parser.add_argument("--incremental",action="store_true",help="Skip the build if the input is unchanged")
+    args = parser.parse_args()
+
+    options = {
+        "min_zoom": args.min_zoom,
+        "feature_zoom": args.feature_zoom,
+        "cluster_grid": args.cluster_grid
+    }
+    if args.incremental:
+        manifest = BuildManifest("data/build_manifest.json")
+        build_tile_pyramid(args.input,args.output,manifest,**options)
+        manifest.save()
+        manifest.write_changed_list("data/changed_files.json")
+    else:
+        build_tile_pyramid(args.input,args.output,**options)